@@ -13,4 +13,16 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# После настройки Django: модуль импортирует модели
+from wallets.push import websocket_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """
+    HTTP - приложение Django, WebSocket - поток изменений кошельков (wallets.push)
+    """
+    if scope['type'] == 'websocket':
+        return await websocket_application(scope, receive, send)
+    return await django_application(scope, receive, send)
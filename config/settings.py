@@ -9,9 +9,9 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 
 SECRET_KEY = os.getenv('SECRET_KEY')
 
-DEBUG = True
+DEBUG = os.getenv('DEBUG', 'true').lower() == 'true'
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = [host for host in os.getenv('ALLOWED_HOSTS', '').split(',') if host]
 
 INSTALLED_APPS = [
     'django.contrib.admin',
@@ -63,7 +63,7 @@ WSGI_APPLICATION = 'config.wsgi.application'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.ClaimsJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -78,10 +78,29 @@ DATABASES = {
         'PASSWORD': os.getenv('POSTGRES_PASSWORD'),
         'HOST': os.getenv('POSTGRES_HOST'),
         'PORT': os.getenv('POSTGRES_PORT'),
-
+        # Соединение проверяется перед повторным использованием (из пула или после CONN_MAX_AGE)
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Пул соединений процесса (psycopg 3): запрос берет готовое соединение
+# вместо нового подключения к Postgres. DB_POOL_TIMEOUT - наибольшее
+# ожидание свободного соединения, секунды; без пула соединение живет
+# DB_CONN_MAX_AGE секунд (0 - закрывается после каждого запроса)
+DB_POOL_ENABLED = os.getenv('DB_POOL_ENABLED', 'false').lower() == 'true'
+if DB_POOL_ENABLED:
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+            'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+            'max_idle': float(os.getenv('DB_POOL_MAX_IDLE', 600)),
+            'max_lifetime': float(os.getenv('DB_POOL_MAX_LIFETIME', 3600)),
+        },
+    }
+else:
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.getenv('DB_CONN_MAX_AGE', 0))
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -117,6 +136,9 @@ AUTH_USER_MODEL = 'users.User'
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=120),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
+    # Токен содержит признак администратора и кошелек пользователя; отозванные токены не принимаются
+    "TOKEN_OBTAIN_SERIALIZER": "wallets.serializers.WalletTokenObtainPairSerializer",
+    "TOKEN_REFRESH_SERIALIZER": "users.serializers.DenylistTokenRefreshSerializer",
 }
 
 CORS_ALLOWED_ORIGINS = [
@@ -131,3 +153,156 @@ CSRF_TRUSTED_ORIGINS = [
 CORS_ALLOW_ALL_ORIGINS = False
 
 NULLABLE = {'blank': True, 'null': True}
+
+# Движок операций с кошельком: 'atomic' (один SQL-запрос), 'locking'
+# или 'combiner' (групповая фиксация операций одного кошелька)
+WALLET_OPERATION_ENGINE = os.getenv('WALLET_OPERATION_ENGINE', 'atomic')
+
+# Окно накопления операций для движка 'combiner', мс
+WALLET_COMBINER_WINDOW_MS = float(os.getenv('WALLET_COMBINER_WINDOW_MS', 2))
+
+# Максимальное число операций в одном пакетном запросе
+WALLET_BATCH_MAX_SIZE = int(os.getenv('WALLET_BATCH_MAX_SIZE', 1000))
+
+# Срок хранения ключей идемпотентности (заголовок Idempotency-Key), часы
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.getenv('IDEMPOTENCY_KEY_TTL_HOURS', 24))
+
+# Redis для кэша состояния кошельков; без него используется кэш в памяти процесса
+REDIS_URL = os.getenv('REDIS_URL')
+
+# Время жизни записи кэша состояния кошелька, секунды
+BALANCE_CACHE_TTL = int(os.getenv('BALANCE_CACHE_TTL', 300))
+
+# То же для кэша в памяти (без REDIS_URL): записи других процессов (воркеров gunicorn, process_operations,
+# import_ledger) он не видит, поэтому запись живет недолго и баланс отстает от базы не больше чем на этот срок
+LOCAL_BALANCE_CACHE_TTL = float(os.getenv('LOCAL_BALANCE_CACHE_TTL', 1))
+
+# Наибольшее ожидание изменения кошелька (GET с If-None-Match и ?wait=), секунды
+WALLET_LONG_POLL_MAX_WAIT = float(os.getenv('WALLET_LONG_POLL_MAX_WAIT', 30))
+
+# Интервал перечитывания версии из базы при ожидании без Redis, секунды
+WALLET_LONG_POLL_INTERVAL = float(os.getenv('WALLET_LONG_POLL_INTERVAL', 1))
+
+# Размер страницы истории операций по умолчанию и наибольший (?limit=)
+OPERATION_PAGE_SIZE = int(os.getenv('OPERATION_PAGE_SIZE', 50))
+OPERATION_PAGE_MAX_SIZE = int(os.getenv('OPERATION_PAGE_MAX_SIZE', 500))
+
+# Разделы таблицы операций: на сколько месяцев вперед создавать, сколько
+# полных месяцев хранить в базе (0 - хранить все) и куда выгружать старые
+OPERATION_PARTITIONS_AHEAD = int(os.getenv('OPERATION_PARTITIONS_AHEAD', 3))
+OPERATION_RETENTION_MONTHS = int(os.getenv('OPERATION_RETENTION_MONTHS', 0))
+OPERATION_ARCHIVE_DIR = os.getenv('OPERATION_ARCHIVE_DIR', str(BASE_DIR / 'archive'))
+
+# Асинхронные представления баланса и операций вместо синхронных; работают
+# под ASGI-сервером (uvicorn config.asgi:application) с пулом psycopg 3
+WALLET_ASYNC_VIEWS = os.getenv('WALLET_ASYNC_VIEWS', 'false').lower() == 'true'
+ASYNC_DB_POOL_MIN_SIZE = int(os.getenv('ASYNC_DB_POOL_MIN_SIZE', 1))
+ASYNC_DB_POOL_MAX_SIZE = int(os.getenv('ASYNC_DB_POOL_MAX_SIZE', 20))
+ASYNC_DB_POOL_TIMEOUT = float(os.getenv('ASYNC_DB_POOL_TIMEOUT', 30))
+
+# Аутентификация только по утверждениям токена, без запросов пользователя и
+# групп; отозванные токены перечитываются из базы не чаще раза в
+# JWT_DENYLIST_REFRESH_SECONDS секунд (в других процессах отзыв действует с этой задержкой)
+JWT_STATELESS_AUTH = os.getenv('JWT_STATELESS_AUTH', 'false').lower() == 'true'
+JWT_DENYLIST_REFRESH_SECONDS = float(os.getenv('JWT_DENYLIST_REFRESH_SECONDS', 5))
+
+# Наибольший интервал выписки кошелька (?from=&to=), дни
+WALLET_STATEMENT_MAX_DAYS = int(os.getenv('WALLET_STATEMENT_MAX_DAYS', 366))
+
+# Точный COUNT(*) в списках админки, пока оценка планировщика меньше этого числа строк
+ADMIN_EXACT_COUNT_MAX = int(os.getenv('ADMIN_EXACT_COUNT_MAX', 10000))
+
+# Рендерер и парсер JSON на orjson вместо json стандартной библиотеки (ответы те же байт в байт)
+FAST_JSON = os.getenv('FAST_JSON', 'false').lower() == 'true'
+if FAST_JSON:
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'] = (
+        'wallets.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    )
+    REST_FRAMEWORK['DEFAULT_PARSER_CLASSES'] = (
+        'wallets.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    )
+
+# Метрики запросов процесса (/metrics, формат Prometheus) и заголовок Server-Timing с временем
+# обработки, базы и рендера. /metrics отдается с Authorization: Bearer <METRICS_TOKEN> (если задан) или с JWT
+# администратора, без них - 401
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_SERVER_TIMING = os.getenv('METRICS_SERVER_TIMING', 'false').lower() == 'true'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+if METRICS_ENABLED:
+    MIDDLEWARE.insert(0, 'wallets.metrics.RequestMetricsMiddleware')
+
+# Ожидание блокировки строки кошелька, с которого кошелек считается конкурентным (мс), и
+# сколько таких кошельков отслеживает набросок горячих кошельков процесса (/metrics)
+LOCK_WAIT_CONTENDED_MS = float(os.getenv('LOCK_WAIT_CONTENDED_MS', 1))
+HOT_WALLETS_TRACKED = int(os.getenv('HOT_WALLETS_TRACKED', 100))
+
+# Допуск операций к кошельку (0 - без ограничения): выполняющихся одновременно операций на кошелек,
+# операций в секунду и запас корзины (token bucket) на кошелек и на пользователя. Сверх пределов -
+# 429 с Retry-After (ADMISSION_RETRY_AFTER секунд при пределе одновременных операций). Счетчики - в
+# Redis (REDIS_URL), иначе в памяти процесса; счетчик одновременных операций в Redis живет
+# ADMISSION_IN_FLIGHT_TTL секунд с последнего допуска
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 0))
+ADMISSION_WALLET_RATE = float(os.getenv('ADMISSION_WALLET_RATE', 0))
+ADMISSION_WALLET_BURST = float(os.getenv('ADMISSION_WALLET_BURST', 20))
+ADMISSION_USER_RATE = float(os.getenv('ADMISSION_USER_RATE', 0))
+ADMISSION_USER_BURST = float(os.getenv('ADMISSION_USER_BURST', 20))
+ADMISSION_RETRY_AFTER = float(os.getenv('ADMISSION_RETRY_AFTER', 1))
+ADMISSION_IN_FLIGHT_TTL = int(os.getenv('ADMISSION_IN_FLIGHT_TTL', 30))
+
+# Реплики для чтения: POSTGRES_REPLICAS - через запятую host[:port] с теми же базой и пользователем,
+# что у default (базы replica_1, replica_2, ...). GET-запросы читают с реплики; клиент после своей
+# записи читает с основной базы REPLICA_PIN_SECONDS секунд или пока реплика не воспроизведет LSN записи
+# (позиция реплики перечитывается не чаще раза в REPLICA_LSN_CHECK_INTERVAL секунд)
+DATABASE_REPLICAS = []
+for number, replica in enumerate(filter(None, os.getenv('POSTGRES_REPLICAS', '').split(',')), start=1):
+    host, _, port = replica.strip().partition(':')
+    DATABASES[f'replica_{number}'] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port,
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica_{number}')
+REPLICA_PIN_SECONDS = float(os.getenv('REPLICA_PIN_SECONDS', 5))
+REPLICA_LSN_CHECK_INTERVAL = float(os.getenv('REPLICA_LSN_CHECK_INTERVAL', 0.1))
+if DATABASE_REPLICAS:
+    DATABASE_ROUTERS = ['wallets.replicas.ReplicaRouter']
+    # До сессий и аутентификации: их чтения тоже идут на реплику
+    MIDDLEWARE.insert(
+        MIDDLEWARE.index('django.contrib.sessions.middleware.SessionMiddleware'),
+        'wallets.replicas.ReplicaRoutingMiddleware'
+    )
+
+# Шарды кошельков: POSTGRES_SHARDS - через запятую host[:port][/dbname] с тем же пользователем, что у default
+# (базы shard_1, shard_2, ...). Кошелек со своими операциями живет в одной базе из WALLET_SHARDS, где - записано
+# в справочнике в default; по шардам кошельки раскладывает команда rebalance_wallets
+WALLET_SHARDS = ['default']
+for number, shard in enumerate(filter(None, os.getenv('POSTGRES_SHARDS', '').split(',')), start=1):
+    address, _, name = shard.strip().partition('/')
+    host, _, port = address.partition(':')
+    DATABASES[f'shard_{number}'] = {
+        **DATABASES['default'],
+        'NAME': name or DATABASES['default']['NAME'],
+        'HOST': host,
+        'PORT': port,
+    }
+    WALLET_SHARDS.append(f'shard_{number}')
+if len(WALLET_SHARDS) > 1:
+    # Раньше маршрутизатора реплик: чтения кошелька идут в его шард, реплики есть только у default
+    DATABASE_ROUTERS = ['wallets.sharding.ShardRouter'] + (
+        ['wallets.replicas.ReplicaRouter'] if DATABASE_REPLICAS else []
+    )
+
+# Асинхронный режим операций (Prefer: respond-async): обработанные операции хранятся для опроса статуса
+# OPERATION_QUEUE_RETENTION_HOURS часов; OPERATION_QUEUE_EAGER - обработка в процессе запроса без process_operations
+OPERATION_QUEUE_RETENTION_HOURS = int(os.getenv('OPERATION_QUEUE_RETENTION_HOURS', 24))
+OPERATION_QUEUE_EAGER = os.getenv('OPERATION_QUEUE_EAGER', 'false').lower() == 'true'
+
+# Поток изменений баланса (.../<uuid>/events/, SSE и WebSocket под ASGI): сигнал поддержания соединения каждые
+# WALLET_PUSH_HEARTBEAT секунд без событий, соединение закрывается через WALLET_PUSH_MAX_AGE секунд (клиент
+# переподключается с последней версией)
+WALLET_PUSH_HEARTBEAT = float(os.getenv('WALLET_PUSH_HEARTBEAT', 15))
+WALLET_PUSH_MAX_AGE = float(os.getenv('WALLET_PUSH_MAX_AGE', 300))
@@ -6,6 +6,8 @@ from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 
+from wallets.views import MetricsView
+
 schema_view = get_schema_view(
    openapi.Info(
       title="Snippets API",
@@ -25,6 +27,7 @@ urlpatterns = [
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
 
+    path('metrics', MetricsView.as_view(), name='metrics'),
     path('admin/', admin.site.urls),
     path('users/', include('users.urls', namespace='users')),
     path('api/v1/wallets/', include('wallets.urls', namespace='wallets'))
@@ -0,0 +1,30 @@
+"""
+Настройки gunicorn для промышленного запуска: gunicorn -c gunicorn.conf.py config.wsgi
+
+Каждый рабочий процесс держит свой пул соединений с базой (DB_POOL_ENABLED),
+поэтому соединений с Postgres не больше GUNICORN_WORKERS * DB_POOL_MAX_SIZE.
+Потоков в процессе не должно быть больше DB_POOL_MAX_SIZE, иначе запросы
+ждут свободное соединение.
+"""
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+# Приложение загружается в каждом процессе после fork: пул и соединения не наследуются
+preload_app = False
+
+# Перезапуск процесса после max_requests запросов ограничивает рост памяти
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
@@ -1,8 +1,12 @@
 from django.contrib import admin
 
 from users.models import User
+from wallets.admin_utils import ScalableModelAdmin
 
 
 @admin.register(User)
-class UserAdmin(admin.ModelAdmin):
+class UserAdmin(ScalableModelAdmin):
     list_display = ('id', 'email',)
+    # Точное совпадение - поиск по уникальному индексу email
+    search_fields = ('=email',)
+    list_only_fields = ('id', 'email')
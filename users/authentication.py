@@ -0,0 +1,112 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from users.denylist import get_token_denylist
+from users.models import User
+from wallets import async_db
+
+
+def token_revoked():
+    return AuthenticationFailed('Токен отозван', code='token_revoked')
+
+
+def user_from_claims(validated_token):
+    """
+    Пользователь из подписанных утверждений токена, без запроса к базе.
+    Экземпляр не загружен из базы: годится для сравнения и внешних ключей.
+    """
+    try:
+        user = User(id=validated_token[api_settings.USER_ID_CLAIM])
+    except KeyError:
+        raise InvalidToken(_('Token contained no recognizable user identification'))
+    user.is_admin = validated_token.get('is_admin', False)
+    # Не wallet: так называется обратная связь с моделью кошелька
+    user.token_wallet = validated_token.get('wallet')
+    return user
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication с проверкой списка отозванных токенов.
+
+    С JWT_STATELESS_AUTH пользователь, признак администратора и кошелек
+    берутся из утверждений токена, поэтому ни аутентификация, ни IsAdmin
+    и IsOwner не обращаются к базе. Смена пароля и прав, блокировка и
+    удаление пользователя отзывают его токены.
+    """
+
+    def get_validated_token(self, raw_token):
+        validated_token = super().get_validated_token(raw_token)
+        if get_token_denylist().is_revoked(validated_token):
+            raise token_revoked()
+        return validated_token
+
+    def get_user(self, validated_token):
+        if settings.JWT_STATELESS_AUTH:
+            return user_from_claims(validated_token)
+        return super().get_user(validated_token)
+
+
+class AsyncJWTAuthentication(JWTAuthentication):
+    """
+    Аутентификация по JWT для асинхронных представлений.
+
+    Токен проверяется как в JWTAuthentication, пользователь читается одним
+    запросом через асинхронный пул вместе с признаком администратора,
+    поэтому проверка IsAdmin не обращается к базе. С JWT_STATELESS_AUTH
+    пользователь берется из утверждений токена.
+    """
+    user_sql = """
+        SELECT id, is_active, is_superuser, password, EXISTS (
+            SELECT 1 FROM {user_groups} AS user_group JOIN auth_group ON auth_group.id = user_group.group_id
+            WHERE user_group.user_id = {user}.id AND auth_group.name = 'admin'
+        )
+        FROM {user} WHERE id = %s
+    """
+
+    async def aauthenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        validated_token = self.get_validated_token(raw_token)
+        denylist = get_token_denylist()
+        if denylist.is_stale():
+            await sync_to_async(denylist.reload)()
+        if denylist.is_revoked(validated_token, reload=False):
+            raise token_revoked()
+        return await self.aget_user(validated_token), validated_token
+
+    async def aget_user(self, validated_token):
+        if settings.JWT_STATELESS_AUTH:
+            return user_from_claims(validated_token)
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        row = await async_db.fetchone(
+            self.user_sql.format(user=User._meta.db_table, user_groups=User.groups.through._meta.db_table), [user_id]
+        )
+        if row is None:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        user = User(id=row[0], is_active=row[1], is_superuser=row[2], password=row[3])
+        user.is_admin = row[4]
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code='password_changed')
+
+        return user
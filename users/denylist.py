@@ -0,0 +1,110 @@
+"""
+Список отозванных JWT.
+
+Источник истины - таблица RevokedToken, проверка токена идет по снимку
+в памяти процесса: снимок перечитывается не чаще раза в
+JWT_DENYLIST_REFRESH_SECONDS. Отзыв в своем процессе действует сразу, в
+других процессах - после перечитывания снимка.
+
+Снимок ограничен: моменты отзыва по пользователям (одна строка на
+пользователя) и отозванные токены, истекающие в пределах срока жизни
+access-токена, - только такими могут быть отозванные access-токены.
+Refresh-токен проверяется в таблице при обновлении: это редкий запрос.
+"""
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Max
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+
+from users.models import RevokedToken
+
+
+class TokenDenylist:
+
+    def __init__(self, refresh: float):
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.loaded_at = None
+        self.tokens = set()
+        # user_id -> момент отзыва (timestamp): недействительны токены, выданные не позже
+        self.users = {}
+
+    def is_stale(self) -> bool:
+        return self.loaded_at is None or time.monotonic() - self.loaded_at >= self.refresh
+
+    def reload(self):
+        now = timezone.now()
+        # С основной базы: отстающая реплика вернула бы отозванные токены как действующие
+        revoked = RevokedToken.objects.using(DEFAULT_DB_ALIAS).filter(expires_at__gt=now)
+        tokens = set(
+            revoked.filter(jti__isnull=False, expires_at__lte=now + api_settings.ACCESS_TOKEN_LIFETIME)
+            .values_list('jti', flat=True)
+        )
+        users = {
+            user_id: revoked_at.timestamp()
+            for user_id, revoked_at in revoked.filter(user_id__isnull=False).values('user_id').annotate(
+                revoked_at=Max('revoked_at')
+            ).values_list('user_id', 'revoked_at')
+        }
+        with self.lock:
+            self.tokens, self.users, self.loaded_at = tokens, users, time.monotonic()
+
+    def is_revoked(self, token, reload: bool = True) -> bool:
+        """
+        Отозван ли токен. С reload=False снимок не перечитывается
+        (асинхронный код перечитывает его сам в потоке).
+        """
+        if reload and self.is_stale():
+            self.reload()
+        jti = token.get(api_settings.JTI_CLAIM)
+        if jti in self.tokens:
+            return True
+        if token.get(api_settings.TOKEN_TYPE_CLAIM) == 'refresh' and jti is not None:
+            # Отозванного refresh-токена может не быть в снимке
+            if RevokedToken.objects.using(DEFAULT_DB_ALIAS).filter(jti=jti).exists():
+                return True
+        revoked_at = self.users.get(token.get(api_settings.USER_ID_CLAIM))
+        return revoked_at is not None and token.get('auth_time', token.get('iat', 0)) <= revoked_at
+
+    def revoke_token(self, token):
+        """
+        Отзыв одного токена до истечения его срока
+        """
+        jti = token[api_settings.JTI_CLAIM]
+        RevokedToken.objects.get_or_create(
+            jti=jti, defaults={'expires_at': datetime.fromtimestamp(token['exp'], tz=dt_timezone.utc)}
+        )
+        with self.lock:
+            self.tokens.add(jti)
+
+    def revoke_user(self, user_id):
+        """
+        Отзыв всех выданных пользователю токенов
+        """
+        lifetime = max(api_settings.ACCESS_TOKEN_LIFETIME, api_settings.REFRESH_TOKEN_LIFETIME)
+        # Отзывы редки, заодно удаляются истекшие записи
+        RevokedToken.objects.filter(expires_at__lte=timezone.now()).delete()
+        revoked = RevokedToken.objects.create(user_id=user_id, expires_at=timezone.now() + lifetime)
+        with self.lock:
+            self.users[user_id] = max(self.users.get(user_id, 0), revoked.revoked_at.timestamp())
+
+
+_denylist = None
+_denylist_lock = threading.Lock()
+
+
+def get_token_denylist() -> TokenDenylist:
+    """
+    Список отозванных токенов процесса
+    """
+    global _denylist
+    if _denylist is None:
+        with _denylist_lock:
+            if _denylist is None:
+                _denylist = TokenDenylist(settings.JWT_DENYLIST_REFRESH_SECONDS)
+    return _denylist
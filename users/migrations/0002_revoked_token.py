@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-18 09:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevokedToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jti', models.CharField(blank=True, max_length=255, null=True, unique=True, verbose_name='Идентификатор токена')),
+                ('user_id', models.BigIntegerField(blank=True, null=True, verbose_name='Пользователь')),
+                ('revoked_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата и время отзыва')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='Срок хранения')),
+            ],
+            options={
+                'verbose_name': 'Отозванный токен',
+                'verbose_name_plural': 'Отозванные токены',
+            },
+        ),
+    ]
@@ -38,4 +38,37 @@ class User(AbstractUser):
 
     class Meta:
         verbose_name = 'Пользователь'
-        verbose_name_plural = 'Пользователи'
\ No newline at end of file
+        verbose_name_plural = 'Пользователи'
+
+
+class RevokedToken(models.Model):
+    """
+    Модель отзыва токенов.
+
+    Отзывается один токен (jti, выход из системы) или все токены
+    пользователя, выданные до revoked_at (смена пароля, прав, блокировка).
+    Запись нужна только до истечения срока отозванных токенов.
+    """
+    jti = models.CharField(
+        max_length=255,
+        unique=True,
+        **NULLABLE,
+        verbose_name='Идентификатор токена'
+    )
+    # Не внешний ключ: отзыв переживает удаление пользователя
+    user_id = models.BigIntegerField(
+        **NULLABLE,
+        verbose_name='Пользователь'
+    )
+    revoked_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name='Дата и время отзыва'
+    )
+    expires_at = models.DateTimeField(
+        db_index=True,
+        verbose_name='Срок хранения'
+    )
+
+    class Meta:
+        verbose_name = 'Отозванный токен'
+        verbose_name_plural = 'Отозванные токены'
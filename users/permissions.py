@@ -3,6 +3,9 @@ from rest_framework.permissions import BasePermission
 
 class IsAdmin(BasePermission):
     def has_permission(self, request, view):
+        # Признак из токена или загруженный вместе с пользователем (асинхронная аутентификация)
+        if hasattr(request.user, 'is_admin'):
+            return request.user.is_admin or request.user.is_superuser
         return request.user.groups.filter(name='admin').exists() or request.user.is_superuser
 
 
@@ -15,6 +18,10 @@ class IsYourObject(BasePermission):
 
 class IsOwner(BasePermission):
     def has_object_permission(self, request, view, obj):
-        if obj.owner == request.user:
+        # Сравнение по id: без загрузки владельца из базы
+        if obj.owner_id == request.user.pk:
+            return True
+        # Кошелек из утверждений токена
+        if getattr(request.user, 'token_wallet', None) is not None and request.user.token_wallet == str(obj.pk):
             return True
         return False
@@ -1,5 +1,11 @@
-from rest_framework.serializers import ModelSerializer
+import time
 
+from rest_framework.serializers import CharField, ModelSerializer, Serializer
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+
+from users.authentication import token_revoked
+from users.denylist import get_token_denylist
 from users.models import User
 
 
@@ -19,3 +25,40 @@ class UserDetailSerializer(ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'email', 'password', 'first_name', 'last_name', 'phone')
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """
+    Пара токенов с признаком администратора
+    """
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        # Момент входа с долями секунды: отзыв отсекает токены, выданные до него,
+        # не задевая вход сразу после отзыва. Переходит в токены, полученные обновлением
+        token['auth_time'] = time.time()
+        token['is_admin'] = user.is_superuser or user.groups.filter(name='admin').exists()
+        return token
+
+
+class DenylistTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    Обновление токена, кроме отозванного
+    """
+
+    def validate(self, attrs):
+        try:
+            refresh = self.token_class(attrs['refresh'])
+        except TokenError as e:
+            raise InvalidToken(e.args[0])
+        if get_token_denylist().is_revoked(refresh):
+            raise token_revoked()
+        return super().validate(attrs)
+
+
+class LogoutSerializer(Serializer):
+    """
+    Выход: кроме токена запроса отзывается переданный refresh-токен
+    """
+    refresh = CharField(required=False)
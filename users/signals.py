@@ -0,0 +1,52 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from users.denylist import get_token_denylist
+from users.models import User
+
+# Поля, от которых зависят выданные токены: пароль, блокировка и права
+SECURITY_FIELDS = ('password', 'is_active', 'is_superuser')
+
+
+@receiver(pre_save, sender=User)
+def detect_security_change(sender, instance, update_fields=None, **kwargs):
+    instance._revoke_tokens = False
+    if instance.pk is None:
+        return
+    # Сохранение только других полей (например, last_login) выданных токенов не касается
+    if update_fields is not None and not set(update_fields) & set(SECURITY_FIELDS):
+        return
+    previous = User.objects.filter(pk=instance.pk).values(*SECURITY_FIELDS).first()
+    if previous is not None:
+        instance._revoke_tokens = any(previous[field] != getattr(instance, field) for field in SECURITY_FIELDS)
+
+
+@receiver(post_save, sender=User)
+def revoke_on_security_change(sender, instance, created, **kwargs):
+    if not created and instance._revoke_tokens:
+        get_token_denylist().revoke_user(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def revoke_on_delete(sender, instance, **kwargs):
+    get_token_denylist().revoke_user(instance.pk)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def revoke_on_groups_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Признак администратора в токене зависит от групп пользователя
+    """
+    if action == 'pre_clear' and reverse:
+        # Группа очищается целиком: участники известны только до очистки
+        instance._cleared_users = list(instance.user_set.values_list('pk', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        users = [instance.pk]
+    elif action == 'post_clear':
+        users = getattr(instance, '_cleared_users', [])
+    else:
+        users = pk_set or []
+    for user_id in users:
+        get_token_denylist().revoke_user(user_id)
@@ -2,7 +2,7 @@ from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 
-from users.models import User
+from users.models import RevokedToken, User
 
 
 class UserTestCase(APITestCase):
@@ -27,6 +27,9 @@ class UserTestCase(APITestCase):
         self.assertEqual(
             User.objects.all().count(), 2
         )
+        # Пароль хэшируется при первом сохранении, токены не отзываются
+        self.assertTrue(User.objects.get(email='test@example.com').check_password('qwe123'))
+        self.assertFalse(RevokedToken.objects.exists())
 
     def test_user_retrieve(self):
         """ Тест просмотра пользователя"""
@@ -6,7 +6,9 @@ from rest_framework_simplejwt.views import (
 )
 
 from users.apps import UsersConfig
-from users.views import UserCreateAPIView, UserListApiView, UserRetrieveApiView, UserUpdateApiView, UserDestroyApiView
+from users.views import (
+    UserCreateAPIView, UserListApiView, UserRetrieveApiView, UserUpdateApiView, UserDestroyApiView, LogoutAPIView
+)
 
 app_name = UsersConfig.name
 
@@ -14,6 +16,7 @@ urlpatterns = [
     path('register/', UserCreateAPIView.as_view(), name='register'),
     path('login/', TokenObtainPairView.as_view(permission_classes=(AllowAny,)), name='login'),
     path('token/refresh/', TokenRefreshView.as_view(permission_classes=(AllowAny,)), name='token_refresh'),
+    path('logout/', LogoutAPIView.as_view(), name='logout'),
     path('list/', UserListApiView.as_view(), name='users_list'),
     path('<int:pk>/', UserRetrieveApiView.as_view(), name='user_retrieve'),
     path('<int:pk>/update', UserUpdateApiView.as_view(), name='user_update'),
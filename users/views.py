@@ -1,9 +1,17 @@
+from django.contrib.auth.hashers import make_password
 from rest_framework.generics import CreateAPIView, ListAPIView, RetrieveAPIView, UpdateAPIView, DestroyAPIView
-from rest_framework.permissions import AllowAny
+from rest_framework import status
+from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
 
 from users.models import User
+from users.denylist import get_token_denylist
 from users.permissions import IsAdmin, IsYourObject
-from users.serializers import UserSerializer, UserDetailSerializer
+from users.serializers import UserSerializer, UserDetailSerializer, LogoutSerializer
 
 
 class UserCreateAPIView(CreateAPIView):
@@ -15,9 +23,8 @@ class UserCreateAPIView(CreateAPIView):
     permission_classes = (AllowAny,)
 
     def perform_create(self, serializer):
-        user = serializer.save(is_active=True)
-        user.set_password(user.password)
-        user.save()
+        # Пароль хэшируется до первого сохранения: его смена вторым сохранением отзывала бы токены
+        serializer.save(is_active=True, password=make_password(serializer.validated_data['password']))
 
 
 class UserListApiView(ListAPIView):
@@ -54,3 +61,29 @@ class UserDestroyApiView(DestroyAPIView):
     queryset = User.objects.all()
     serializer_class = UserDetailSerializer
     permission_classes = (IsYourObject,)
+
+
+class LogoutAPIView(APIView):
+    """
+    Выход: токен запроса и переданный refresh-токен отзываются
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
+        serializer = LogoutSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        refresh = None
+        if 'refresh' in serializer.validated_data:
+            try:
+                refresh = RefreshToken(serializer.validated_data['refresh'])
+            except TokenError as e:
+                raise InvalidToken(e.args[0])
+            if str(refresh.get(api_settings.USER_ID_CLAIM)) != str(request.user.pk):
+                raise InvalidToken('Токен другого пользователя')
+
+        denylist = get_token_denylist()
+        if request.auth is not None:
+            denylist.revoke_token(request.auth)
+        if refresh is not None:
+            denylist.revoke_token(refresh)
+        return Response(status=status.HTTP_204_NO_CONTENT)
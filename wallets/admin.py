@@ -1,13 +1,26 @@
 from django.contrib import admin
 
+from wallets.admin_utils import ScalableModelAdmin
 from wallets.models import Wallet, Operation
 
 
 @admin.register(Wallet)
-class WalletAdmin(admin.ModelAdmin):
-    list_display = ('owner', 'balance',)
+class WalletAdmin(ScalableModelAdmin):
+    list_display = ('uuid', 'owner', 'balance', 'shard_count',)
+    # Владелец - одним JOIN, только нужные столбцы
+    list_select_related = ('owner',)
+    raw_id_fields = ('owner',)
+    list_only_fields = ('uuid', 'balance', 'shard_count', 'owner__id', 'owner__email')
+    search_fields = ('=owner__email',)
 
 
-@admin.register(Operation )
-class OperationAdmin(admin.ModelAdmin):
-    list_display = ('wallet', 'operation_type', 'amount', 'created_at')
+@admin.register(Operation)
+class OperationAdmin(ScalableModelAdmin):
+    list_display = ('id', 'wallet_id', 'operation_type', 'amount', 'created_at')
+    list_filter = ('operation_type',)
+    # Фильтр по дате - полуинтервал created_at: индекс wallets_op_created_idx и отсечение разделов
+    date_hierarchy = 'created_at'
+    keyset_ordering = ('-created_at', '-id')
+    # wallet_id вместо кошелька: список без обращения к таблице кошельков
+    list_only_fields = ('id', 'wallet_id', 'operation_type', 'amount', 'created_at')
+    raw_id_fields = ('wallet',)
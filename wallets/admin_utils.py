@@ -0,0 +1,211 @@
+"""
+Админка для таблиц на миллионы строк.
+
+- EstimatedCountPaginator: число строк по оценке планировщика вместо
+  COUNT(*), точный подсчет - только для небольших выборок.
+- KeysetChangeList: страницы по ключу сортировки (?cursor=) вместо OFFSET,
+  время ответа не зависит от глубины страницы.
+- SkipScanQuerySet: годы, месяцы и дни иерархии дат находятся поиском
+  минимума по индексу от границы к границе, без чтения всех строк периода.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db.models import Min, Q, QuerySet
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+CURSOR_VAR = 'cursor'
+SKIP_SCAN_KINDS = ('year', 'month', 'day')
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator с оценкой числа строк по плану запроса (EXPLAIN), точный
+    COUNT(*) - пока оценка меньше ADMIN_EXACT_COUNT_MAX
+    """
+
+    estimated = False
+
+    @cached_property
+    def count(self):
+        plan = json.loads(self.object_list.explain(format='json'))
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        if estimate < settings.ADMIN_EXACT_COUNT_MAX:
+            return self.object_list.count()
+        self.estimated = True
+        return estimate
+
+
+class SkipScanQuerySet(QuerySet):
+    """
+    QuerySet, в котором dates/datetimes (иерархия дат админки) выполняются
+    серией запросов MIN(поле) от начала следующего периода: по индексу поля
+    это один переход на период вместо DISTINCT по всем строкам
+    """
+
+    def datetimes(self, field_name, kind, order='ASC', tzinfo=None):
+        if kind not in SKIP_SCAN_KINDS:
+            return super().datetimes(field_name, kind, order, tzinfo)
+        tzinfo = tzinfo or timezone.get_current_timezone()
+        return self.skip_scan(field_name, kind, order, lambda value: timezone.localtime(value, tzinfo))
+
+    def dates(self, field_name, kind, order='ASC'):
+        if kind not in SKIP_SCAN_KINDS:
+            return super().dates(field_name, kind, order)
+        return self.skip_scan(field_name, kind, order, lambda value: value)
+
+    def skip_scan(self, field_name, kind, order, localize):
+        periods, lower = [], None
+        while True:
+            queryset = self if lower is None else self.filter(**{f'{field_name}__gte': lower})
+            first = queryset.aggregate(first=Min(field_name))['first']
+            if first is None:
+                break
+            period = truncate(localize(first), kind)
+            periods.append(period)
+            lower = next_period(period, kind)
+        return periods[::-1] if order == 'DESC' else periods
+
+
+def truncate(value, kind):
+    value = value.replace(month=1 if kind == 'year' else value.month, day=1 if kind in ('year', 'month') else value.day)
+    if isinstance(value, datetime):
+        value = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    return value
+
+
+def next_period(period, kind):
+    if kind == 'day':
+        following = period + timedelta(days=1)
+    elif kind == 'month':
+        following = (period.replace(day=28) + timedelta(days=4)).replace(day=1)
+    else:
+        following = period.replace(year=period.year + 1)
+    if isinstance(following, datetime):
+        # Граница в часовом поясе периода (переходы на летнее время)
+        following = timezone.make_aware(following.replace(tzinfo=None), period.tzinfo)
+    return following
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Список админки со страницами по ключу ModelAdmin.keyset_ordering
+    (поля по убыванию, последнее - уникальное; по умолчанию - первичный
+    ключ). Ссылка на следующую страницу содержит ключ последней строки;
+    при сортировке по другому столбцу - обычные страницы.
+    """
+
+    @cached_property
+    def keyset_ordering(self):
+        return self.model_admin.keyset_ordering or (f'-{self.model._meta.pk.name}',)
+
+    def get_filters_params(self, params=None):
+        params = super().get_filters_params(params)
+        params.pop(CURSOR_VAR, None)
+        return params
+
+    @property
+    def keyset(self):
+        return ORDER_VAR not in self.params
+
+    def get_queryset(self, request, exclude_parameters=None):
+        queryset = super().get_queryset(request, exclude_parameters)
+        # Только столбцы списка; форма объекта читает строку целиком
+        if self.model_admin.list_only_fields:
+            queryset = queryset.only(*self.model_admin.list_only_fields)
+        return queryset
+
+    def get_ordering(self, request, queryset):
+        if self.keyset:
+            return list(self.keyset_ordering)
+        return super().get_ordering(request, queryset)
+
+    def get_results(self, request):
+        if not self.keyset:
+            self.next_cursor = None
+            return super().get_results(request)
+        fields = [field.lstrip('-') for field in self.keyset_ordering]
+        queryset = self.queryset
+        cursor = request.GET.get(CURSOR_VAR)
+        if cursor:
+            queryset = queryset.filter(self.after(fields, self.decode_cursor(fields, cursor)))
+        page = list(queryset[:self.list_per_page + 1])
+
+        self.paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        self.result_count = self.paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = page[:self.list_per_page]
+        self.can_show_all = False
+        self.multi_page = len(page) > self.list_per_page or bool(cursor)
+        self.next_cursor = (
+            self.encode_cursor([getattr(page[self.list_per_page - 1], field) for field in fields])
+            if len(page) > self.list_per_page else None
+        )
+
+    def next_page_url(self):
+        return self.get_query_string({CURSOR_VAR: self.next_cursor}) if self.next_cursor else None
+
+    def first_page_url(self):
+        return self.get_query_string(remove=[CURSOR_VAR])
+
+    @staticmethod
+    def after(fields, values):
+        """
+        Строки строго после ключа при сортировке по убыванию; условие
+        по первому полю (<=) - граница поиска по индексу
+        """
+        condition = Q(**{f'{fields[-1]}__lt': values[-1]})
+        for field, value in zip(fields[-2::-1], values[-2::-1]):
+            condition = Q(**{f'{field}__lt': value}) | (Q(**{field: value}) & condition)
+        if len(fields) > 1:
+            condition &= Q(**{f'{fields[0]}__lte': values[0]})
+        return condition
+
+    @staticmethod
+    def encode_cursor(values):
+        return base64.urlsafe_b64encode(
+            '|'.join(value.isoformat() if isinstance(value, datetime) else str(value) for value in values).encode()
+        ).decode()
+
+    def decode_cursor(self, fields, cursor):
+        try:
+            values = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            if len(values) != len(fields):
+                raise ValueError
+            return [self.model._meta.get_field(field).to_python(value) for field, value in zip(fields, values)]
+        except (binascii.Error, UnicodeDecodeError, ValueError, ValidationError):
+            raise IncorrectLookupParameters
+
+
+class ScalableModelAdmin(admin.ModelAdmin):
+    """
+    ModelAdmin для больших таблиц: оценка числа строк, страницы по ключу
+    keyset_ordering, без второго COUNT(*) всей таблицы; list_only_fields -
+    столбцы, которые читает список
+    """
+    keyset_ordering = None
+    list_only_fields = None
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    change_list_template = 'admin/keyset_change_list.html'
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        # Иерархия дат без DISTINCT по всем строкам периода
+        if self.date_hierarchy:
+            queryset = SkipScanQuerySet(self.model, query=queryset.query, using=queryset.db)
+        return queryset
@@ -0,0 +1,254 @@
+"""
+Допуск операций к кошельку до обращения к базе.
+
+Операция допускается, если у кошелька меньше ADMISSION_MAX_IN_FLIGHT
+выполняющихся операций и есть токены в корзинах (token bucket) кошелька
+(ADMISSION_WALLET_RATE операций в секунду, запас ADMISSION_WALLET_BURST)
+и пользователя (ADMISSION_USER_RATE, ADMISSION_USER_BURST). Нулевой
+предел отключает проверку. Отказ - 429 с Retry-After сразу, вместо
+ожидания блокировки строки кошелька в потоке обработчика.
+
+Счетчики хранятся в Redis (REDIS_URL), общие для всех процессов, иначе в
+памяти процесса. Ошибки Redis не ломают запрос: операция допускается.
+"""
+import math
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+
+from wallets.cache import run_cache
+
+
+class BaseAdmission:
+    """
+    Счетчики допуска. acquire возвращает None, если операция допущена
+    (после нее обязателен release), иначе - через сколько секунд повторить.
+    """
+    name = None
+    shared = False
+
+    def acquire(self, wallet_uuid, user_id):
+        raise NotImplementedError
+
+    def release(self, wallet_uuid):
+        raise NotImplementedError
+
+    @staticmethod
+    def limits():
+        return (
+            settings.ADMISSION_MAX_IN_FLIGHT,
+            settings.ADMISSION_WALLET_RATE, settings.ADMISSION_WALLET_BURST,
+            settings.ADMISSION_USER_RATE, settings.ADMISSION_USER_BURST,
+        )
+
+
+class LocalAdmission(BaseAdmission):
+    """
+    Счетчики в памяти процесса - замена Redis, когда REDIS_URL не задан
+    """
+    name = 'local'
+    # Размер таблицы корзин, после которого из нее удаляются полные корзины
+    prune_size = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        # ключ корзины -> [токены, время пополнения, скорость, запас]
+        self.buckets = {}
+
+    def acquire(self, wallet_uuid, user_id):
+        max_in_flight, wallet_rate, wallet_burst, user_rate, user_burst = self.limits()
+        key = str(wallet_uuid)
+        with self.lock:
+            if max_in_flight and self.in_flight.get(key, 0) >= max_in_flight:
+                return settings.ADMISSION_RETRY_AFTER
+            now = time.monotonic()
+            buckets = [
+                (bucket_key, self.refill(bucket_key, rate, burst, now))
+                for bucket_key, rate, burst in (
+                    (f'wallet:{key}', wallet_rate, wallet_burst), (f'user:{user_id}', user_rate, user_burst)
+                ) if rate
+            ]
+            wait = max([(1 - bucket[0]) / bucket[2] for _, bucket in buckets if bucket[0] < 1], default=0)
+            if wait:
+                return wait
+            for _, bucket in buckets:
+                bucket[0] -= 1
+            if max_in_flight:
+                self.in_flight[key] = self.in_flight.get(key, 0) + 1
+            if len(self.buckets) > self.prune_size:
+                self.prune(now)
+        return None
+
+    def refill(self, bucket_key, rate, burst, now):
+        bucket = self.buckets.get(bucket_key)
+        if bucket is None:
+            bucket = self.buckets[bucket_key] = [burst, now, rate, burst]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1:] = [now, rate, burst]
+        return bucket
+
+    def prune(self, now):
+        # Полная корзина не отличается от отсутствующей
+        for bucket_key in [
+            bucket_key for bucket_key, (tokens, updated, rate, burst) in self.buckets.items()
+            if tokens + (now - updated) * rate >= burst
+        ]:
+            del self.buckets[bucket_key]
+
+    def release(self, wallet_uuid):
+        key = str(wallet_uuid)
+        with self.lock:
+            count = self.in_flight.get(key, 0) - 1
+            if count > 0:
+                self.in_flight[key] = count
+            else:
+                self.in_flight.pop(key, None)
+
+
+class RedisAdmission(BaseAdmission):
+    """
+    Счетчики в Redis, общие для всех процессов.
+
+    Проверка и списание токенов обеих корзин и увеличение числа
+    выполняющихся операций - один Lua-скрипт: отказ ничего не списывает.
+    Время - часы Redis, одинаковые для всех процессов. Счетчик выполняющихся
+    операций живет ADMISSION_IN_FLIGHT_TTL секунд с последнего допуска:
+    так он обнуляется, если процесс завершился, не вызвав release.
+    """
+    name = 'redis'
+    shared = True
+
+    in_flight_prefix = 'wallet:admission:in_flight:'
+    bucket_prefix = 'wallet:admission:bucket:'
+
+    acquire_script = """
+        local max_in_flight = tonumber(ARGV[1])
+        if max_in_flight > 0 and tonumber(redis.call('GET', KEYS[1]) or '0') >= max_in_flight then
+            return {0, ARGV[6]}
+        end
+        local clock = redis.call('TIME')
+        local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+        local tokens, wait = {}, 0
+        for index = 1, 2 do
+            local rate, burst = tonumber(ARGV[index * 2]), tonumber(ARGV[index * 2 + 1])
+            if rate > 0 then
+                local state = redis.call('HMGET', KEYS[index + 1], 'tokens', 'updated')
+                local available = math.min(
+                    burst, (tonumber(state[1]) or burst) + (now - (tonumber(state[2]) or now)) * rate
+                )
+                if available < 1 then wait = math.max(wait, (1 - available) / rate) end
+                tokens[index] = {available, math.ceil(burst / rate * 1000) + 1000}
+            end
+        end
+        if wait > 0 then return {0, tostring(wait)} end
+        for index, bucket in pairs(tokens) do
+            redis.call('HSET', KEYS[index + 1], 'tokens', tostring(bucket[1] - 1), 'updated', tostring(now))
+            redis.call('PEXPIRE', KEYS[index + 1], bucket[2])
+        end
+        if max_in_flight > 0 then
+            redis.call('INCR', KEYS[1])
+            redis.call('EXPIRE', KEYS[1], ARGV[7])
+        end
+        return {1, '0'}
+    """
+
+    release_script = """
+        if redis.call('DECR', KEYS[1]) <= 0 then redis.call('DEL', KEYS[1]) end
+    """
+
+    def __init__(self, url: str):
+        import redis
+
+        self.errors = redis.RedisError
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.acquire_counters = self.client.register_script(self.acquire_script)
+        self.release_counters = self.client.register_script(self.release_script)
+
+    def acquire(self, wallet_uuid, user_id):
+        max_in_flight, *rates = self.limits()
+        try:
+            admitted, wait = self.acquire_counters(
+                keys=[
+                    self.in_flight_prefix + str(wallet_uuid),
+                    f'{self.bucket_prefix}wallet:{wallet_uuid}',
+                    f'{self.bucket_prefix}user:{user_id}',
+                ],
+                args=[max_in_flight, *rates, settings.ADMISSION_RETRY_AFTER, settings.ADMISSION_IN_FLIGHT_TTL]
+            )
+        except self.errors:
+            return None
+        return None if admitted else float(wait)
+
+    def release(self, wallet_uuid):
+        if not settings.ADMISSION_MAX_IN_FLIGHT:
+            return
+        try:
+            self.release_counters(keys=[self.in_flight_prefix + str(wallet_uuid)])
+        except self.errors:
+            pass
+
+
+_admission = None
+_admission_lock = threading.Lock()
+
+
+def get_admission() -> BaseAdmission:
+    """
+    Счетчики процесса: Redis при заданном REDIS_URL, иначе в памяти
+    """
+    global _admission
+    if _admission is None:
+        with _admission_lock:
+            if _admission is None:
+                _admission = RedisAdmission(settings.REDIS_URL) if settings.REDIS_URL else LocalAdmission()
+    return _admission
+
+
+def enabled() -> bool:
+    max_in_flight, wallet_rate, _, user_rate, _ = BaseAdmission.limits()
+    return bool(max_in_flight or wallet_rate or user_rate)
+
+
+def throttled(wait: float) -> Throttled:
+    # Retry-After - целое число секунд, не меньше одной
+    return Throttled(wait=max(math.ceil(wait), 1))
+
+
+@contextmanager
+def admit(wallet_uuid, user_id):
+    """
+    Выполнение операции с кошельком под счетчиками допуска; при отказе - Throttled (429)
+    """
+    if not enabled():
+        yield
+        return
+    admission = get_admission()
+    wait = admission.acquire(wallet_uuid, user_id)
+    if wait is not None:
+        raise throttled(wait)
+    try:
+        yield
+    finally:
+        admission.release(wallet_uuid)
+
+
+@asynccontextmanager
+async def aadmit(wallet_uuid, user_id):
+    """
+    admit для асинхронного кода: обращения к Redis - в потоке
+    """
+    if not enabled():
+        yield
+        return
+    admission = get_admission()
+    wait = await run_cache(admission, admission.acquire, wallet_uuid, user_id)
+    if wait is not None:
+        raise throttled(wait)
+    try:
+        yield
+    finally:
+        await run_cache(admission, admission.release, wallet_uuid)
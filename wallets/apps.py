@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class WalletsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'wallets'
+
+    def ready(self):
+        # Справочник шардов при удалении кошельков и пользователей
+        import wallets.signals  # noqa: F401
@@ -0,0 +1,101 @@
+"""
+Асинхронный доступ к Postgres для асинхронных представлений.
+
+Django ORM в асинхронном коде выполняет запросы в потоке, поэтому
+асинхронные представления работают с базой напрямую через psycopg 3 и
+пул соединений. Пул привязан к циклу событий: у каждого цикла (процесса
+ASGI-сервера) свой пул на каждую базу, соединения в режиме autocommit.
+Параметры соединения берутся из DATABASES, поэтому тестовая база
+подхватывается автоматически. Запросы кошельков передают базу шарда
+(wallets.sharding.wallet_db()), остальные идут в default.
+"""
+import asyncio
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from wallets.metrics import query_finished
+
+# Параметры OPTIONS, которые обрабатывает сам Django, а не libpq
+DJANGO_OPTIONS = {'pool', 'isolation_level', 'server_side_binding', 'assume_role'}
+
+_pools = {}
+
+
+def conninfo(using: str = DEFAULT_DB_ALIAS) -> str:
+    from psycopg.conninfo import make_conninfo
+
+    database = connections[using].settings_dict
+    params = {
+        'dbname': database['NAME'],
+        'user': database['USER'],
+        'password': database['PASSWORD'],
+        'host': database['HOST'],
+        'port': database['PORT'],
+        **{key: value for key, value in database.get('OPTIONS', {}).items() if key not in DJANGO_OPTIONS},
+    }
+    return make_conninfo(**{key: value for key, value in params.items() if value})
+
+
+async def get_pool(using: str = DEFAULT_DB_ALIAS):
+    """
+    Пул соединений с базой using для текущего цикла событий, открывается при первом обращении
+    """
+    from psycopg import AsyncClientCursor
+    from psycopg_pool import AsyncConnectionPool
+
+    loop = asyncio.get_running_loop()
+    pool = _pools.get((loop, using))
+    if pool is None:
+        # Пулы завершившихся циклов (async_to_sync) закрыть уже нельзя - соединения закроет сборщик мусора
+        for closed in [key for key in _pools if key[0].is_closed()]:
+            del _pools[closed]
+        # Подстановка параметров на стороне клиента, как у psycopg2: те же
+        # SQL-запросы моделей работают без указания типов параметров
+        pool = _pools[(loop, using)] = AsyncConnectionPool(
+            conninfo(using),
+            min_size=settings.ASYNC_DB_POOL_MIN_SIZE,
+            max_size=settings.ASYNC_DB_POOL_MAX_SIZE,
+            timeout=settings.ASYNC_DB_POOL_TIMEOUT,
+            kwargs={'autocommit': True, 'cursor_factory': AsyncClientCursor},
+            open=False,
+        )
+        await pool.open()
+    return pool
+
+
+async def fetchone(sql: str, params=None, using: str = DEFAULT_DB_ALIAS):
+    pool = await get_pool(using)
+    async with pool.connection() as connection, connection.cursor() as cursor:
+        started = time.perf_counter()
+        await cursor.execute(sql, params)
+        row = await cursor.fetchone()
+        query_finished(started)
+        return row
+
+
+async def fetchall(sql: str, params=None, using: str = DEFAULT_DB_ALIAS):
+    pool = await get_pool(using)
+    async with pool.connection() as connection, connection.cursor() as cursor:
+        started = time.perf_counter()
+        await cursor.execute(sql, params)
+        rows = await cursor.fetchall()
+        query_finished(started)
+        return rows
+
+
+async def close_pool():
+    """
+    Закрытие пулов текущего цикла событий (завершение процесса, тесты)
+    """
+    loop = asyncio.get_running_loop()
+    for key in [key for key in _pools if key[0] is loop]:
+        await _pools.pop(key).close()
+
+
+def get_pools():
+    """
+    Открытые пулы процесса (для счетчиков)
+    """
+    return [pool for (loop, _), pool in list(_pools.items()) if not loop.is_closed()]
@@ -0,0 +1,349 @@
+import asyncio
+import threading
+import time
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+# Версия удаленного кошелька: больше любой настоящей, поэтому запоздавшая
+# запись старого состояния не воскрешает кошелек в кэше
+TOMBSTONE_VERSION = 2 ** 53 - 1
+
+
+class BaseBalanceCache:
+    """
+    Кэш состояния кошелька: версия, баланс и владелец.
+
+    Запись выполняется только если версия новее сохраненной, поэтому
+    устаревшее состояние (запоздавший читатель, обогнавший коммит писатель)
+    не может затереть более новое. Состояние - словарь
+    {'version': int, 'balance': Decimal, 'owner': int}; у удаленного кошелька
+    balance равен None.
+    Кэш с shared = False виден только своему процессу.
+    """
+    name = None
+    shared = False
+
+    def get(self, wallet_uuid):
+        raise NotImplementedError
+
+    def set(self, wallet_uuid, state: dict) -> bool:
+        raise NotImplementedError
+
+    def delete(self, wallet_uuid):
+        """
+        Пометка кошелька удаленным
+        """
+        return self.set(wallet_uuid, {'version': TOMBSTONE_VERSION, 'balance': None, 'owner': None})
+
+    def wait(self, wallet_uuid, version: int, timeout: float) -> bool:
+        """
+        Ожидание записи состояния новее version не дольше timeout секунд.
+        Возвращает True, если такое состояние записано.
+        """
+        raise NotImplementedError
+
+    async def await_change(self, wallet_uuid, version: int, timeout: float) -> bool:
+        """
+        wait для асинхронного кода; по умолчанию ожидание в потоке
+        """
+        return await sync_to_async(self.wait, thread_sensitive=False)(wallet_uuid, version, timeout)
+
+    @staticmethod
+    def wake(future):
+        if not future.done():
+            future.set_result(True)
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+
+class LocalBalanceCache(BaseBalanceCache):
+    """
+    Кэш в памяти процесса - замена Redis, когда REDIS_URL не задан.
+    Записи других процессов он не видит, поэтому срок жизни записи короткий
+    (LOCAL_BALANCE_CACHE_TTL): дольше него устаревший баланс не отдается.
+    """
+    name = 'local'
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.entries = {}
+        # Ожидающие асинхронные запросы: uuid -> [(цикл событий, future)]
+        self.waiters = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, wallet_uuid):
+        with self.lock:
+            entry = self.entries.get(str(wallet_uuid))
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[str(wallet_uuid)]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(entry[1])
+
+    def set(self, wallet_uuid, state):
+        with self.lock:
+            entry = self.entries.get(str(wallet_uuid))
+            if entry is not None and entry[0] >= time.monotonic() and entry[1]['version'] >= state['version']:
+                return False
+            self.entries[str(wallet_uuid)] = (time.monotonic() + self.ttl, dict(state))
+            self.changed.notify_all()
+            for loop, future in self.waiters.pop(str(wallet_uuid), []):
+                loop.call_soon_threadsafe(self.wake, future)
+            return True
+
+    def wait(self, wallet_uuid, version, timeout):
+        def newer():
+            entry = self.entries.get(str(wallet_uuid))
+            return entry is not None and entry[1]['version'] > version
+
+        with self.changed:
+            return self.changed.wait_for(newer, timeout)
+
+    async def await_change(self, wallet_uuid, version, timeout):
+        """
+        Ожидание без потока: set будит future в цикле событий ожидающего
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            entry = self.entries.get(str(wallet_uuid))
+            if entry is not None and entry[1]['version'] > version:
+                return True
+            self.waiters.setdefault(str(wallet_uuid), []).append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            # И при отмене: закрытый клиентом поток событий не оставляет ожидающего
+            with self.lock:
+                waiters = self.waiters.get(str(wallet_uuid), [])
+                if (loop, future) in waiters:
+                    waiters.remove((loop, future))
+                    if not waiters:
+                        del self.waiters[str(wallet_uuid)]
+        with self.lock:
+            entry = self.entries.get(str(wallet_uuid))
+            return entry is not None and entry[1]['version'] > version
+
+    def stats(self):
+        return {'backend': self.name, 'hits': self.hits, 'misses': self.misses}
+
+
+class RedisBalanceCache(BaseBalanceCache):
+    """
+    Кэш в Redis, общий для всех процессов.
+
+    Сравнение версий и запись выполняются Lua-скриптом атомарно на стороне
+    Redis. Счетчики попаданий общие и обновляются тем же вызовом, что и
+    чтение. Успешная запись публикует новую версию в канал кошелька для
+    ожидающих изменений. Асинхронных ожидающих процесса будит один поток,
+    подписанный на каналы всех кошельков, поэтому открытые потоки событий
+    не занимают ни потоков, ни соединений с Redis. Ошибки Redis не ломают
+    запрос: чтение считается промахом, а запись пропускается.
+    """
+    name = 'redis'
+    shared = True
+
+    prefix = 'wallet:state:'
+    channel_prefix = 'wallet:changed:'
+    hits_key = 'wallet:cache:hits'
+    misses_key = 'wallet:cache:misses'
+
+    get_script = """
+        local state = redis.call('HMGET', KEYS[1], 'version', 'balance', 'owner')
+        if state[1] then redis.call('INCR', KEYS[2]) else redis.call('INCR', KEYS[3]) end
+        return state
+    """
+
+    set_script = """
+        local current = redis.call('HGET', KEYS[1], 'version')
+        if current and tonumber(current) >= tonumber(ARGV[1]) then return 0 end
+        redis.call('HSET', KEYS[1], 'version', ARGV[1], 'balance', ARGV[2], 'owner', ARGV[3])
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        redis.call('PUBLISH', KEYS[2], ARGV[1])
+        return 1
+    """
+
+    def __init__(self, url: str, ttl: int):
+        import redis
+
+        self.errors = redis.RedisError
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.ttl = ttl
+        self.get_state = self.client.register_script(self.get_script)
+        self.set_state = self.client.register_script(self.set_script)
+        self.lock = threading.Lock()
+        # Ожидающие асинхронные запросы: uuid -> [(цикл событий, future, версия)]
+        self.waiters = {}
+        self.listener = None
+
+    def get(self, wallet_uuid):
+        try:
+            version, balance, owner = self.get_state(
+                keys=[self.prefix + str(wallet_uuid), self.hits_key, self.misses_key]
+            )
+        except self.errors:
+            return None
+        if version is None:
+            return None
+        return {
+            'version': int(version),
+            'balance': Decimal(balance.decode()) if balance else None,
+            'owner': int(owner) if owner else None,
+        }
+
+    def set(self, wallet_uuid, state):
+        try:
+            return bool(self.set_state(
+                keys=[self.prefix + str(wallet_uuid), self.channel_prefix + str(wallet_uuid)],
+                args=[
+                    state['version'],
+                    '' if state['balance'] is None else str(state['balance']),
+                    '' if state['owner'] is None else state['owner'],
+                    self.ttl,
+                ]
+            ))
+        except self.errors:
+            return False
+
+    def wait(self, wallet_uuid, version, timeout):
+        deadline = time.monotonic() + timeout
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        try:
+            # Подписка до проверки версии: запись между ними не потеряется
+            pubsub.subscribe(self.channel_prefix + str(wallet_uuid))
+            current = self.client.hget(self.prefix + str(wallet_uuid), 'version')
+            if current is not None and int(current) > version:
+                return True
+            while (remaining := deadline - time.monotonic()) > 0:
+                message = pubsub.get_message(timeout=remaining)
+                if message is not None and int(message['data']) > version:
+                    return True
+            return False
+        except self.errors:
+            # Без Redis ожидание вырождается в паузу до таймаута
+            time.sleep(max(deadline - time.monotonic(), 0))
+            return False
+        finally:
+            pubsub.close()
+
+    async def await_change(self, wallet_uuid, version, timeout):
+        """
+        Ожидание без потока: публикацию новой версии доставляет общий
+        подписчик процесса (listen)
+        """
+        self.start_listener()
+        key = str(wallet_uuid)
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future(), version)
+        with self.lock:
+            self.waiters.setdefault(key, []).append(waiter)
+        try:
+            # Ожидающий зарегистрирован до проверки версии: публикация между ними не потеряется
+            current = await sync_to_async(self.version, thread_sensitive=False)(key)
+            if current is not None and current > version:
+                return True
+            await asyncio.wait_for(waiter[1], timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self.lock:
+                waiters = self.waiters.get(key, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self.waiters[key]
+
+    def version(self, key):
+        try:
+            current = self.client.hget(self.prefix + key, 'version')
+        except self.errors:
+            return None
+        return int(current) if current is not None else None
+
+    def start_listener(self):
+        if self.listener is None:
+            with self.lock:
+                if self.listener is None:
+                    self.listener = threading.Thread(target=self.listen, name='wallet-cache-listener', daemon=True)
+                    self.listener.start()
+
+    def listen(self):
+        """
+        Подписка на каналы всех кошельков; после ошибки Redis - переподключение.
+        Пропущенные за это время публикации ожидающие заметят по таймауту.
+        """
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.psubscribe(self.channel_prefix + '*')
+                while True:
+                    message = pubsub.get_message(timeout=1)
+                    if message is not None and message['type'] == 'pmessage':
+                        self.notify(message['channel'].decode()[len(self.channel_prefix):], int(message['data']))
+            except self.errors:
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+    def notify(self, key, version):
+        with self.lock:
+            waiters = self.waiters.get(key, [])
+            woken = [waiter for waiter in waiters if waiter[2] < version]
+            for waiter in woken:
+                waiters.remove(waiter)
+            if not waiters:
+                self.waiters.pop(key, None)
+        for loop, future, _ in woken:
+            try:
+                loop.call_soon_threadsafe(self.wake, future)
+            except RuntimeError:
+                # Цикл событий ожидающего уже закрыт
+                pass
+
+    def stats(self):
+        try:
+            hits, misses = self.client.mget(self.hits_key, self.misses_key)
+        except self.errors:
+            return {'backend': self.name, 'hits': None, 'misses': None, 'error': 'unavailable'}
+        return {'backend': self.name, 'hits': int(hits or 0), 'misses': int(misses or 0)}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_balance_cache() -> BaseBalanceCache:
+    """
+    Кэш процесса: Redis при заданном REDIS_URL, иначе кэш в памяти
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if settings.REDIS_URL:
+                    _cache = RedisBalanceCache(settings.REDIS_URL, settings.BALANCE_CACHE_TTL)
+                else:
+                    _cache = LocalBalanceCache(settings.LOCAL_BALANCE_CACHE_TTL)
+    return _cache
+
+
+async def run_cache(cache: BaseBalanceCache, method, *args):
+    """
+    Вызов метода кэша из асинхронного кода: обращение к Redis - в потоке,
+    чтобы не блокировать цикл событий, кэш в памяти - сразу
+    """
+    if cache.shared:
+        return await sync_to_async(method, thread_sensitive=False)(*args)
+    return method(*args)
@@ -0,0 +1,86 @@
+"""
+Сериализаторы горячих путей без построения полей на каждый запрос.
+
+ModelSerializer при каждом создании заново строит поля по модели. Здесь
+экземпляр сериализатора и его поля создаются один раз на процесс, а
+проверка и представление повторяют Serializer.to_internal_value и
+to_representation на готовых полях: тексты и коды ошибок те же. Данные,
+не являющиеся словарем, проверяет обычный сериализатор.
+"""
+from collections.abc import Mapping
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.utils.functional import cached_property
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import SkipField, get_error_detail
+from rest_framework.relations import PKOnlyObject
+from rest_framework.serializers import as_serializer_error
+
+
+class CompiledSerializer:
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+
+    @cached_property
+    def serializer(self):
+        return self.serializer_class()
+
+    @cached_property
+    def writable_fields(self):
+        return [
+            (field, getattr(self.serializer, f'validate_{field.field_name}', None))
+            for field in self.serializer._writable_fields
+        ]
+
+    @cached_property
+    def readable_fields(self):
+        return list(self.serializer._readable_fields)
+
+    def validate(self, data) -> dict:
+        """
+        Проверенные данные, как serializer.validated_data; при ошибке -
+        ValidationError с теми же ошибками, что у serializer.is_valid(raise_exception=True)
+        """
+        if not isinstance(data, Mapping):
+            serializer = self.serializer_class(data=data)
+            serializer.is_valid(raise_exception=True)
+            return serializer.validated_data
+
+        validated, errors = {}, {}
+        for field, validate_method in self.writable_fields:
+            try:
+                value = field.run_validation(field.get_value(data))
+                if validate_method is not None:
+                    value = validate_method(value)
+            except ValidationError as exc:
+                errors[field.field_name] = exc.detail
+            except DjangoValidationError as exc:
+                errors[field.field_name] = get_error_detail(exc)
+            except SkipField:
+                pass
+            else:
+                self.serializer.set_value(validated, field.source_attrs, value)
+        if errors:
+            raise ValidationError(errors)
+
+        try:
+            self.serializer.run_validators(validated)
+            validated = self.serializer.validate(validated)
+        except (ValidationError, DjangoValidationError) as exc:
+            raise ValidationError(as_serializer_error(exc))
+        return validated
+
+    def to_representation(self, instance) -> dict:
+        """
+        Представление объекта, как serializer.data
+        """
+        representation = {}
+        for field in self.readable_fields:
+            try:
+                attribute = field.get_attribute(instance)
+            except SkipField:
+                continue
+            check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+            representation[field.field_name] = None if check_for_none is None else field.to_representation(attribute)
+        return representation
@@ -0,0 +1,224 @@
+"""
+Телеметрия блокировок строк кошельков.
+
+Для каждой операции, которая блокирует строку кошелька, отдельно
+измеряются ожидание блокировки и работа под ней вместе с фиксацией
+(блокировка держится до конца COMMIT):
+- update_balance, ledger, shards - select_for_update в методах Wallet,
+  ожидание - время запроса блокировки;
+- batch - блокировка кошельков и суб-балансов пачки в apply_operations
+  (combiner, пачки, переводы), ожидание относится ко всем кошелькам пачки;
+- atomic - UPDATE движка atomic, который берет блокировку сам: ожидание
+  считает Postgres (clock_timestamp() от начала выполнения до изменения
+  строки), отказ при нехватке средств не учитывается.
+
+Кошельки, ожидание которых не меньше LOCK_WAIT_CONTENDED_MS, попадают в
+ограниченный набросок (Space-Saving) самых конкурентных кошельков по
+суммарному ожиданию. Значения - в памяти процесса, на /metrics вместе с
+метриками запросов; по всем процессам кластера горячие кошельки
+показывает команда hot_wallets.
+
+На /metrics кошелек обозначается ключом metric_key (HMAC от uuid на
+SECRET_KEY), а не uuid: по метрикам нельзя найти чужие кошельки. Ключ
+кошелька выводит hot_wallets.
+"""
+import bisect
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils.crypto import salted_hmac
+
+from wallets.metrics import histogram_lines
+from wallets.sharding import wallet_db
+
+# Границы корзин гистограмм ожидания и работы под блокировкой, секунды
+LOCK_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Сколько горячих кошельков отдается на /metrics
+EXPORTED_HOT_WALLETS = 10
+
+
+class SpaceSaving:
+    """
+    Набросок top-K по весу (алгоритм Space-Saving) на k счетчиков.
+
+    Ключ вне набора вытесняет ключ с наименьшим весом и наследует его вес
+    как погрешность: вес ключа завышен не больше чем на error, а любой
+    ключ с настоящим весом больше минимального в наброске в нем есть.
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self.lock = threading.Lock()
+        # ключ -> [вес, погрешность, число событий]
+        self.counters = {}
+
+    def add(self, key, weight: float):
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                if len(self.counters) < self.k:
+                    counter = self.counters[key] = [0.0, 0.0, 0]
+                else:
+                    evicted = min(self.counters, key=lambda other: self.counters[other][0])
+                    minimum = self.counters.pop(evicted)[0]
+                    counter = self.counters[key] = [minimum, minimum, 0]
+            counter[0] += weight
+            counter[2] += 1
+
+    def top(self, n: int = None) -> list:
+        """
+        [(ключ, вес, погрешность, число событий)] по убыванию веса
+        """
+        with self.lock:
+            items = [(key, *counter) for key, counter in self.counters.items()]
+        items.sort(key=lambda item: item[1], reverse=True)
+        return items[:n]
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+
+
+class LockTelemetry:
+    """
+    Гистограммы ожидания и работы под блокировкой по месту блокировки,
+    число ожиданий дольше LOCK_WAIT_CONTENDED_MS и набросок горячих кошельков
+    """
+
+    def __init__(self, buckets=LOCK_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # место -> [корзины ожидания..., +Inf, сумма ожидания, корзины работы..., +Inf, сумма работы, конкурентных]
+        self.sites = {}
+        self.hot_wallets = None
+
+    @property
+    def sketch(self) -> SpaceSaving:
+        if self.hot_wallets is None:
+            self.hot_wallets = SpaceSaving(settings.HOT_WALLETS_TRACKED)
+        return self.hot_wallets
+
+    def record(self, site: str, wallet_uuids, wait: float, execution: float):
+        size = len(self.buckets) + 2
+        contended = wait * 1000 >= settings.LOCK_WAIT_CONTENDED_MS
+        with self.lock:
+            series = self.sites.get(site)
+            if series is None:
+                series = self.sites[site] = ([0] * (size - 1) + [0.0]) * 2 + [0]
+            series[bisect.bisect_left(self.buckets, wait)] += 1
+            series[size - 1] += wait
+            series[size + bisect.bisect_left(self.buckets, execution)] += 1
+            series[2 * size - 1] += execution
+            series[2 * size] += contended
+        if contended:
+            for wallet_uuid in wallet_uuids:
+                self.sketch.add(str(wallet_uuid), wait)
+
+    def reset(self):
+        with self.lock:
+            self.sites.clear()
+        self.sketch.reset()
+
+    def export(self) -> str:
+        with self.lock:
+            sites = {site: list(series) for site, series in self.sites.items()}
+        size = len(self.buckets) + 2
+
+        lines = []
+        for name, description, offset in (
+            ('wallet_lock_wait_seconds', 'Ожидание блокировки строки кошелька', 0),
+            ('wallet_lock_execution_seconds', 'Работа под блокировкой строки кошелька с фиксацией', size),
+        ):
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} histogram']
+            for site, series in sorted(sites.items()):
+                lines += histogram_lines(
+                    name, f'site="{site}"', self.buckets,
+                    series[offset:offset + size - 1], series[offset + size - 1]
+                )
+
+        lines += [
+            '# HELP wallet_lock_contended_total Ожидания блокировки не короче LOCK_WAIT_CONTENDED_MS',
+            '# TYPE wallet_lock_contended_total counter',
+        ]
+        lines += [
+            f'wallet_lock_contended_total{{site="{site}"}} {series[2 * size]}' for site, series in sorted(sites.items())
+        ]
+
+        lines += [
+            '# HELP wallet_hot_wallet_lock_wait_seconds Суммарное ожидание блокировки самых конкурентных кошельков '
+            '(оценка сверху, погрешность - в wallet_hot_wallet_lock_wait_error_seconds)',
+            '# TYPE wallet_hot_wallet_lock_wait_seconds gauge',
+        ]
+        top = self.sketch.top(EXPORTED_HOT_WALLETS)
+        lines += [
+            f'wallet_hot_wallet_lock_wait_seconds{{wallet="{metric_key(key)}"}} {weight!r}' for key, weight, _, _ in top
+        ]
+        lines += [
+            '# HELP wallet_hot_wallet_lock_wait_error_seconds Погрешность оценки ожидания горячего кошелька',
+            '# TYPE wallet_hot_wallet_lock_wait_error_seconds gauge',
+        ]
+        lines += [
+            f'wallet_hot_wallet_lock_wait_error_seconds{{wallet="{metric_key(key)}"}} {error!r}'
+            for key, _, error, _ in top
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+telemetry = LockTelemetry()
+
+
+def metric_key(wallet_uuid) -> str:
+    """
+    Обозначение кошелька в метриках: постоянное, но не раскрывающее uuid
+    """
+    return salted_hmac('wallets.contention.metric_key', str(wallet_uuid)).hexdigest()[:16]
+
+
+class LockTimer:
+    """
+    Замер операции под блокировкой: с входа до acquired() - ожидание, от
+    acquired() до конца фиксации - работа. Замер открывается вне транзакции,
+    чтобы выход был после COMMIT; если транзакция внешняя и еще открыта,
+    работа считается до ее фиксации (on_commit), откат замер отбрасывает.
+    Без вызова acquired() (ошибка запроса блокировки) или после cancel()
+    ничего не записывается.
+
+        with LockTimer('update_balance', [wallet_uuid]) as timer, atomic():
+            wallet = Wallet.objects.select_for_update().get(pk=wallet_uuid)
+            timer.acquired()
+            ...
+    """
+
+    def __init__(self, site: str, wallet_uuids):
+        self.site = site
+        self.wallet_uuids = wallet_uuids
+        self.started = None
+        self.locked = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def acquired(self):
+        self.locked = time.perf_counter()
+
+    def cancel(self):
+        """
+        Операцию замеряет другое место блокировки
+        """
+        self.locked = None
+
+    def __exit__(self, *exc_info):
+        if self.locked is None:
+            return False
+        using = wallet_db()
+        if connections[using].in_atomic_block:
+            transaction.on_commit(self.record, using=using, robust=True)
+        else:
+            self.record()
+        return False
+
+    def record(self):
+        telemetry.record(self.site, self.wallet_uuids, self.locked - self.started, time.perf_counter() - self.locked)
@@ -0,0 +1,547 @@
+import threading
+import time
+from contextlib import nullcontext
+from datetime import timedelta
+from decimal import Decimal
+from uuid import uuid4
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, connections
+from django.db.models import Sum
+from django.http import Http404
+from rest_framework.exceptions import ValidationError
+
+from wallets import async_db
+from wallets.contention import LockTimer, telemetry
+from wallets.models import Wallet, WalletShard, Operation, IdempotencyKey
+from wallets.sharding import atomic, locate_many, use_shard, wallet_db
+
+
+def wallet_not_found():
+    """
+    Исключение 404 с тем же текстом, что и у get_object_or_404
+    """
+    return Http404(f'No {Wallet._meta.object_name} matches the given query.')
+
+
+class BaseEngine:
+    """
+    Базовый движок применения операций к кошельку.
+
+    Метод apply возвращает новый баланс, выбрасывает Http404 для
+    несуществующего кошелька и ValidationError при недостатке средств.
+    Ключ идемпотентности сохраняется в той же транзакции, что и операция;
+    конкурентный дубликат ключа приводит к IntegrityError.
+    """
+    name = None
+
+    def apply(self, wallet_uuid, operation_type: str, amount: Decimal, idempotency_key: str = None) -> Decimal:
+        raise NotImplementedError
+
+    async def aapply(self, wallet_uuid, operation_type: str, amount: Decimal, idempotency_key: str = None) -> Decimal:
+        """
+        Асинхронный apply; по умолчанию синхронный путь в потоке
+        """
+        return await sync_to_async(self.apply)(wallet_uuid, operation_type, amount, idempotency_key)
+
+
+class LockingEngine(BaseEngine):
+    """
+    Исходный путь: блокировка строки кошелька и Wallet.update_balance
+    """
+    name = 'locking'
+
+    def apply(self, wallet_uuid, operation_type, amount, idempotency_key=None):
+        wallet = Wallet.objects.filter(uuid=wallet_uuid).first()
+        if wallet is None:
+            raise wallet_not_found()
+        if wallet.shard_count or wallet.ledger_mode:
+            if wallet.shard_count:
+                balance = wallet.apply_to_shards(operation_type, amount, idempotency_key)
+            else:
+                balance = wallet.apply_to_ledger(operation_type, amount, idempotency_key)
+            if balance is None:
+                # Режим кошелька сменили во время операции
+                return self.apply(wallet_uuid, operation_type, amount, idempotency_key)
+            return balance
+        return wallet.update_balance(
+            operation_type=operation_type,
+            amount=amount,
+            idempotency_key=idempotency_key
+        )
+
+
+class AtomicEngine(BaseEngine):
+    """
+    Проверка баланса, изменение баланса и запись операции одним SQL-запросом.
+
+    UPDATE с условием balance + delta >= 0 сам берет блокировку строки
+    и перепроверяет условие после ожидания конкурирующей транзакции,
+    поэтому уйти в минус нельзя. Блокировка держится только до конца
+    этого запроса (autocommit), а не на время нескольких обращений к базе.
+    Пополнение кошелька с суб-балансами меняет одну свободную строку
+    суб-баланса тем же запросом, списание выполняет Wallet.apply_to_shards.
+    Пополнение кошелька в режиме журнала - только вставка несвернутой
+    операции, списание выполняет Wallet.apply_to_ledger.
+    Новое состояние записывается в кэш после фиксации. Время ожидания
+    блокировки строки запрос возвращает сам: от начала выполнения (started,
+    до поиска строки) до ее изменения (RETURNING).
+    """
+    name = 'atomic'
+
+    sql = """
+        WITH started AS MATERIALIZED (
+            SELECT clock_timestamp() AS at
+        ), existing AS (
+            SELECT uuid, balance, shard_count, ledger_mode FROM {wallet} WHERE uuid = %(uuid)s
+        ), updated AS (
+            UPDATE {wallet}
+            SET balance = balance + %(delta)s, version = version + 1
+            WHERE uuid = %(uuid)s AND shard_count = 0 AND NOT ledger_mode AND balance + %(delta)s >= 0
+                AND (SELECT at FROM started) IS NOT NULL
+            RETURNING uuid, balance, version, owner_id,
+                EXTRACT(EPOCH FROM clock_timestamp() - (SELECT at FROM started)) AS waited
+        ), free_shard AS (
+            SELECT id FROM {shard} WHERE wallet_id = %(uuid)s AND %(delta)s > 0
+            ORDER BY random() LIMIT 1 FOR UPDATE SKIP LOCKED
+        ), updated_shard AS (
+            UPDATE {shard} SET balance = balance + %(delta)s, version = version + 1
+            WHERE id = COALESCE(
+                (SELECT id FROM free_shard),
+                (SELECT id FROM {shard} WHERE wallet_id = %(uuid)s AND %(delta)s > 0 ORDER BY random() LIMIT 1)
+            )
+            RETURNING id, balance
+        ), appended AS (
+            SELECT balance + %(delta)s + COALESCE((
+                SELECT SUM(CASE WHEN operation_type = 'DEPOSIT' THEN amount ELSE -amount END)
+                FROM {operation} WHERE wallet_id = %(uuid)s AND NOT compacted
+            ), 0) AS balance
+            FROM existing WHERE ledger_mode AND %(delta)s > 0
+        ), created AS (
+            INSERT INTO {operation} (wallet_id, operation_type, amount, created_at, compacted)
+            SELECT %(uuid)s, %(operation_type)s, %(amount)s, now(), NOT EXISTS (SELECT 1 FROM appended)
+            FROM (
+                SELECT 1 FROM updated UNION ALL SELECT 1 FROM updated_shard UNION ALL SELECT 1 FROM appended
+            ) AS changed
+        ), result AS (
+            SELECT COALESCE(
+                (SELECT balance FROM updated),
+                (SELECT balance FROM updated_shard) + COALESCE((
+                    SELECT SUM(balance) FROM {shard}
+                    WHERE wallet_id = %(uuid)s AND id <> (SELECT id FROM updated_shard)
+                ), 0),
+                (SELECT balance FROM appended)
+            ) AS balance
+        ), keyed AS (
+            INSERT INTO {key} (wallet_id, key, operation_type, amount, balance, created_at, expires_at)
+            SELECT %(uuid)s, %(key)s, %(operation_type)s, %(amount)s, balance, now(), now() + %(ttl)s
+            FROM result WHERE balance IS NOT NULL AND %(key)s IS NOT NULL
+        )
+        SELECT
+            (SELECT balance FROM result), (SELECT shard_count FROM existing), (SELECT ledger_mode FROM existing),
+            (SELECT version FROM updated), (SELECT owner_id FROM updated), (SELECT waited FROM updated)
+    """
+
+    def query(self, wallet_uuid, operation_type, amount, idempotency_key):
+        delta = amount if operation_type == Operation.DEPOSIT else -amount
+        sql = self.sql.format(
+            wallet=Wallet._meta.db_table,
+            shard=WalletShard._meta.db_table,
+            operation=Operation._meta.db_table,
+            key=IdempotencyKey._meta.db_table
+        )
+        return sql, {
+            'uuid': wallet_uuid,
+            'delta': delta,
+            'operation_type': operation_type,
+            'amount': amount,
+            'key': idempotency_key,
+            'ttl': timedelta(hours=settings.IDEMPOTENCY_KEY_TTL_HOURS),
+        }
+
+    def apply(self, wallet_uuid, operation_type, amount, idempotency_key=None):
+        # Во внешней транзакции ошибка дубликата ключа не должна ее ломать
+        connection = connections[wallet_db()]
+        savepoint = atomic() if idempotency_key and connection.in_atomic_block else nullcontext()
+        started = time.perf_counter()
+        with savepoint, connection.cursor() as cursor:
+            cursor.execute(*self.query(wallet_uuid, operation_type, amount, idempotency_key))
+            balance, shard_count, ledger_mode, version, owner_id, waited = cursor.fetchone()
+
+        if shard_count is None:
+            raise wallet_not_found()
+        if version is not None:
+            self.record(wallet_uuid, started, waited)
+            Wallet.cache_state(wallet_uuid, {'version': version, 'balance': balance, 'owner': owner_id})
+            return balance
+        if balance is not None:
+            # Пополнение суб-баланса или журнала: баланс не учитывает
+            # незафиксированные операции других транзакций
+            Wallet.cache_state(wallet_uuid)
+            return balance
+
+        # Строка не обновилась: либо это списание с кошелька с суб-балансами
+        # или в режиме журнала, либо не хватает средств, либо режим
+        # кошелька сменили конкурентно
+        wallet = Wallet(uuid=wallet_uuid, shard_count=shard_count, ledger_mode=ledger_mode)
+        if not shard_count and not ledger_mode:
+            wallet = Wallet.objects.filter(uuid=wallet_uuid).first()
+            if wallet is None:
+                raise wallet_not_found()
+        if wallet.shard_count or wallet.ledger_mode:
+            if wallet.shard_count:
+                balance = wallet.apply_to_shards(operation_type, amount, idempotency_key)
+            else:
+                balance = wallet.apply_to_ledger(operation_type, amount, idempotency_key)
+            if balance is not None:
+                return balance
+            return self.apply(wallet_uuid, operation_type, amount, idempotency_key)
+        raise ValidationError('Недостаточно средств')
+
+    @staticmethod
+    def record(wallet_uuid, started, waited):
+        """
+        Ожидание блокировки строки - по часам Postgres, остальное время запроса - работа под блокировкой
+        """
+        waited = float(waited)
+        telemetry.record('atomic', [wallet_uuid], waited, max(time.perf_counter() - started - waited, 0))
+
+    async def aapply(self, wallet_uuid, operation_type, amount, idempotency_key=None):
+        """
+        Тот же запрос через асинхронный пул. Списания с суб-балансов и из
+        журнала требуют нескольких запросов в транзакции и выполняются
+        синхронным apply в потоке; до этого запрос ничего не записывает.
+        """
+        from psycopg import IntegrityError as DriverIntegrityError
+
+        started = time.perf_counter()
+        try:
+            row = await async_db.fetchone(
+                *self.query(wallet_uuid, operation_type, amount, idempotency_key), using=wallet_db()
+            )
+        except DriverIntegrityError as e:
+            raise IntegrityError(*e.args) from e
+        balance, shard_count, ledger_mode, version, owner_id, waited = row
+
+        if shard_count is None:
+            raise wallet_not_found()
+        if version is not None:
+            self.record(wallet_uuid, started, waited)
+            await Wallet.acache_state(wallet_uuid, {'version': version, 'balance': balance, 'owner': owner_id})
+            return balance
+        if balance is not None:
+            await Wallet.acache_state(wallet_uuid)
+            return balance
+
+        if not shard_count and not ledger_mode:
+            # Режим кошелька могли сменить, пока запрос ждал блокировку строки
+            row = await async_db.fetchone(
+                f'SELECT shard_count, ledger_mode FROM {Wallet._meta.db_table} WHERE uuid = %s', [wallet_uuid],
+                using=wallet_db()
+            )
+            if row is None:
+                raise wallet_not_found()
+            if not any(row):
+                raise ValidationError('Недостаточно средств')
+        return await super().aapply(wallet_uuid, operation_type, amount, idempotency_key)
+
+
+class PendingOperation:
+    """
+    Операция, ожидающая применения в общей пачке
+    """
+
+    def __init__(
+            self, operation_type: str, amount: Decimal, wallet_uuid=None, idempotency_key: str = None,
+            transfer_id=None):
+        self.wallet_uuid = wallet_uuid
+        self.operation_type = operation_type
+        self.amount = amount
+        self.idempotency_key = idempotency_key
+        self.transfer_id = transfer_id
+        self.balance = None
+        self.error = None
+        self.done = threading.Event()
+
+
+def apply_operations(batch, all_or_nothing: bool = False) -> bool:
+    """
+    Применение операций к нескольким кошелькам одной транзакцией.
+
+    Кошельки, а затем суб-балансы блокируются в порядке uuid (и номера
+    суб-баланса), поэтому пересекающиеся пачки не создают взаимных
+    блокировок. Операции проверяются по порядку; балансы записываются
+    одним UPDATE на таблицу (bulk_update), операции - одним bulk_create.
+    Результат каждой операции записывается в ее balance или error.
+    Операция с уже сохраненным ключом идемпотентности не применяется
+    повторно, а получает сохраненный баланс.
+    В режиме all_or_nothing при любой ошибке ничего не записывается
+    и возвращается False.
+    """
+    uuids = sorted({item.wallet_uuid for item in batch})
+    with LockTimer('batch', uuids) as timer, atomic():
+        # FOR NO KEY UPDATE не мешает вставке операций других транзакций
+        wallets = {
+            wallet.uuid: wallet
+            for wallet in Wallet.objects.select_for_update(no_key=True).filter(uuid__in=uuids).order_by('uuid')
+        }
+        shards = {}
+        sharded = [wallet.uuid for wallet in wallets.values() if wallet.shard_count]
+        if sharded:
+            for shard in WalletShard.objects.select_for_update().filter(
+                    wallet_id__in=sharded).order_by('wallet_id', 'index'):
+                shards.setdefault(shard.wallet_id, []).append(shard)
+        timer.acquired()
+
+        balances = {
+            uuid: sum(shard.balance for shard in shards[uuid]) if uuid in shards else wallet.balance
+            for uuid, wallet in wallets.items()
+        }
+        ledger = [wallet.uuid for wallet in wallets.values() if wallet.ledger_mode]
+        if ledger:
+            pending = Operation.objects.filter(wallet_id__in=ledger, compacted=False).values('wallet_id').annotate(
+                total=Sum(Operation.signed_amount())
+            )
+            for row in pending:
+                balances[row['wallet_id']] += row['total']
+        initial = dict(balances)
+
+        # Ключи кошелька почти всегда пишутся под блокировкой его строки или
+        # суб-балансов, поэтому здесь видны уже сохраненные ключи. Редкая гонка
+        # (пополнение в режиме журнала, смена режима) дает IntegrityError
+        keyed = [item for item in batch if item.idempotency_key and item.wallet_uuid in balances]
+        stored = {}
+        if keyed:
+            for key in IdempotencyKey.objects.filter(
+                    wallet_id__in={item.wallet_uuid for item in keyed},
+                    key__in={item.idempotency_key for item in keyed}):
+                stored[(key.wallet_id, key.key)] = key
+
+        operations, keys = [], []
+        for item in batch:
+            balance = balances.get(item.wallet_uuid)
+            if balance is None:
+                item.error = wallet_not_found()
+                continue
+            if item.idempotency_key:
+                previous = stored.get((item.wallet_uuid, item.idempotency_key))
+                if previous is not None:
+                    item.balance = previous.balance
+                    continue
+            if item.operation_type == Operation.WITHDRAW and balance < item.amount:
+                item.error = ValidationError('Недостаточно средств')
+                continue
+            item.balance = balances[item.wallet_uuid] = (
+                balance + item.amount if item.operation_type == Operation.DEPOSIT else balance - item.amount
+            )
+            operations.append(Operation(
+                wallet_id=item.wallet_uuid,
+                operation_type=item.operation_type,
+                amount=item.amount,
+                compacted=not wallets[item.wallet_uuid].ledger_mode,
+                transfer_id=item.transfer_id
+            ))
+            if item.idempotency_key:
+                stored[(item.wallet_uuid, item.idempotency_key)] = item
+                keys.append(IdempotencyKey(
+                    wallet_id=item.wallet_uuid,
+                    key=item.idempotency_key,
+                    operation_type=item.operation_type,
+                    amount=item.amount,
+                    balance=item.balance
+                ))
+
+        if all_or_nothing and any(item.error is not None for item in batch):
+            return False
+        if not operations:
+            return True
+
+        changed_wallets, changed_shards = [], []
+        applied = {operation.wallet_id for operation in operations}
+        for uuid, balance in balances.items():
+            delta = balance - initial[uuid]
+            if wallets[uuid].ledger_mode:
+                # Пополнения журнала идут без блокировки кошелька - состояние перечитывается
+                if uuid in applied:
+                    Wallet.cache_state(uuid)
+                continue
+            if not delta:
+                continue
+            if uuid not in shards:
+                wallets[uuid].balance = balance
+                wallets[uuid].version += 1
+                changed_wallets.append(wallets[uuid])
+            elif delta > 0:
+                shards[uuid][0].balance += delta
+                shards[uuid][0].version += 1
+                changed_shards.append(shards[uuid][0])
+            else:
+                # Списание по порядку суб-балансов, как в Wallet.apply_to_shards
+                for shard in shards[uuid]:
+                    taken = min(shard.balance, -delta)
+                    if taken:
+                        shard.balance -= taken
+                        shard.version += 1
+                        delta += taken
+                        changed_shards.append(shard)
+                    if not delta:
+                        break
+            # Кошелек и все его суб-балансы заблокированы - состояние согласовано
+            Wallet.cache_state(uuid, {
+                'version': wallets[uuid].version + sum(shard.version for shard in shards.get(uuid, [])),
+                'balance': balance,
+                'owner': wallets[uuid].owner_id,
+            })
+
+        if changed_wallets:
+            Wallet.objects.bulk_update(changed_wallets, ['balance', 'version'])
+        if changed_shards:
+            WalletShard.objects.bulk_update(changed_shards, ['balance', 'version'])
+        Operation.objects.bulk_create(operations)
+        if keys:
+            IdempotencyKey.objects.bulk_create(keys)
+    return True
+
+
+def apply_on_shards(batch, all_or_nothing: bool = False) -> bool:
+    """
+    apply_operations для кошельков из разных шардов: пачка делится по
+    шардам, каждая часть - транзакция своего шарда. Пачку all_or_nothing
+    по нескольким шардам одной транзакцией не применить - ValidationError.
+    """
+    locations = locate_many(item.wallet_uuid for item in batch)
+    parts = {}
+    for item in batch:
+        parts.setdefault(locations[str(item.wallet_uuid)], []).append(item)
+    if all_or_nothing and len(parts) > 1:
+        raise ValidationError('Пачка all_or_nothing должна относиться к кошелькам одного шарда')
+    applied = True
+    for alias, part in parts.items():
+        with use_shard(alias):
+            applied = apply_operations(part, all_or_nothing) and applied
+    return applied
+
+
+def transfer(source_uuid, destination_uuid, amount: Decimal) -> PendingOperation:
+    """
+    Перевод между кошельками одной транзакцией: списание и пополнение с
+    общим transfer_id применяются как пачка all_or_nothing, поэтому оба
+    кошелька блокируются в порядке uuid и встречные переводы не создают
+    взаимных блокировок. Возвращает списание (баланс источника в balance),
+    при ошибке (Http404, ValidationError) ничего не записывается.
+
+    Кошельки из разных шардов: списание и пополнение - транзакции своих
+    шардов, при ошибке пополнения списанное возвращается источнику
+    пополнением с тем же transfer_id. Если процесс прервется между ними,
+    списание перевода останется без пары - его находит поиск по transfer_id.
+    """
+    transfer_id = uuid4()
+    withdraw = PendingOperation(Operation.WITHDRAW, amount, source_uuid, transfer_id=transfer_id)
+    deposit = PendingOperation(Operation.DEPOSIT, amount, destination_uuid, transfer_id=transfer_id)
+    locations = locate_many([source_uuid, destination_uuid])
+    source, destination = locations[str(source_uuid)], locations[str(destination_uuid)]
+    if source == destination:
+        with use_shard(source):
+            if not apply_operations([withdraw, deposit], all_or_nothing=True):
+                raise withdraw.error or deposit.error
+        return withdraw
+
+    with use_shard(destination):
+        if not Wallet.objects.filter(uuid=destination_uuid).exists():
+            raise wallet_not_found()
+    with use_shard(source):
+        if not apply_operations([withdraw], all_or_nothing=True):
+            raise withdraw.error
+    try:
+        with use_shard(destination):
+            if not apply_operations([deposit], all_or_nothing=True):
+                raise deposit.error
+    except Exception:
+        refund = PendingOperation(Operation.DEPOSIT, amount, source_uuid, transfer_id=transfer_id)
+        with use_shard(source):
+            apply_operations([refund])
+        raise
+    return withdraw
+
+
+class CombinerEngine(BaseEngine):
+    """
+    Групповая фиксация операций одного кошелька.
+
+    Первый запрос к кошельку становится ведущим: ждет
+    WALLET_COMBINER_WINDOW_MS, забирает накопившиеся за это время операции
+    и применяет их по порядку одной транзакцией - один UPDATE баланса и один
+    bulk_create операций. Каждый запрос получает свой баланс после своей
+    операции или свой отказ «Недостаточно средств».
+
+    Очередь общая только внутри процесса. Пачки разных процессов
+    сериализуются на блокировке строки кошелька, поэтому число передач
+    блокировки уменьшается в размер пачки и между процессами.
+    """
+    name = 'combiner'
+
+    _lock = threading.Lock()
+    _queues = {}
+
+    def apply(self, wallet_uuid, operation_type, amount, idempotency_key=None):
+        pending = PendingOperation(operation_type, amount, idempotency_key=idempotency_key)
+
+        # Внутри чужой транзакции объединять нельзя: ее откат отменил бы
+        # операции других запросов, которым уже ответили успехом
+        if connections[wallet_db()].in_atomic_block:
+            self.apply_batch(wallet_uuid, [pending])
+            return self.result(pending)
+
+        with self._lock:
+            queue = self._queues.get(wallet_uuid)
+            leader = queue is None
+            if leader:
+                queue = self._queues[wallet_uuid] = []
+            queue.append(pending)
+
+        if not leader:
+            pending.done.wait()
+            return self.result(pending)
+
+        time.sleep(settings.WALLET_COMBINER_WINDOW_MS / 1000)
+        with self._lock:
+            batch = self._queues.pop(wallet_uuid)
+        try:
+            self.apply_batch(wallet_uuid, batch)
+        except Exception as e:
+            for item in batch:
+                item.error = item.error or e
+        finally:
+            for item in batch:
+                item.done.set()
+        return self.result(pending)
+
+    @staticmethod
+    def result(pending):
+        if pending.error is not None:
+            raise pending.error
+        return pending.balance
+
+    @staticmethod
+    def apply_batch(wallet_uuid, batch):
+        """
+        Применение пачки операций к кошельку одной транзакцией
+        """
+        for item in batch:
+            item.wallet_uuid = wallet_uuid
+        apply_operations(batch)
+
+
+ENGINES = {
+    LockingEngine.name: LockingEngine,
+    AtomicEngine.name: AtomicEngine,
+    CombinerEngine.name: CombinerEngine,
+}
+
+
+def get_engine(name: str = None) -> BaseEngine:
+    """
+    Движок по имени, по умолчанию из настройки WALLET_OPERATION_ENGINE
+    """
+    return ENGINES[name or settings.WALLET_OPERATION_ENGINE]()
@@ -0,0 +1,155 @@
+"""
+Потоковые выгрузка и загрузка журнала через COPY.
+
+Данные не проходят через ORM: строки идут потоком между файлом и базой
+(copy_expert читает и пишет файл блоками), при загрузке поток режется на
+порции по числу строк, каждая порция - самостоятельный ввод COPY и
+отдельная транзакция. Поддерживаются форматы csv (с заголовком) и binary;
+файлы с расширением .gz сжимаются и распаковываются на лету.
+"""
+import gzip
+import struct
+import time
+
+# Формат -> расширение файла и параметры COPY
+FORMATS = {
+    'csv': ('csv', 'FORMAT csv, HEADER'),
+    'binary': ('bin', 'FORMAT binary'),
+}
+
+BINARY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+BINARY_TRAILER = b'\xff\xff'
+
+# Размер блока при передаче файла в COPY FROM STDIN
+BLOCK_SIZE = 2 ** 16
+
+
+def copy_to(cursor, sql: str, file):
+    """
+    COPY ... TO STDOUT в файл. Django работает с psycopg 3, если он
+    установлен, иначе с psycopg2 - у них разный интерфейс COPY.
+    """
+    if hasattr(cursor, 'copy_expert'):
+        cursor.copy_expert(sql, file)
+        return
+    with cursor.copy(sql) as copy:
+        for data in copy:
+            file.write(data)
+
+
+def copy_from(cursor, sql: str, file):
+    """
+    COPY ... FROM STDIN из файла
+    """
+    if hasattr(cursor, 'copy_expert'):
+        cursor.copy_expert(sql, file, BLOCK_SIZE)
+        return
+    with cursor.copy(sql) as copy:
+        while data := file.read(BLOCK_SIZE):
+            copy.write(data)
+
+
+def open_file(path: str, mode: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class ProgressFile:
+    """
+    Обертка файла: считает переданные байты и не чаще раза в interval
+    секунд вызывает report(байты, секунды)
+    """
+
+    def __init__(self, file, report, interval: float = 5):
+        self.file = file
+        self.report = report
+        self.interval = interval
+        self.bytes = 0
+        self.started = self.reported = time.monotonic()
+
+    def write(self, data):
+        self.count(len(data))
+        return self.file.write(data)
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.count(len(data))
+        return data
+
+    def readline(self, size=-1):
+        data = self.file.readline(size)
+        self.count(len(data))
+        return data
+
+    def count(self, size):
+        self.bytes += size
+        now = time.monotonic()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.report(self.bytes, now - self.started)
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+
+def iter_chunks(file, copy_format: str, rows: int):
+    """
+    Порции ввода COPY не более чем по rows строк: (данные, число строк).
+    Каждая порция - полноценный ввод: с заголовком CSV или с сигнатурой
+    и завершающим маркером двоичного формата.
+    """
+    if copy_format == 'csv':
+        yield from iter_csv_chunks(file, rows)
+    else:
+        yield from iter_binary_chunks(file, rows)
+
+
+def iter_csv_chunks(file, rows):
+    # Значения журнала (uuid, числа, даты, тип операции) не содержат
+    # переводов строк, поэтому одна строка файла - одна запись
+    header = file.readline()
+    lines = []
+    for line in iter(file.readline, b''):
+        lines.append(line)
+        if len(lines) == rows:
+            yield header + b''.join(lines), len(lines)
+            lines = []
+    if lines:
+        yield header + b''.join(lines), len(lines)
+
+
+def iter_binary_chunks(file, rows):
+    header = read_exact(file, len(BINARY_SIGNATURE) + 8)
+    if not header.startswith(BINARY_SIGNATURE):
+        raise ValueError('Файл не в двоичном формате COPY')
+    extension_length = struct.unpack('!I', header[-4:])[0]
+    header = BINARY_SIGNATURE + header[len(BINARY_SIGNATURE):-4] + struct.pack('!I', 0)
+    read_exact(file, extension_length)
+
+    tuples = []
+    while True:
+        field_count = struct.unpack('!h', read_exact(file, 2))[0]
+        if field_count == -1:
+            break
+        parts = [struct.pack('!h', field_count)]
+        for _ in range(field_count):
+            length_bytes = read_exact(file, 4)
+            length = struct.unpack('!i', length_bytes)[0]
+            parts.append(length_bytes)
+            if length > 0:
+                parts.append(read_exact(file, length))
+        tuples.append(b''.join(parts))
+        if len(tuples) == rows:
+            yield header + b''.join(tuples) + BINARY_TRAILER, len(tuples)
+            tuples = []
+    if tuples:
+        yield header + b''.join(tuples) + BINARY_TRAILER, len(tuples)
+
+
+def read_exact(file, size: int) -> bytes:
+    data = file.read(size)
+    if len(data) != size:
+        raise ValueError('Файл COPY обрезан')
+    return data
@@ -0,0 +1,77 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta, timezone
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Max, Min
+
+from wallets.models import Operation
+from wallets.statements import rebuild
+
+
+class Command(BaseCommand):
+    """
+    Пересчет дневных итогов кошельков из операций
+    """
+    help = (
+        'Пересчитывает дневные итоги кошельков из таблицы операций порциями по несколько дней, порции '
+        'выполняются параллельно, каждая - отдельная транзакция. По умолчанию - все дни, за которые в базе есть '
+        'операции: итоги архивированных разделов сохраняются. Шарды пересчитываются по очереди'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=date.fromisoformat, help='Первый день (YYYY-MM-DD, UTC)')
+        parser.add_argument('--until', type=date.fromisoformat, help='День после последнего (YYYY-MM-DD, UTC)')
+        parser.add_argument('--chunk-days', type=int, default=7, help='Дней в одной порции')
+        parser.add_argument('--workers', type=int, default=4, help='Параллельных порций')
+
+    def handle(self, *args, **options):
+        if options['chunk_days'] < 1 or options['workers'] < 1:
+            raise CommandError('--chunk-days и --workers должны быть положительными')
+        for alias in settings.WALLET_SHARDS:
+            self.backfill(alias, options)
+
+    def backfill(self, alias, options):
+        prefix = f'{alias}: ' if len(settings.WALLET_SHARDS) > 1 else ''
+        since, until = options['since'], options['until']
+        if since is None or until is None:
+            bounds = Operation.objects.using(alias).aggregate(first=Min('created_at'), last=Max('created_at'))
+            if bounds['first'] is None:
+                self.stdout.write(f'{prefix}Операций нет')
+                return
+            since = since or self.utc_day(bounds['first'])
+            until = until or self.utc_day(bounds['last']) + timedelta(days=1)
+        if since >= until:
+            raise CommandError('Пустой интервал дней')
+
+        chunks = []
+        day = since
+        while day < until:
+            chunks.append((day, min(day + timedelta(days=options['chunk_days']), until)))
+            day = chunks[-1][1]
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            rebuilt = executor.map(lambda chunk: self.rebuild_chunk(alias, chunk), chunks)
+            for (day_from, day_to), rows in zip(chunks, rebuilt):
+                self.stdout.write(f'{prefix}{day_from} - {day_to - timedelta(days=1)}: {rows} строк итогов')
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}Пересчитано дней: {(until - since).days}, порций: {len(chunks)} '
+            f'за {time.monotonic() - started:.1f} с'
+        ))
+
+    @staticmethod
+    def rebuild_chunk(alias, chunk):
+        # У каждого потока свое соединение
+        connection = connections[alias]
+        try:
+            with transaction.atomic(using=alias), connection.cursor() as cursor:
+                return rebuild(cursor, *chunk)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def utc_day(moment) -> date:
+        return moment.astimezone(timezone.utc).date()
@@ -0,0 +1,93 @@
+import statistics
+import time
+import uuid
+
+from django.core.management import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from rest_framework.test import APIClient
+
+from users.models import User
+from wallets.models import Wallet, Operation
+from wallets.pagination import KeysetPagination
+
+
+class Command(BaseCommand):
+    """
+    Нагрузочный тест истории операций: время страницы в зависимости от ее номера
+    """
+    help = 'Сравнивает время страницы истории по ключу и через OFFSET на кошельке с большим числом операций'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--operations', type=int, default=1000000, help='Число операций кошелька')
+        parser.add_argument('--limit', type=int, default=50, help='Размер страницы')
+        parser.add_argument(
+            '--page', type=int, action='append',
+            help='Номер страницы (можно указать несколько раз), по умолчанию 1, 10, 100, 1000, 10000'
+        )
+        parser.add_argument('--repeat', type=int, default=20, help='Повторов на каждую страницу')
+        parser.add_argument('--keep', action='store_true', help='Не удалять тестовый кошелек')
+
+    def handle(self, *args, **options):
+        owner = User.objects.create(email=f'bench-{uuid.uuid4().hex}@example.com')
+        wallet = Wallet.objects.create(owner=owner)
+        try:
+            self.fill(wallet, options['operations'])
+            client = APIClient(SERVER_NAME='localhost')
+            client.force_authenticate(user=owner)
+            url = f'/api/v1/wallets/{wallet.uuid}/operations/'
+
+            limit = options['limit']
+            for page in options['page'] or [1, 10, 100, 1000, 10000]:
+                offset = (page - 1) * limit
+                if offset >= options['operations']:
+                    continue
+                history = Operation.objects.filter(wallet=wallet).order_by('-created_at', '-id').only(
+                    'id', 'operation_type', 'amount', 'created_at'
+                )
+                params, after = {'limit': limit}, history
+                if offset:
+                    last = history[offset - 1]
+                    params['cursor'] = KeysetPagination.encode_cursor(last.created_at, last.pk)
+                    after = history.filter(
+                        Q(created_at__lte=last.created_at) & (Q(created_at__lt=last.created_at) | Q(id__lt=last.pk))
+                    )
+
+                by_key = self.measure(lambda: list(after[:limit]), options['repeat'])
+                by_offset = self.measure(lambda: list(history[offset:offset + limit]), options['repeat'])
+                http = self.measure(lambda: client.get(url, params), options['repeat'])
+                self.stdout.write(
+                    f'страница {page:>6}: запрос по ключу {by_key * 1000:8.2f} ms, '
+                    f'запрос с OFFSET {by_offset * 1000:8.2f} ms, HTTP по ключу {http * 1000:8.2f} ms'
+                )
+        finally:
+            if not options['keep']:
+                owner.delete()
+
+    def fill(self, wallet, operations):
+        """
+        Операции вставляются одним запросом, по одной в секунду назад от текущего времени
+        """
+        self.stdout.write(f'Вставка {operations} операций...')
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {Operation._meta.db_table} (wallet_id, operation_type, amount, created_at, compacted)
+                SELECT %s, CASE WHEN i %% 2 = 0 THEN 'DEPOSIT' ELSE 'WITHDRAW' END, 1.00,
+                    now() - i * interval '1 second', true
+                FROM generate_series(1, %s) AS i
+                """,
+                [wallet.uuid, operations]
+            )
+            # Карта видимости для чтения только из индекса
+            cursor.execute(f'VACUUM ANALYZE {Operation._meta.db_table}')
+
+    @staticmethod
+    def measure(fetch, repeat):
+        fetch()
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fetch()
+            timings.append(time.perf_counter() - started)
+        return statistics.median(timings)
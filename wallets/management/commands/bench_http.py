@@ -0,0 +1,123 @@
+import asyncio
+import json
+import statistics
+import time
+import uuid
+from decimal import Decimal
+from urllib.parse import urlsplit
+
+from django.core.management import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.models import User
+from wallets.models import Wallet
+
+
+class Command(BaseCommand):
+    """
+    Нагрузочный тест HTTP-эндпоинтов баланса и операций запущенного сервера
+    """
+    help = (
+        'Отправляет запросы к запущенному серверу с заданным числом одновременных соединений и измеряет '
+        'запросы/сек и задержки. Для сравнения запустите один и тот же прогон против WSGI-сервера и против '
+        'ASGI-сервера с WALLET_ASYNC_VIEWS=true'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Адрес сервера')
+        parser.add_argument(
+            '--endpoint', choices=['balance', 'operation'], action='append',
+            help='Эндпоинт (можно указать несколько раз), по умолчанию оба'
+        )
+        parser.add_argument('--concurrency', type=int, action='append', help='Одновременных запросов, по умолчанию 100')
+        parser.add_argument('--requests', type=int, default=5000, help='Число запросов на один прогон')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        if url.scheme != 'http':
+            raise CommandError('Поддерживается только http')
+        owner = User.objects.create(email=f'bench-{uuid.uuid4().hex}@example.com')
+        wallet = Wallet.objects.create(owner=owner, balance=Decimal('1000000.00'))
+        token = str(AccessToken.for_user(owner))
+        try:
+            for endpoint in options['endpoint'] or ['balance', 'operation']:
+                for concurrency in options['concurrency'] or [100]:
+                    elapsed, latencies, errors = asyncio.run(
+                        self.run(url, endpoint, wallet.uuid, token, concurrency, options['requests'])
+                    )
+                    self.report(endpoint, concurrency, elapsed, latencies, errors)
+        finally:
+            owner.delete()
+
+    def report(self, endpoint, concurrency, elapsed, latencies, errors):
+        if not latencies:
+            raise CommandError(f'{endpoint}: ни одного успешного ответа, ошибки: {errors}')
+        latencies.sort()
+        self.stdout.write(
+            f'{endpoint:>9}, соединений {concurrency:>5}: {len(latencies) / elapsed:9.1f} req/sec, '
+            f'p50 {statistics.median(latencies) * 1000:.1f} ms, '
+            f'p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} ms, '
+            f'ошибок {sum(errors.values())} {dict(errors) if errors else ""}'
+        )
+
+    async def run(self, url, endpoint, wallet_uuid, token, concurrency, total):
+        """
+        concurrency соединений keep-alive, каждое шлет запросы один за другим,
+        пока не отправлено total запросов
+        """
+        if endpoint == 'balance':
+            method, path, body = 'GET', f'/api/v1/wallets/{wallet_uuid}/', b''
+        else:
+            method, path = 'POST', f'/api/v1/wallets/{wallet_uuid}/operation/'
+            body = json.dumps({'operation_type': 'DEPOSIT', 'amount': '1.00'}).encode()
+        request = (
+            f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nAuthorization: Bearer {token}\r\n'
+            f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'
+        ).encode() + body
+
+        latencies, errors = [], {}
+        remaining = [total]
+
+        async def worker():
+            reader = writer = None
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                started = time.monotonic()
+                try:
+                    if writer is None:
+                        reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+                    writer.write(request)
+                    status_code, keep_alive = await self.read_response(reader)
+                except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                    writer = self.close(writer)
+                    continue
+                if status_code == 200:
+                    latencies.append(time.monotonic() - started)
+                else:
+                    errors[status_code] = errors.get(status_code, 0) + 1
+                if not keep_alive:
+                    writer = self.close(writer)
+            self.close(writer)
+
+        started = time.monotonic()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        return time.monotonic() - started, latencies, errors
+
+    @staticmethod
+    async def read_response(reader):
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin1').split('\r\n')
+        status_code = int(lines[0].split()[1])
+        headers = dict(line.split(': ', 1) for line in lines[1:] if ': ' in line)
+        headers = {name.lower(): value for name, value in headers.items()}
+        if 'content-length' not in headers:
+            raise ValueError('Ответ без Content-Length')
+        await reader.readexactly(int(headers['content-length']))
+        return status_code, headers.get('connection', '').lower() != 'close'
+
+    @staticmethod
+    def close(writer):
+        if writer is not None:
+            writer.close()
+        return None
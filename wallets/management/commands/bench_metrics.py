@@ -0,0 +1,69 @@
+import statistics
+import time
+import uuid
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.models import User
+from wallets.models import Wallet
+
+MIDDLEWARE = 'wallets.metrics.RequestMetricsMiddleware'
+
+
+class Command(BaseCommand):
+    """
+    Нагрузочный тест накладных расходов метрик запросов
+    """
+    help = (
+        'Сравнивает время запроса баланса (из кэша) и операции с RequestMetricsMiddleware и без него. '
+        'Замеры чередуются сериями, результат - медиана времени запроса'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Запросов в серии')
+        parser.add_argument('--rounds', type=int, default=5, help='Серий на каждый вариант')
+
+    def handle(self, *args, **options):
+        owner = User.objects.create(email=f'bench-{uuid.uuid4().hex}@example.com')
+        try:
+            wallet = Wallet.objects.create(owner=owner, balance=Decimal('1000000.00'))
+            headers = {'Authorization': f'Bearer {AccessToken.for_user(owner)}'}
+            retrieve_url = reverse('wallets:wallet_retrieve', args=[wallet.uuid])
+            operation_url = reverse('wallets:wallet_operation', args=[wallet.uuid])
+            without = [name for name in settings.MIDDLEWARE if name != MIDDLEWARE]
+
+            for name, request in (
+                ('баланс из кэша', lambda client: client.get(retrieve_url, headers=headers)),
+                ('пополнение', lambda client: client.post(
+                    operation_url, {'operation_type': 'DEPOSIT', 'amount': '1.00'}, headers=headers
+                )),
+            ):
+                timings = {True: [], False: []}
+                for _ in range(options['rounds']):
+                    for enabled in (False, True):
+                        with override_settings(MIDDLEWARE=[MIDDLEWARE] + without if enabled else without):
+                            client = APIClient(SERVER_NAME='localhost')
+                            timings[enabled] += self.measure(lambda: request(client), options['requests'])
+                base, instrumented = statistics.median(timings[False]), statistics.median(timings[True])
+                self.stdout.write(
+                    f'{name:<16} без метрик {base * 1e6:8.1f} мкс, с метриками {instrumented * 1e6:8.1f} мкс, '
+                    f'накладные расходы {(instrumented / base - 1) * 100:+.1f}%'
+                )
+        finally:
+            owner.delete()
+
+    @staticmethod
+    def measure(call, requests):
+        call()
+        timings = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - started)
+        return timings
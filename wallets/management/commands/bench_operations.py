@@ -0,0 +1,98 @@
+import statistics
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from django.core.management import BaseCommand
+from django.db import connection
+
+from users.models import User
+from wallets.engines import ENGINES, get_engine
+from wallets.models import Wallet, Operation
+
+
+class Command(BaseCommand):
+    """
+    Нагрузочный тест операций на одном «горячем» кошельке
+    """
+    help = 'Измеряет ops/sec и задержки операций на одном кошельке для выбранных движков'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--engine', action='append', choices=sorted(ENGINES),
+            help='Движок операций (можно указать несколько раз), по умолчанию все'
+        )
+        parser.add_argument('--threads', type=int, default=8, help='Число параллельных потоков')
+        parser.add_argument('--ops', type=int, default=2000, help='Число операций на один прогон')
+        parser.add_argument(
+            '--shards', type=int, action='append',
+            help='Число суб-балансов кошелька (можно указать несколько раз), по умолчанию 0'
+        )
+        parser.add_argument('--ledger', action='store_true', help='Кошелек в режиме журнала')
+        parser.add_argument(
+            '--deposits-only', action='store_true',
+            help='Только пополнения (списание блокирует все суб-балансы)'
+        )
+
+    def handle(self, *args, **options):
+        for name in options['engine'] or sorted(ENGINES):
+            for shard_count in options['shards'] or [0]:
+                wallet = self.create_wallet(shard_count, options['ledger'])
+                try:
+                    elapsed, latencies = self.run(
+                        name, wallet, options['threads'], options['ops'], options['deposits_only']
+                    )
+                finally:
+                    wallet.owner.delete()
+                self.report(name, shard_count, options['threads'], elapsed, latencies)
+
+    def report(self, name, shard_count, threads, elapsed, latencies):
+        latencies.sort()
+        self.stdout.write(
+            f'{name:>10}, суб-балансов {shard_count:>3}: {len(latencies) / elapsed:10.1f} ops/sec, '
+            f'p50 {statistics.median(latencies) * 1000:.2f} ms, '
+            f'p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms '
+            f'({threads} потоков, {len(latencies)} операций)'
+        )
+
+    @staticmethod
+    def create_wallet(shard_count, ledger_mode=False):
+        owner = User.objects.create(email=f'bench-{uuid.uuid4().hex}@example.com')
+        wallet = Wallet.objects.create(owner=owner, balance=Decimal('1000000.00'))
+        if shard_count:
+            wallet.set_shard_count(shard_count)
+        if ledger_mode:
+            wallet.set_ledger_mode(True)
+        return wallet
+
+    @staticmethod
+    def run(name, wallet, threads, ops, deposits_only=False):
+        """
+        Выполняет ops операций в threads потоках, чередуя пополнение и списание
+        """
+        latencies = []
+        lock = threading.Lock()
+        per_thread = ops // threads
+
+        def worker():
+            engine = get_engine(name)
+            local = []
+            try:
+                for i in range(per_thread):
+                    operation_type = Operation.DEPOSIT if deposits_only or i % 2 == 0 else Operation.WITHDRAW
+                    started = time.perf_counter()
+                    engine.apply(wallet.uuid, operation_type, Decimal('1.00'))
+                    local.append(time.perf_counter() - started)
+            finally:
+                connection.close()
+            with lock:
+                latencies.extend(local)
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return time.perf_counter() - started, latencies
@@ -0,0 +1,106 @@
+import time
+import uuid
+from decimal import Decimal
+from io import BytesIO
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.test import override_settings
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from users.models import User
+from wallets.models import Wallet
+from wallets.renderers import ORJSONParser, ORJSONRenderer
+from wallets.serializers import OperationSerializer, WalletSerializer, compiled_operation, compiled_wallet
+from wallets.views import WalletRetrieveView
+
+
+class Command(BaseCommand):
+    """
+    Микробенчмарк процессорного времени горячих путей запроса
+    """
+    help = (
+        'Сравнивает процессорное время на вызов: проверка операции и представление кошелька сериализатором и '
+        'скомпилированным сериализатором, рендер и разбор JSON стандартными классами DRF и на orjson, запрос '
+        'баланса целиком с FAST_JSON и без'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000, help='Вызовов на каждый замер')
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        payload = {'operation_type': 'DEPOSIT', 'amount': '1000.00'}
+        body = b'{"operation_type": "DEPOSIT", "amount": "1000.00"}'
+        wallet = Wallet(uuid=uuid.uuid4(), balance=Decimal('1000.00'))
+        data = compiled_wallet.to_representation(wallet)
+
+        def validate_serializer():
+            serializer = OperationSerializer(data=payload)
+            serializer.is_valid(raise_exception=True)
+            return serializer.validated_data
+
+        self.compare(
+            'проверка операции', iterations,
+            validate_serializer, lambda: compiled_operation.validate(payload)
+        )
+        self.compare(
+            'представление кошелька', iterations,
+            lambda: WalletSerializer(wallet).data, lambda: compiled_wallet.to_representation(wallet)
+        )
+        self.compare(
+            'рендер JSON', iterations,
+            lambda: JSONRenderer().render(data), lambda: ORJSONRenderer().render(data)
+        )
+        self.compare(
+            'разбор JSON', iterations,
+            lambda: JSONParser().parse(BytesIO(body)), lambda: ORJSONParser().parse(BytesIO(body))
+        )
+
+        owner = User.objects.create(email=f'bench-{uuid.uuid4().hex}@example.com')
+        try:
+            wallet = Wallet.objects.create(owner=owner, balance=Decimal('1000.00'))
+            factory = APIRequestFactory(SERVER_NAME='localhost')
+            view = WalletRetrieveView.as_view()
+
+            def retrieve():
+                request = factory.get(f'/api/v1/wallets/{wallet.uuid}/')
+                force_authenticate(request, user=owner)
+                response = view(request, wallet_uuid=wallet.uuid)
+                response.render()
+                return response
+
+            standard = self.measure(retrieve, iterations // 10)
+            with override_settings(REST_FRAMEWORK={
+                **settings.REST_FRAMEWORK,
+                'DEFAULT_RENDERER_CLASSES': ('wallets.renderers.ORJSONRenderer',),
+                'DEFAULT_PARSER_CLASSES': ('wallets.renderers.ORJSONParser',),
+            }):
+                fast = self.measure(retrieve, iterations // 10)
+            self.report('запрос баланса (FAST_JSON)', standard, fast)
+        finally:
+            owner.delete()
+
+    def compare(self, name, iterations, before, after):
+        if before() != after():
+            self.stderr.write(f'{name}: результаты различаются')
+        self.report(name, self.measure(before, iterations), self.measure(after, iterations))
+
+    def report(self, name, before, after):
+        self.stdout.write(
+            f'{name:<28} до {before * 1e6:8.1f} мкс, после {after * 1e6:8.1f} мкс, '
+            f'ускорение x{before / after:.2f}'
+        )
+
+    @staticmethod
+    def measure(call, iterations):
+        """
+        Процессорное время процесса на один вызов
+        """
+        call()
+        started = time.process_time()
+        for _ in range(iterations):
+            call()
+        return (time.process_time() - started) / max(iterations, 1)
@@ -0,0 +1,63 @@
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import connections
+
+from wallets.models import Wallet
+from wallets.sharding import use_shard
+
+
+class Command(BaseCommand):
+    """
+    Фоновая свертка операций кошельков в режиме журнала в снимки балансов
+    """
+    help = 'Сворачивает несвернутые операции в balance кошельков порциями, во всех шардах'
+
+    # Ключ advisory-блокировки: в каждом шарде одновременно работает только одна свертка
+    lock_key = 0x77616c6c6574
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help='Операций за одну транзакцию')
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='Повторять свертку с этим интервалом, секунды (0 - один проход)'
+        )
+
+    def handle(self, *args, **options):
+        locked = []
+        try:
+            for alias in settings.WALLET_SHARDS:
+                with connections[alias].cursor() as cursor:
+                    cursor.execute('SELECT pg_try_advisory_lock(%s)', [self.lock_key])
+                    if not cursor.fetchone()[0]:
+                        self.stderr.write('Свертка уже выполняется другим процессом')
+                        return
+                locked.append(alias)
+            while True:
+                for alias in locked:
+                    with use_shard(alias):
+                        compacted = self.compact(options['batch_size'])
+                    if compacted:
+                        self.stdout.write(f'Свернуто операций: {compacted}' + self.shard_suffix(alias))
+                if not options['interval']:
+                    break
+                time.sleep(options['interval'])
+        finally:
+            for alias in locked:
+                with connections[alias].cursor() as cursor:
+                    cursor.execute('SELECT pg_advisory_unlock(%s)', [self.lock_key])
+
+    @staticmethod
+    def shard_suffix(alias):
+        return f' ({alias})' if len(settings.WALLET_SHARDS) > 1 else ''
+
+    @staticmethod
+    def compact(batch_size):
+        # Порциями, пока не свернуто все; каждая порция - отдельная транзакция
+        total = 0
+        while True:
+            compacted = Wallet.compact(batch_size)
+            total += compacted
+            if compacted < batch_size:
+                return total
@@ -0,0 +1,82 @@
+import os
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from wallets.ledger_io import FORMATS, ProgressFile, copy_to, open_file
+from wallets.models import Wallet, WalletShard, Operation
+
+
+class Command(BaseCommand):
+    """
+    Выгрузка кошельков и операций через COPY
+    """
+    help = (
+        'Выгружает кошельки (uuid, владелец, баланс) и операции в каталог: wallets.<ext> и operations.<ext>. '
+        'Память не зависит от объема данных. Выгружается один шард (--database)'
+    )
+
+    wallets_sql = """
+        SELECT wallet.uuid, wallet.owner_id,
+            (wallet.balance
+                + COALESCE((SELECT SUM(balance) FROM {shard} WHERE wallet_id = wallet.uuid), 0)
+                + COALESCE((
+                    SELECT SUM(CASE WHEN operation_type = 'DEPOSIT' THEN amount ELSE -amount END)
+                    FROM {operation} WHERE wallet_id = wallet.uuid AND NOT compacted
+                ), 0))::numeric(20, 2) AS balance
+        FROM {wallet} AS wallet
+    """
+
+    operations_sql = """
+        SELECT id, wallet_id, operation_type, amount, created_at FROM {operation} {where}
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Каталог для файлов выгрузки')
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv', help='Формат COPY')
+        parser.add_argument('--compress', action='store_true', help='Сжимать файлы gzip')
+        parser.add_argument('--since', help='Операции начиная с этого момента (ISO 8601)')
+        parser.add_argument('--until', help='Операции до этого момента, не включая (ISO 8601)')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Шард кошельков (WALLET_SHARDS)')
+
+    def handle(self, *args, **options):
+        if options['database'] not in settings.WALLET_SHARDS:
+            raise CommandError(f"Базы {options['database']} нет в WALLET_SHARDS")
+        connection = connections[options['database']]
+        os.makedirs(options['directory'], exist_ok=True)
+        extension, copy_options = FORMATS[options['format']]
+        suffix = f'.{extension}.gz' if options['compress'] else f'.{extension}'
+        tables = {
+            'wallet': Wallet._meta.db_table,
+            'shard': WalletShard._meta.db_table,
+            'operation': Operation._meta.db_table,
+        }
+
+        conditions, params = [], []
+        if options['since']:
+            conditions.append('created_at >= %s')
+            params.append(options['since'])
+        if options['until']:
+            conditions.append('created_at < %s')
+            params.append(options['until'])
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        # Обе выгрузки в одном снимке REPEATABLE READ: балансы согласованы с операциями
+        with transaction.atomic(using=options['database']), connection.cursor() as cursor:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+            for name, sql, sql_params in (
+                    ('wallets', self.wallets_sql.format(**tables), []),
+                    ('operations', self.operations_sql.format(where=where, **tables), params)):
+                path = os.path.join(options['directory'], name + suffix)
+                query = connection.ops.compose_sql(sql, sql_params)
+                with open_file(path, 'wb') as file:
+                    progress = ProgressFile(file, lambda size, elapsed: self.progress(name, size, elapsed))
+                    copy_to(cursor, f'COPY ({query}) TO STDOUT WITH ({copy_options})', progress)
+                self.stdout.write(
+                    f'{name}: {cursor.rowcount} строк, {progress.bytes / 2 ** 20:.1f} МБ за {progress.elapsed:.1f} с '
+                    f'({cursor.rowcount / max(progress.elapsed, 1e-6):.0f} строк/с) -> {path}'
+                )
+
+    def progress(self, name, size, elapsed):
+        self.stdout.write(f'{name}: {size / 2 ** 20:.1f} МБ, {size / 2 ** 20 / elapsed:.1f} МБ/с')
@@ -0,0 +1,78 @@
+import re
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from wallets.contention import SpaceSaving, metric_key
+from wallets.models import Wallet
+
+# Значение UUID, подставленное в текст запроса: '…'::uuid
+UUID_PATTERN = re.compile(r"'([0-9a-f]{32}|[0-9a-f-]{36})'::uuid")
+
+# Запросы всех соединений базы, ждущие блокировку, к кошелькам и суб-балансам (wallets_wallet%)
+WAITING_SQL = """
+    SELECT query FROM pg_stat_activity
+    WHERE datname = current_database() AND pid <> pg_backend_pid() AND wait_event_type = 'Lock' AND query LIKE %s
+"""
+
+
+class Command(BaseCommand):
+    """
+    Самые конкурентные кошельки по всем процессам, работающим с базой
+    """
+    help = (
+        'Опрашивает pg_stat_activity и считает, сколько времени запросы к каждому кошельку ждали блокировку: '
+        'ожидание кошелька - число ожидающих запросов с его UUID в каждом опросе, умноженное на интервал. '
+        'Учитываются все процессы и движки; значения параметров видны в тексте запроса при подстановке на '
+        'стороне клиента (по умолчанию у Django). Счетчики процесса - wallet_hot_wallet_* на /metrics, '
+        'кошелек там обозначен ключом из вывода команды'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=float, default=10, help='Длительность опроса, секунды')
+        parser.add_argument('--interval', type=float, default=0.05, help='Интервал опроса, секунды')
+        parser.add_argument('--top', type=int, default=10, help='Сколько кошельков вывести')
+        parser.add_argument('--tracked', type=int, default=1000, help='Размер наброска горячих кошельков')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Шард кошельков (WALLET_SHARDS)')
+
+    def handle(self, *args, **options):
+        if options['duration'] <= 0 or options['interval'] <= 0 or options['top'] < 1 or options['tracked'] < 1:
+            raise CommandError('Параметры должны быть положительными')
+        if options['database'] not in settings.WALLET_SHARDS:
+            raise CommandError(f"Базы {options['database']} нет в WALLET_SHARDS")
+
+        sketch = SpaceSaving(options['tracked'])
+        samples = waiting = 0
+        deadline = time.monotonic() + options['duration']
+        with connections[options['database']].cursor() as cursor:
+            while True:
+                cursor.execute(WAITING_SQL, [f'%{Wallet._meta.db_table}%'])
+                for query, in cursor.fetchall():
+                    waiting += 1
+                    for wallet_uuid in {uuid.UUID(value) for value in UUID_PATTERN.findall(query)}:
+                        sketch.add(str(wallet_uuid), options['interval'])
+                samples += 1
+                if time.monotonic() + options['interval'] > deadline:
+                    break
+                time.sleep(options['interval'])
+
+        top = sketch.top(options['top'])
+        self.stdout.write(f'Опросов: {samples}, ожидающих запросов: {waiting}')
+        if not top:
+            self.stdout.write('Ожиданий блокировок кошельков нет')
+            return
+        wallets = Wallet.objects.using(options['database']).in_bulk([wallet_uuid for wallet_uuid, *_ in top])
+        for wallet_uuid, weight, error, count in top:
+            wallet = wallets.get(uuid.UUID(wallet_uuid))
+            mode = (
+                'не найден' if wallet is None else
+                f'суб-балансов {wallet.shard_count}' if wallet.shard_count else
+                'журнал' if wallet.ledger_mode else 'обычный'
+            )
+            self.stdout.write(
+                f'{wallet_uuid} (ключ {metric_key(wallet_uuid)})  ожидание ~{weight:.2f} с (±{error:.2f}), '
+                f'ожидающих в опросах: {count}, {mode}'
+            )
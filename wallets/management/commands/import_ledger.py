@@ -0,0 +1,220 @@
+import io
+import os
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Q
+
+from users.models import User
+from wallets.cache import get_balance_cache
+from wallets.ledger_io import FORMATS, ProgressFile, copy_from, iter_chunks, open_file
+from wallets.models import Wallet, WalletDirectory, WalletShard, Operation
+
+
+class Command(BaseCommand):
+    """
+    Загрузка кошельков и операций через COPY
+    """
+    help = (
+        'Загружает wallets.<ext> и operations.<ext> из каталога (формат выгрузки export_ledger) порциями, '
+        'каждая порция - отдельная транзакция. Загружается в один шард (--database), новые кошельки '
+        'записываются в справочник шардов; разложить их по шардам - командой rebalance_wallets'
+    )
+
+    staging_sql = """
+        CREATE TEMPORARY TABLE IF NOT EXISTS ledger_import_wallet (
+            uuid uuid, owner_id bigint, balance numeric(20, 2)
+        ) ON COMMIT DELETE ROWS;
+        CREATE TEMPORARY TABLE IF NOT EXISTS ledger_import_operation (
+            id bigint, wallet_id uuid, operation_type varchar(8), amount numeric(20, 2), created_at timestamptz
+        ) ON COMMIT DELETE ROWS;
+        CREATE TEMPORARY TABLE IF NOT EXISTS ledger_import_expected (uuid uuid PRIMARY KEY, balance numeric(20, 2));
+        TRUNCATE ledger_import_expected;
+    """
+
+    # Новые кошельки создаются с нулевым балансом: его дают загружаемые операции.
+    # Кошельки из skipped (без владельца, записанные в справочнике в другой
+    # шард или за другим кошельком владельца) и уже существующие пропускаются
+    wallets_sql = """
+        WITH expected AS (
+            INSERT INTO ledger_import_expected SELECT uuid, balance FROM ledger_import_wallet
+            ON CONFLICT (uuid) DO UPDATE SET balance = excluded.balance
+        )
+        INSERT INTO {wallet} (uuid, owner_id, balance, shard_count, ledger_mode, version)
+        SELECT uuid, owner_id, 0, 0, false, 0 FROM ledger_import_wallet
+        WHERE NOT uuid = ANY(%(skipped)s)
+        ON CONFLICT DO NOTHING
+        RETURNING uuid, owner_id
+    """
+
+    # Строки кошельков блокируются в порядке uuid, как в apply_operations
+    lock_sql = """
+        SELECT 1 FROM {wallet}
+        WHERE uuid IN (SELECT wallet_id FROM ledger_import_operation)
+        ORDER BY uuid FOR NO KEY UPDATE
+    """
+
+    # Вставка порции и пересчет балансов одним запросом: сумма операций
+    # каждого кошелька прибавляется к balance (к первому суб-балансу у
+    # разделенного кошелька), поэтому после каждой порции балансы
+    # согласованы с операциями. Операции неизвестных кошельков пропускаются
+    operations_sql = """
+        WITH inserted AS (
+            INSERT INTO {operation} (wallet_id, operation_type, amount, created_at, compacted)
+            SELECT wallet_id, operation_type, amount, created_at, true FROM ledger_import_operation
+            WHERE wallet_id IN (SELECT uuid FROM {wallet})
+            RETURNING wallet_id, CASE WHEN operation_type = 'DEPOSIT' THEN amount ELSE -amount END AS delta
+        ), totals AS (
+            SELECT wallet_id, SUM(delta) AS delta FROM inserted GROUP BY wallet_id
+        ), shards AS (
+            UPDATE {shard} AS shard SET balance = shard.balance + totals.delta, version = shard.version + 1
+            FROM totals WHERE shard.wallet_id = totals.wallet_id AND shard.index = 0
+        ), wallets AS (
+            UPDATE {wallet} AS wallet
+            SET balance = wallet.balance + CASE WHEN wallet.shard_count = 0 THEN totals.delta ELSE 0 END,
+                version = wallet.version + 1
+            FROM totals WHERE wallet.uuid = totals.wallet_id
+            RETURNING wallet.uuid
+        )
+        SELECT (SELECT COUNT(*) FROM inserted), ARRAY(SELECT uuid FROM wallets)
+    """
+
+    # Кошельки, баланс которых после загрузки не совпал с выгруженным
+    reconcile_sql = """
+        SELECT expected.uuid, expected.balance, wallet.balance
+            + COALESCE((SELECT SUM(balance) FROM {shard} WHERE wallet_id = wallet.uuid), 0)
+            + COALESCE((
+                SELECT SUM(CASE WHEN operation_type = 'DEPOSIT' THEN amount ELSE -amount END)
+                FROM {operation} WHERE wallet_id = wallet.uuid AND NOT compacted
+            ), 0) AS balance
+        FROM ledger_import_expected AS expected
+        JOIN {wallet} AS wallet ON wallet.uuid = expected.uuid
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Каталог с файлами выгрузки')
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv', help='Формат COPY')
+        parser.add_argument('--chunk-size', type=int, default=100000, help='Строк в одной порции')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Шард кошельков (WALLET_SHARDS)')
+
+    def handle(self, *args, **options):
+        if options['database'] not in settings.WALLET_SHARDS:
+            raise CommandError(f"Базы {options['database']} нет в WALLET_SHARDS")
+        extension, copy_options = FORMATS[options['format']]
+        tables = {
+            'wallet': Wallet._meta.db_table,
+            'shard': WalletShard._meta.db_table,
+            'operation': Operation._meta.db_table,
+        }
+        files = {name: self.find_file(options['directory'], name, extension) for name in ('wallets', 'operations')}
+        if not any(files.values()):
+            raise CommandError(f'В каталоге нет файлов wallets.{extension} и operations.{extension}')
+
+        with connections[options['database']].cursor() as cursor:
+            cursor.execute(self.staging_sql)
+            if files['wallets']:
+                self.load(
+                    cursor, files['wallets'], options, 'ledger_import_wallet', copy_options,
+                    self.wallets_sql.format(**tables)
+                )
+            if files['operations']:
+                self.load(
+                    cursor, files['operations'], options, 'ledger_import_operation', copy_options,
+                    self.operations_sql.format(**tables), self.lock_sql.format(**tables)
+                )
+            if files['wallets']:
+                self.reconcile(cursor, self.reconcile_sql.format(**tables))
+
+    def load(self, cursor, path, options, staging, copy_options, sql, lock_sql=None):
+        name = os.path.basename(path)
+        alias = cursor.db.alias
+        started, total, applied = time.monotonic(), 0, 0
+        with open_file(path, 'rb') as file:
+            progress = ProgressFile(file, lambda size, elapsed: None)
+            for chunk, rows in iter_chunks(progress, options['format'], options['chunk_size']):
+                # Транзакция справочника в default фиксируется после транзакции шарда
+                with transaction.atomic(using=DEFAULT_DB_ALIAS), transaction.atomic(using=alias):
+                    copy_from(cursor, f'COPY {staging} FROM STDIN WITH ({copy_options})', io.BytesIO(chunk))
+                    if lock_sql:
+                        cursor.execute(lock_sql)
+                        cursor.execute(sql)
+                        inserted, changed = cursor.fetchone()
+                        self.refresh_cache(alias, changed)
+                    else:
+                        inserted = self.insert_wallets(cursor, sql)
+                total += rows
+                applied += inserted
+                elapsed = max(time.monotonic() - started, 1e-6)
+                self.stdout.write(
+                    f'{name}: {total} строк, загружено {applied}, {total / elapsed:.0f} строк/с, '
+                    f'{progress.bytes / 2 ** 20 / elapsed:.1f} МБ/с'
+                )
+        if applied != total:
+            self.stdout.write(self.style.WARNING(f'{name}: пропущено {total - applied} строк'))
+
+    @staticmethod
+    def insert_wallets(cursor, sql) -> int:
+        """
+        Вставка порции кошельков и их записей в справочник шардов. Владельцы
+        и справочник - в default, поэтому проверки идут отдельными запросами
+        """
+        cursor.execute('SELECT uuid, owner_id FROM ledger_import_wallet')
+        staged = cursor.fetchall()
+        users = set(User.objects.filter(pk__in={owner_id for _, owner_id in staged}).values_list('pk', flat=True))
+        alias = cursor.db.alias
+        # Запись справочника мешает, только если кошелек записан в другой шард или у владельца другой кошелек
+        locations = WalletDirectory.objects.filter(
+            Q(wallet_uuid__in=[wallet_uuid for wallet_uuid, _ in staged]) |
+            Q(owner_id__in=[owner_id for _, owner_id in staged])
+        ).values_list('wallet_uuid', 'owner_id', 'alias')
+        owners = {owner_id: wallet_uuid for wallet_uuid, owner_id, _ in locations}
+        elsewhere = {wallet_uuid for wallet_uuid, _, location in locations if location != alias}
+        skipped = [
+            wallet_uuid for wallet_uuid, owner_id in staged
+            if owner_id not in users or wallet_uuid in elsewhere or owners.get(owner_id, wallet_uuid) != wallet_uuid
+        ]
+        cursor.execute(sql, {'skipped': skipped})
+        inserted = cursor.fetchall()
+        WalletDirectory.objects.bulk_create(
+            [
+                WalletDirectory(wallet_uuid=wallet_uuid, owner_id=owner_id, alias=alias)
+                for wallet_uuid, owner_id in inserted
+            ],
+            ignore_conflicts=True
+        )
+        return len(inserted)
+
+    @staticmethod
+    def refresh_cache(alias, wallet_uuids):
+        """
+        Кэш измененных кошельков обновляется одним запросом после фиксации порции
+        """
+        def write():
+            cache = get_balance_cache()
+            for wallet_uuid, state in Wallet.get_states(wallet_uuids, alias).items():
+                cache.set(wallet_uuid, state)
+
+        if wallet_uuids:
+            transaction.on_commit(write, using=alias, robust=True)
+
+    def reconcile(self, cursor, sql):
+        cursor.execute(sql)
+        mismatched = [row for row in cursor.fetchall() if row[1] != row[2]]
+        cursor.execute('TRUNCATE ledger_import_expected')
+        for wallet_uuid, expected, actual in mismatched[:10]:
+            self.stdout.write(
+                self.style.WARNING(f'Кошелек {wallet_uuid}: ожидался баланс {expected}, получен {actual}')
+            )
+        if mismatched:
+            self.stdout.write(self.style.WARNING(f'Балансов не совпало: {len(mismatched)}'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Балансы совпадают с выгрузкой'))
+
+    @staticmethod
+    def find_file(directory, name, extension):
+        for path in (os.path.join(directory, f'{name}.{extension}'), os.path.join(directory, f'{name}.{extension}.gz')):
+            if os.path.exists(path):
+                return path
+        return None
@@ -0,0 +1,30 @@
+from django.core.management import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from wallets.models import Wallet
+from wallets.sharding import locate, use_shard
+
+
+class Command(BaseCommand):
+    """
+    Включение и отключение режима журнала для кошелька
+    """
+    help = 'Переводит кошелек в режим журнала (баланс = снимок + несвернутые операции) или обратно'
+
+    def add_arguments(self, parser):
+        parser.add_argument('wallet_uuid', help='UUID кошелька')
+        parser.add_argument('--disable', action='store_true', help='Отключить режим журнала')
+
+    def handle(self, *args, **options):
+        with use_shard(locate(options['wallet_uuid'])):
+            wallet = Wallet.objects.filter(uuid=options['wallet_uuid']).first()
+            if wallet is None:
+                raise CommandError('Кошелек не найден')
+
+            try:
+                wallet.set_ledger_mode(not options['disable'])
+            except ValidationError as e:
+                raise CommandError(e.detail[0])
+            self.stdout.write(
+                f'Кошелек {wallet.uuid}: режим журнала {wallet.ledger_mode}, баланс {wallet.get_balance()}'
+            )
@@ -0,0 +1,72 @@
+import os
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import timezone
+
+from wallets.partitions import (
+    DEFAULT, add_months, archive_partition, create_partition, is_covered, list_partitions, month_bound,
+    month_start, partition_name
+)
+
+
+class Command(BaseCommand):
+    """
+    Обслуживание помесячных разделов таблицы операций
+    """
+    help = (
+        'Создает разделы операций на месяцы вперед и архивирует в сжатый CSV разделы старше срока хранения, '
+        'во всех шардах (архивы шарда - в подкаталоге с его именем). Запускается ежедневно (cron)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ahead', type=int, default=settings.OPERATION_PARTITIONS_AHEAD,
+            help='На сколько месяцев вперед создавать разделы'
+        )
+        parser.add_argument(
+            '--retention-months', type=int, default=settings.OPERATION_RETENTION_MONTHS,
+            help='Сколько полных месяцев хранить в базе (0 - не архивировать)'
+        )
+        parser.add_argument(
+            '--archive-dir', default=settings.OPERATION_ARCHIVE_DIR, help='Каталог архивов разделов'
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет сделано')
+
+    def handle(self, *args, **options):
+        for alias in settings.WALLET_SHARDS:
+            with connections[alias].cursor() as cursor:
+                self.maintain(cursor, alias, options)
+
+    def maintain(self, cursor, alias, options):
+        # Имена разделов во всех шардах одинаковые: сообщения с именем шарда, архивы - в его подкаталоге
+        prefix = f'{alias}: ' if len(settings.WALLET_SHARDS) > 1 else ''
+        archive_dir = options['archive_dir']
+        if alias != DEFAULT_DB_ALIAS:
+            archive_dir = os.path.join(archive_dir, alias)
+
+        current = month_start(timezone.now())
+        existing = list_partitions(cursor)
+        for ahead in range(options['ahead'] + 1):
+            month = add_months(current, ahead)
+            if is_covered(existing, month_bound(month)):
+                continue
+            if not options['dry_run']:
+                create_partition(cursor, month)
+            self.stdout.write(f'{prefix}Создан раздел {partition_name(month)}')
+
+        if not options['retention_months']:
+            return
+        cutoff = month_bound(add_months(current, -options['retention_months']))
+        for name, lower, upper in list_partitions(cursor):
+            if name == DEFAULT or upper is None or upper > cutoff:
+                continue
+            if options['dry_run']:
+                self.stdout.write(f'{prefix}Раздел {name} будет архивирован')
+                continue
+            try:
+                path = archive_partition(cursor, name, archive_dir)
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write(f'{prefix}Раздел {name} архивирован в {path}')
@@ -0,0 +1,64 @@
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import DatabaseError, connections
+
+from wallets.operation_queue import pending_wallets, process_wallet, purge
+from wallets.sharding import use_shard
+
+
+class Command(BaseCommand):
+    """
+    Обработчик очереди операций, принятых в асинхронном режиме
+    """
+    help = (
+        'Применяет операции из очереди (Prefer: respond-async) пулом потоков: кошельки - параллельно, операции '
+        'одного кошелька - по порядку приема пачками. В простое удаляет обработанные операции старше '
+        'OPERATION_QUEUE_RETENTION_HOURS'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Потоков-обработчиков')
+        parser.add_argument('--batch-size', type=int, default=100, help='Операций кошелька за одну транзакцию')
+        parser.add_argument(
+            '--interval', type=float, default=1,
+            help='Пауза при пустой очереди, секунды (0 - разобрать очередь и завершиться)'
+        )
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['batch_size'] < 1 or options['interval'] < 0:
+            raise CommandError('Параметры должны быть положительными')
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                processed = 0
+                for alias in settings.WALLET_SHARDS:
+                    with use_shard(alias):
+                        wallets = pending_wallets(options['workers'] * 4)
+                    process = functools.partial(self.process, alias, options['batch_size'])
+                    processed += sum(executor.map(process, wallets))
+                if processed:
+                    self.stdout.write(f'Обработано операций: {processed}')
+                    continue
+                for alias in settings.WALLET_SHARDS:
+                    with use_shard(alias):
+                        purge(10000)
+                if not options['interval']:
+                    break
+                time.sleep(options['interval'])
+
+    def process(self, alias, batch_size, wallet_uuid):
+        # У каждого потока свое соединение
+        connection = connections[alias]
+        try:
+            with use_shard(alias):
+                return process_wallet(wallet_uuid, batch_size)
+        except DatabaseError as e:
+            # Операции остаются в очереди до следующего прохода
+            self.stderr.write(f'{wallet_uuid}: {e}')
+            return 0
+        finally:
+            connection.close()
@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import connections
+
+from wallets.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    """
+    Удаление ключей идемпотентности с истекшим сроком хранения
+    """
+    help = 'Удаляет просроченные ключи идемпотентности порциями, во всех шардах'
+
+    sql = """
+        DELETE FROM {table} WHERE id IN (
+            SELECT id FROM {table} WHERE expires_at < now() LIMIT %s
+        )
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help='Ключей за один DELETE')
+        parser.add_argument('--pause', type=float, default=0, help='Пауза между порциями, секунды')
+
+    def handle(self, *args, **options):
+        # Короткие транзакции по порции, чтобы не держать блокировки и не раздувать WAL
+        deleted = 0
+        for alias in settings.WALLET_SHARDS:
+            while True:
+                with connections[alias].cursor() as cursor:
+                    cursor.execute(self.sql.format(table=IdempotencyKey._meta.db_table), [options['batch_size']])
+                    count = cursor.rowcount
+                deleted += count
+                if count < options['batch_size']:
+                    break
+                time.sleep(options['pause'])
+        self.stdout.write(f'Удалено ключей: {deleted}')
@@ -0,0 +1,340 @@
+import uuid
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, models, transaction
+
+from wallets.models import (
+    DailyStatement, IdempotencyKey, Operation, QueuedOperation, Wallet, WalletDirectory, WalletShard
+)
+from wallets.sharding import forget, placement
+
+
+class MoveError(Exception):
+    """
+    Перенос кошелька прерван до фиксации; повторный запуск начнет его заново
+    """
+
+
+def columns(model) -> list:
+    # Автоинкрементный id не переносится: в шарде-приемнике его выдает своя последовательность
+    return [field.column for field in model._meta.concrete_fields if not isinstance(field, models.AutoField)]
+
+
+class Command(BaseCommand):
+    """
+    Перенос кошельков между шардами
+    """
+    help = (
+        'Переносит кошельки, шард которых по справочнику не совпадает с placement(uuid) (после изменения '
+        'WALLET_SHARDS), или один кошелек (--wallet, --to). Перенос идет онлайн: сначала копируется свернутая '
+        'история, затем под блокировкой строки кошелька - остаток, справочник переключается до фиксации удаления '
+        'в старом шарде. --repair сверяет справочник с шардами после сбоев; запускать при остановленной записи'
+    )
+
+    # Ключ advisory-блокировки в default: одновременно работает только один перенос
+    lock_key = 0x7265626c6e63
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет перенесено')
+        parser.add_argument('--limit', type=int, default=0, help='Перенести не больше N кошельков (0 - все)')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Операций в одной порции копирования')
+        parser.add_argument('--wallet', help='UUID кошелька для переноса')
+        parser.add_argument('--to', help='Шард для --wallet')
+        parser.add_argument('--repair', action='store_true', help='Сверить справочник с шардами')
+
+    def handle(self, *args, **options):
+        if options['limit'] < 0 or options['batch_size'] < 1:
+            raise CommandError('Параметры должны быть положительными')
+        if bool(options['wallet']) != bool(options['to']):
+            raise CommandError('--wallet и --to задаются вместе')
+        if options['to'] and options['to'] not in settings.WALLET_SHARDS:
+            raise CommandError(f"Базы {options['to']} нет в WALLET_SHARDS")
+
+        with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', [self.lock_key])
+            if not cursor.fetchone()[0]:
+                raise CommandError('Перенос уже выполняется другим процессом')
+        try:
+            if options['repair']:
+                self.repair(options)
+            else:
+                self.rebalance(options)
+        finally:
+            with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', [self.lock_key])
+
+    def rebalance(self, options):
+        if options['wallet']:
+            location = WalletDirectory.objects.filter(wallet_uuid=options['wallet']).first()
+            if location is None:
+                raise CommandError('Кошелек не найден')
+            moves = [(location.wallet_uuid, location.alias, options['to'])] if location.alias != options['to'] else []
+        else:
+            moves = self.misplaced(options['limit'])
+        if not moves:
+            self.stdout.write('Все кошельки на своих шардах')
+            return
+
+        moved = 0
+        for wallet_uuid, source, target in moves:
+            if options['dry_run']:
+                self.stdout.write(f'{wallet_uuid}: {source} -> {target}')
+                continue
+            try:
+                self.move(wallet_uuid, source, target, options['batch_size'])
+            except (MoveError, DatabaseError) as e:
+                self.stderr.write(f'{wallet_uuid}: {source} -> {target} не перенесен: {e}')
+                continue
+            moved += 1
+            self.stdout.write(f'{wallet_uuid}: {source} -> {target}')
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f'Перенесено кошельков: {moved} из {len(moves)}'))
+
+    @staticmethod
+    def misplaced(limit) -> list:
+        """
+        Кошельки, шард которых не совпадает с placement: [(uuid, откуда, куда)]
+        """
+        moves = []
+        for wallet_uuid, alias in WalletDirectory.objects.order_by('wallet_uuid').values_list(
+            'wallet_uuid', 'alias'
+        ).iterator():
+            target = placement(wallet_uuid)
+            if alias != target:
+                moves.append((wallet_uuid, alias, target))
+                if len(moves) == limit:
+                    break
+        return moves
+
+    def move(self, wallet_uuid, source, target, batch_size):
+        """
+        Перенос одного кошелька.
+
+        1. В приемник копируются строка кошелька (предварительно) и свернутые
+           операции - они уже не меняются; запоминается, что скопировано.
+        2. В транзакции источника строка кошелька блокируется FOR UPDATE:
+           операции с кошельком ждут ее (вставка операции - на проверке
+           внешнего ключа при фиксации). Читается остаток - состояние,
+           суб-балансы, несвернутые и новые операции, ключи, очередь
+           асинхронных операций, дневные итоги - и все данные кошелька
+           удаляются (пока не зафиксировано).
+        3. Остаток записывается в приемник, транзакция приемника фиксируется.
+        4. Справочник переключается на приемник.
+        5. Фиксируется удаление в источнике. Ждавшие операции получают ошибку
+           внешнего ключа, и обработчики повторяют их в новом шарде (on_shard).
+
+        Сбой до шага 4 оставляет кошелек в источнике, копию в приемнике удалит
+        повторный перенос; сбой после - копию в источнике удалит --repair.
+        """
+        self.discard(target, wallet_uuid)
+        copied, skipped, last_id = self.copy_history(wallet_uuid, source, target, batch_size)
+        switched = False
+        try:
+            with transaction.atomic(using=source):
+                data = self.take(wallet_uuid, source, copied, skipped, last_id)
+                with transaction.atomic(using=target):
+                    self.put(wallet_uuid, target, data)
+                switched = WalletDirectory.objects.filter(
+                    wallet_uuid=wallet_uuid, alias=source
+                ).update(alias=target) == 1
+                if not switched:
+                    raise MoveError('запись справочника изменилась')
+        except Exception:
+            if not switched:
+                self.discard(target, wallet_uuid)
+            raise
+        finally:
+            forget(wallet_uuid)
+
+    @staticmethod
+    def copy_history(wallet_uuid, source, target, batch_size):
+        """
+        Шаг 1: строка кошелька и свернутые операции. Возвращает число
+        скопированных, id пропущенных несвернутых и наибольший просмотренный id
+        """
+        wallet_columns = ', '.join(columns(Wallet))
+        operation_columns = columns(Operation)
+        insert_sql = (
+            f'INSERT INTO {Operation._meta.db_table} ({", ".join(operation_columns)}) '
+            f'VALUES ({", ".join(["%s"] * len(operation_columns))})'
+        )
+        copied, skipped, last_id = 0, [], 0
+        with transaction.atomic(using=source), transaction.atomic(using=target):
+            with connections[source].cursor() as cursor:
+                cursor.execute(f'SELECT {wallet_columns} FROM {Wallet._meta.db_table} WHERE uuid = %s', [wallet_uuid])
+                row = cursor.fetchone()
+            if row is None:
+                raise MoveError('кошелька нет в шарде справочника')
+            with connections[target].cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {Wallet._meta.db_table} ({wallet_columns}) '
+                    f'VALUES ({", ".join(["%s"] * len(row))})', row
+                )
+            # Один запрос - один снимок истории; читается порциями через курсор сервера
+            with connections[source].chunked_cursor() as cursor:
+                cursor.execute(
+                    f'SELECT id, compacted, {", ".join(operation_columns)} FROM {Operation._meta.db_table} '
+                    f'WHERE wallet_id = %s ORDER BY id', [wallet_uuid]
+                )
+                while rows := cursor.fetchmany(batch_size):
+                    last_id = rows[-1][0]
+                    skipped.extend(row[0] for row in rows if not row[1])
+                    batch = [row[2:] for row in rows if row[1]]
+                    with connections[target].cursor() as target_cursor:
+                        target_cursor.executemany(insert_sql, batch)
+                    copied += len(batch)
+        return copied, skipped, last_id
+
+    @staticmethod
+    def take(wallet_uuid, source, copied, skipped, last_id) -> dict:
+        """
+        Шаг 2: остаток данных кошелька под блокировкой и их удаление в источнике
+        """
+        operation = Operation._meta.db_table
+        data = {}
+        with connections[source].cursor() as cursor:
+            cursor.execute(
+                f'SELECT {", ".join(columns(Wallet))} FROM {Wallet._meta.db_table} WHERE uuid = %s FOR UPDATE',
+                [wallet_uuid]
+            )
+            data[Wallet] = cursor.fetchall()
+            if not data[Wallet]:
+                raise MoveError('кошелек удален')
+            cursor.execute(
+                f'SELECT count(*) FROM {operation} WHERE wallet_id = %s AND id <= %s AND NOT id = ANY(%s)',
+                [wallet_uuid, last_id, skipped]
+            )
+            if cursor.fetchone()[0] != copied:
+                # Запоздавшая вставка или удаление раздела операций во время копирования
+                raise MoveError('история изменилась во время копирования')
+            cursor.execute(
+                f'SELECT {", ".join(columns(Operation))} FROM {operation} '
+                f'WHERE wallet_id = %s AND (id > %s OR id = ANY(%s)) ORDER BY id',
+                [wallet_uuid, last_id, skipped]
+            )
+            data[Operation] = cursor.fetchall()
+            for model in (WalletShard, IdempotencyKey, QueuedOperation, DailyStatement):
+                cursor.execute(
+                    f'SELECT {", ".join(columns(model))} FROM {model._meta.db_table} WHERE wallet_id = %s',
+                    [wallet_uuid]
+                )
+                data[model] = cursor.fetchall()
+            for model in (Operation, WalletShard, IdempotencyKey, QueuedOperation, DailyStatement):
+                cursor.execute(f'DELETE FROM {model._meta.db_table} WHERE wallet_id = %s', [wallet_uuid])
+            cursor.execute(f'DELETE FROM {Wallet._meta.db_table} WHERE uuid = %s', [wallet_uuid])
+        return data
+
+    @staticmethod
+    def put(wallet_uuid, target, data):
+        """
+        Шаг 3: остаток в приемник. Дневные итоги, которые триггер насчитал
+        по скопированным операциям, заменяются итогами источника
+        """
+        wallet_columns = columns(Wallet)
+        with connections[target].cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {Wallet._meta.db_table} SET {", ".join(f"{column} = %s" for column in wallet_columns)} '
+                f'WHERE uuid = %s', [*data[Wallet][0], wallet_uuid]
+            )
+            if cursor.rowcount != 1:
+                raise MoveError('копия кошелька в приемнике удалена')
+            for model in (WalletShard, IdempotencyKey, QueuedOperation, Operation, DailyStatement):
+                if model is DailyStatement:
+                    cursor.execute(f'DELETE FROM {model._meta.db_table} WHERE wallet_id = %s', [wallet_uuid])
+                model_columns = columns(model)
+                if data[model]:
+                    cursor.executemany(
+                        f'INSERT INTO {model._meta.db_table} ({", ".join(model_columns)}) '
+                        f'VALUES ({", ".join(["%s"] * len(model_columns))})', data[model]
+                    )
+
+    @staticmethod
+    def discard(alias, wallet_uuid):
+        """
+        Удаление копии кошелька со всеми данными из шарда alias
+        """
+        with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+            for model in (Operation, WalletShard, IdempotencyKey, QueuedOperation, DailyStatement):
+                cursor.execute(f'DELETE FROM {model._meta.db_table} WHERE wallet_id = %s', [wallet_uuid])
+            cursor.execute(f'DELETE FROM {Wallet._meta.db_table} WHERE uuid = %s', [wallet_uuid])
+
+    def repair(self, options):
+        """
+        Сверка справочника с шардами после сбоев переноса или создания кошелька:
+        - запись справочника указывает на шард с кошельком - копии в других
+          шардах удаляются;
+        - кошелек есть только в другом шарде - запись переключается на него;
+        - кошелька нет нигде - запись удаляется;
+        - кошелек шарда без записи - записывается в справочник.
+        """
+        dry_run, batch_size = options['dry_run'], options['batch_size']
+        fixed = 0
+        last = uuid.UUID(int=0)
+        while True:
+            chunk = list(
+                WalletDirectory.objects.filter(wallet_uuid__gt=last).order_by('wallet_uuid')[:batch_size]
+            )
+            if not chunk:
+                break
+            last = chunk[-1].wallet_uuid
+            present = {
+                alias: set(
+                    Wallet.objects.using(alias).filter(uuid__in=[location.wallet_uuid for location in chunk])
+                    .values_list('uuid', flat=True)
+                )
+                for alias in settings.WALLET_SHARDS
+            }
+            for location in chunk:
+                found = [alias for alias in settings.WALLET_SHARDS if location.wallet_uuid in present[alias]]
+                if location.alias in found:
+                    for alias in found:
+                        if alias != location.alias:
+                            self.stdout.write(f'{location.wallet_uuid}: удаление копии в {alias}')
+                            if not dry_run:
+                                self.discard(alias, location.wallet_uuid)
+                            fixed += 1
+                elif len(found) == 1:
+                    self.stdout.write(f'{location.wallet_uuid}: справочник {location.alias} -> {found[0]}')
+                    if not dry_run:
+                        WalletDirectory.objects.filter(pk=location.pk).update(alias=found[0])
+                    fixed += 1
+                elif not found:
+                    self.stdout.write(f'{location.wallet_uuid}: кошелька нет ни в одном шарде, запись удаляется')
+                    if not dry_run:
+                        location.delete()
+                    fixed += 1
+                else:
+                    self.stderr.write(
+                        f'{location.wallet_uuid}: копии в {", ".join(found)}, справочник - {location.alias}; '
+                        f'нужен ручной разбор'
+                    )
+                forget(location.wallet_uuid)
+
+        for alias in settings.WALLET_SHARDS:
+            last = uuid.UUID(int=0)
+            while True:
+                chunk = list(
+                    Wallet.objects.using(alias).filter(uuid__gt=last).order_by('uuid')
+                    .values_list('uuid', 'owner_id')[:batch_size]
+                )
+                if not chunk:
+                    break
+                last = chunk[-1][0]
+                known = set(
+                    WalletDirectory.objects.filter(wallet_uuid__in=[wallet_uuid for wallet_uuid, _ in chunk])
+                    .values_list('wallet_uuid', flat=True)
+                )
+                for wallet_uuid, owner_id in chunk:
+                    if wallet_uuid in known:
+                        continue
+                    self.stdout.write(f'{wallet_uuid}: нет в справочнике, записывается в {alias}')
+                    fixed += 1
+                    if dry_run:
+                        continue
+                    _, created = WalletDirectory.objects.get_or_create(
+                        owner_id=owner_id, defaults={'wallet_uuid': wallet_uuid, 'alias': alias}
+                    )
+                    if not created:
+                        self.stderr.write(f'{wallet_uuid}: у владельца {owner_id} уже есть другой кошелек')
+        self.stdout.write(self.style.SUCCESS(f'Исправлено записей: {fixed}'))
@@ -0,0 +1,32 @@
+from django.core.management import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from wallets.models import Wallet
+from wallets.sharding import locate, use_shard
+
+
+class Command(BaseCommand):
+    """
+    Включение и отключение суб-балансов для «горячего» кошелька
+    """
+    help = 'Разделяет баланс кошелька на N суб-балансов (0 - отключить)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('wallet_uuid', help='UUID кошелька')
+        parser.add_argument('shard_count', type=int, help='Число суб-балансов, 0 - отключить')
+
+    def handle(self, *args, **options):
+        if options['shard_count'] < 0:
+            raise CommandError('Число суб-балансов не может быть отрицательным')
+        with use_shard(locate(options['wallet_uuid'])):
+            wallet = Wallet.objects.filter(uuid=options['wallet_uuid']).first()
+            if wallet is None:
+                raise CommandError('Кошелек не найден')
+
+            try:
+                wallet.set_shard_count(options['shard_count'])
+            except ValidationError as e:
+                raise CommandError(e.detail[0])
+            self.stdout.write(
+                f'Кошелек {wallet.uuid}: суб-балансов {wallet.shard_count}, баланс {wallet.get_balance()}'
+            )
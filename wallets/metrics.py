@@ -0,0 +1,254 @@
+"""
+Метрики запросов процесса в формате Prometheus.
+
+RequestMetricsMiddleware для каждого запроса измеряет полное время,
+число и время запросов к базе, время рендера ответа и размер тела и
+добавляет их в реестр по имени маршрута (wallets:wallet_operation и т.п.).
+Запросы к базе учитываются оберткой execute_wrappers соединений Django и
+функциями async_db; рендер - для ответов DRF (Response) и асинхронных
+представлений. Реестр - в памяти процесса: каждый процесс gunicorn или
+uvicorn отдает свои значения, Prometheus суммирует их по меткам экземпляра.
+"""
+import bisect
+import contextvars
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+# Границы корзин гистограммы времени ответа, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Маршрут запросов, не сопоставленных ни одному URL (404), и метод вне списка: без роста числа рядов
+UNMATCHED = '<unmatched>'
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+_current = contextvars.ContextVar('wallet_request_stats', default=None)
+
+
+class RequestStats:
+    """
+    Измерения одного запроса
+    """
+    __slots__ = ('started', 'queries', 'db_time', 'render_time', 'render_started')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.render_started = None
+
+    def start_render(self, response):
+        self.render_started = time.perf_counter()
+
+    def finish_render(self, response):
+        if self.render_started is not None:
+            self.render_time += time.perf_counter() - self.render_started
+            self.render_started = None
+        return response
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Обертка execute_wrappers соединений Django: число и время запросов
+    """
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_time += time.perf_counter() - started
+
+
+def install_wrapper(sender, connection, **kwargs):
+    """
+    Обертка на каждое новое соединение Django, в любом потоке
+    """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install_wrapper)
+
+
+def query_finished(started: float):
+    """
+    Учет запроса к базе вне ORM (async_db), started - time.perf_counter() до запроса
+    """
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += time.perf_counter() - started
+
+
+def render_finished(started: float):
+    """
+    Учет рендера ответа вне DRF (асинхронные представления)
+    """
+    stats = _current.get()
+    if stats is not None:
+        stats.render_time += time.perf_counter() - started
+
+
+class MetricsRegistry:
+    """
+    Счетчики процесса по (маршрут, метод): гистограмма времени ответа и
+    суммы запросов к базе, времени базы, рендера и байтов ответа; число
+    ответов - по (маршрут, метод, статус)
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # (маршрут, метод) -> [корзины..., +Inf, сумма времени, запросы, время базы, рендер, байты]
+        self.series = {}
+        self.responses = {}
+
+    def observe(self, view, method, status, duration, stats, size):
+        bucket = bisect.bisect_left(self.buckets, duration)
+        with self.lock:
+            series = self.series.get((view, method))
+            if series is None:
+                series = self.series[(view, method)] = [0] * (len(self.buckets) + 1) + [0.0, 0, 0.0, 0.0, 0]
+            series[bucket] += 1
+            values = len(self.buckets) + 1
+            series[values] += duration
+            series[values + 1] += stats.queries
+            series[values + 2] += stats.db_time
+            series[values + 3] += stats.render_time
+            series[values + 4] += size
+            key = (view, method, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.series.clear()
+            self.responses.clear()
+
+    def export(self) -> str:
+        """
+        Текстовый формат Prometheus (version 0.0.4)
+        """
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+            responses = dict(self.responses)
+
+        values = len(self.buckets) + 1
+        lines = [
+            '# HELP wallet_http_request_duration_seconds Время обработки запроса',
+            '# TYPE wallet_http_request_duration_seconds histogram',
+        ]
+        for (view, method), counts in sorted(series.items()):
+            lines += histogram_lines(
+                'wallet_http_request_duration_seconds', f'view="{escape(view)}",method="{method}"',
+                self.buckets, counts[:values], counts[values]
+            )
+
+        lines += [
+            '# HELP wallet_http_responses_total Ответы по статусу',
+            '# TYPE wallet_http_responses_total counter',
+        ]
+        for (view, method, status), count in sorted(responses.items()):
+            lines.append(
+                f'wallet_http_responses_total{{view="{escape(view)}",method="{method}",status="{status}"}} {count}'
+            )
+
+        for offset, name, description in (
+            (1, 'wallet_http_db_queries_total', 'Запросы к базе'),
+            (2, 'wallet_http_db_duration_seconds_total', 'Время запросов к базе'),
+            (3, 'wallet_http_render_duration_seconds_total', 'Время рендера ответа'),
+            (4, 'wallet_http_response_bytes_total', 'Размер тел ответов'),
+        ):
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+            for (view, method), counts in sorted(series.items()):
+                lines.append(f'{name}{{view="{escape(view)}",method="{method}"}} {counts[values + offset]!r}')
+        return '\n'.join(lines) + '\n'
+
+
+def histogram_lines(name, labels, buckets, counts, total) -> list:
+    """
+    Строки гистограммы Prometheus: counts - число наблюдений по корзинам buckets и +Inf, total - их сумма
+    """
+    lines, cumulative = [], 0
+    for bound, count in zip(buckets + ('+Inf',), counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_sum{{{labels}}} {total!r}')
+    lines.append(f'{name}_count{{{labels}}} {cumulative}')
+    return lines
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = MetricsRegistry()
+
+
+class RequestMetricsMiddleware:
+    """
+    Измерение запросов для реестра метрик и заголовка Server-Timing
+    (METRICS_SERVER_TIMING). Работает и в синхронном, и в асинхронном
+    стеке без переключения в поток.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = _current.set(stats)
+        try:
+            # Соединения, открытые до загрузки модуля
+            for connection in connections.all(initialized_only=True):
+                install_wrapper(None, connection)
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, stats)
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = _current.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, stats)
+
+    def process_template_response(self, request, response):
+        # Ответы DRF рендерятся обработчиком после всех middleware
+        stats = _current.get()
+        if stats is not None:
+            stats.start_render(response)
+            response.add_post_render_callback(stats.finish_render)
+        return response
+
+    def finish(self, request, response, stats):
+        duration = time.perf_counter() - stats.started
+        match = request.resolver_match
+        size = 0 if response.streaming else len(response.content)
+        registry.observe(
+            match.view_name if match else UNMATCHED, request.method if request.method in METHODS else 'OTHER',
+            response.status_code, duration, stats, size
+        )
+        if settings.METRICS_SERVER_TIMING:
+            response['Server-Timing'] = (
+                f'total;dur={duration * 1000:.2f}, '
+                f'db;dur={stats.db_time * 1000:.2f};desc="{stats.queries} queries", '
+                f'render;dur={stats.render_time * 1000:.2f}'
+            )
+        return response
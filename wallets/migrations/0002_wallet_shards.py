@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-18 08:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='shard_count',
+            field=models.PositiveSmallIntegerField(default=0, help_text='0 - баланс хранится в самом кошельке', verbose_name='Число суб-балансов'),
+        ),
+        migrations.CreateModel(
+            name='WalletShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField(verbose_name='Номер суб-баланса')),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=20, verbose_name='Суб-баланс')),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='wallets.wallet', verbose_name='Кошелек')),
+            ],
+            options={
+                'verbose_name': 'Суб-баланс',
+                'verbose_name_plural': 'Суб-балансы',
+                'constraints': [models.UniqueConstraint(fields=('wallet', 'index'), name='wallets_shard_wallet_index_uniq')],
+            },
+        ),
+    ]
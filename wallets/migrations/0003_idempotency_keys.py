@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-18 08:48
+
+import django.db.models.deletion
+import wallets.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0002_wallet_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, verbose_name='Ключ идемпотентности')),
+                ('operation_type', models.CharField(choices=[('DEPOSIT', 'Deposit'), ('WITHDRAW', 'Withdraw')], max_length=8, verbose_name='Тип операции')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=20, verbose_name='Сумма операции')),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=20, verbose_name='Баланс после операции')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата и время создания')),
+                ('expires_at', models.DateTimeField(db_index=True, default=wallets.models.idempotency_key_expires_at, verbose_name='Срок хранения')),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='idempotency_keys', to='wallets.wallet', verbose_name='Кошелек')),
+            ],
+            options={
+                'verbose_name': 'Ключ идемпотентности',
+                'verbose_name_plural': 'Ключи идемпотентности',
+                'constraints': [models.UniqueConstraint(fields=('wallet', 'key'), name='wallets_idempotency_wallet_key_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-18 08:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0003_idempotency_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='operation',
+            name='compacted',
+            field=models.BooleanField(db_default=True, help_text='False - операция кошелька в режиме журнала, еще не свернутая в balance', verbose_name='Учтена в снимке баланса'),
+        ),
+        migrations.AddField(
+            model_name='wallet',
+            name='ledger_mode',
+            field=models.BooleanField(default=False, help_text='Баланс - снимок в поле balance плюс еще не свернутые операции', verbose_name='Баланс из журнала операций'),
+        ),
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(condition=models.Q(('compacted', False)), fields=['wallet'], name='wallets_op_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 08:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0004_ledger_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0, help_text='Увеличивается при каждом изменении баланса', verbose_name='Версия состояния'),
+        ),
+        migrations.AddField(
+            model_name='walletshard',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='Версия суб-баланса'),
+        ),
+    ]
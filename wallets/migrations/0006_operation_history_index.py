@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-18 08:58
+
+import django.db.models.deletion
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Индекс на большой таблице строится без блокировки записи
+    atomic = False
+
+    dependencies = [
+        ('wallets', '0005_state_version'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='operation',
+            index=models.Index(fields=['wallet', '-created_at', '-id'], include=('operation_type', 'amount'), name='wallets_op_history_idx'),
+        ),
+        # Индекс внешнего ключа становится префиксом нового и удаляется
+        migrations.AlterField(
+            model_name='operation',
+            name='wallet',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='operations', to='wallets.wallet', verbose_name='Кошелек'),
+        ),
+    ]
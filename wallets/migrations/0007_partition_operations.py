@@ -0,0 +1,114 @@
+from django.db import migrations, transaction
+from django.utils import timezone
+
+from wallets.partitions import (
+    TABLE, LEGACY, DEFAULT, add_months, create_partition, month_bound, month_start
+)
+
+# Сколько будущих месяцев получают разделы сразу при переходе
+PARTITIONS_AHEAD = 3
+
+
+def partition_operations(apps, schema_editor):
+    """
+    Переход на секционированную таблицу без копирования данных: исходная
+    таблица становится разделом wallets_operation_legacy для всех операций
+    до начала следующего месяца. Уникальный индекс (id, created_at) для нового
+    первичного ключа построен заранее (CONCURRENTLY), а ограничение CHECK
+    проверяется без блокировки записи, поэтому ATTACH не сканирует таблицу.
+    """
+    bound = month_bound(add_months(month_start(timezone.now()), 1))
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f'ALTER TABLE {TABLE} DROP CONSTRAINT IF EXISTS {LEGACY}_range, '
+            f'ADD CONSTRAINT {LEGACY}_range CHECK (created_at < %s) NOT VALID',
+            [bound]
+        )
+        cursor.execute(f'ALTER TABLE {TABLE} VALIDATE CONSTRAINT {LEGACY}_range')
+
+        with transaction.atomic(using=schema_editor.connection.alias):
+            # Нумерация продолжается с последнего выданного id
+            cursor.execute(
+                f"SELECT GREATEST(COALESCE(MAX(id), 0), nextval(pg_get_serial_sequence('{TABLE}', 'id'))) + 1 "
+                f"FROM {TABLE}"
+            )
+            next_id = cursor.fetchone()[0]
+            cursor.execute(f'ALTER TABLE {TABLE} ALTER COLUMN id DROP IDENTITY IF EXISTS, ALTER COLUMN id DROP DEFAULT')
+            cursor.execute(f'DROP SEQUENCE IF EXISTS {TABLE}_id_seq')
+            cursor.execute(
+                f'ALTER TABLE {TABLE} DROP CONSTRAINT {TABLE}_pkey, '
+                f'ADD CONSTRAINT {LEGACY}_pkey PRIMARY KEY USING INDEX wallets_op_partition_key'
+            )
+            cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {LEGACY}')
+            cursor.execute(f'ALTER INDEX wallets_op_history_idx RENAME TO {LEGACY}_history_idx')
+            cursor.execute(f'ALTER INDEX wallets_op_pending_idx RENAME TO {LEGACY}_pending_idx')
+
+            cursor.execute(f"""
+                CREATE TABLE {TABLE} (
+                    id bigint NOT NULL,
+                    operation_type varchar(8) NOT NULL,
+                    amount numeric(20, 2) NOT NULL,
+                    created_at timestamp with time zone NOT NULL,
+                    wallet_id uuid NOT NULL,
+                    compacted boolean NOT NULL DEFAULT true,
+                    CONSTRAINT {TABLE}_pkey PRIMARY KEY (id, created_at),
+                    CONSTRAINT {TABLE}_wallet_id_fk_wallets_wallet_uuid FOREIGN KEY (wallet_id)
+                        REFERENCES wallets_wallet (uuid) DEFERRABLE INITIALLY DEFERRED
+                ) PARTITION BY RANGE (created_at)
+            """)
+            cursor.execute(f'CREATE SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id START %s', [next_id])
+            cursor.execute(f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT nextval('{TABLE}_id_seq')")
+            cursor.execute(
+                f'CREATE INDEX wallets_op_history_idx ON {TABLE} (wallet_id, created_at DESC, id DESC) '
+                f'INCLUDE (operation_type, amount)'
+            )
+            cursor.execute(f'CREATE INDEX wallets_op_pending_idx ON {TABLE} (wallet_id) WHERE NOT compacted')
+
+            # Индексы и внешний ключ исходной таблицы совпадают с родительскими и присоединяются к ним
+            cursor.execute(f'ALTER TABLE {TABLE} ATTACH PARTITION {LEGACY} FOR VALUES FROM (MINVALUE) TO (%s)', [bound])
+            cursor.execute(f'ALTER TABLE {LEGACY} DROP CONSTRAINT {LEGACY}_range')
+            cursor.execute(f'CREATE TABLE {DEFAULT} PARTITION OF {TABLE} DEFAULT')
+
+        for ahead in range(1, PARTITIONS_AHEAD + 1):
+            create_partition(cursor, add_months(month_start(timezone.now()), ahead))
+
+
+def merge_operations(apps, schema_editor):
+    """
+    Обратный переход: все разделы копируются в обычную таблицу
+    """
+    with schema_editor.connection.cursor() as cursor, transaction.atomic(using=schema_editor.connection.alias):
+        cursor.execute(f'CREATE TABLE {TABLE}_plain (LIKE {TABLE} INCLUDING DEFAULTS)')
+        cursor.execute(f'INSERT INTO {TABLE}_plain SELECT * FROM {TABLE}')
+        cursor.execute(f'ALTER SEQUENCE {TABLE}_id_seq OWNED BY NONE')
+        cursor.execute(f'DROP TABLE {TABLE}')
+        cursor.execute(f'ALTER TABLE {TABLE}_plain RENAME TO {TABLE}')
+        cursor.execute(f'ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id')
+        cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (id)')
+        cursor.execute(
+            f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_wallet_id_fk_wallets_wallet_uuid FOREIGN KEY (wallet_id) '
+            f'REFERENCES wallets_wallet (uuid) DEFERRABLE INITIALLY DEFERRED'
+        )
+        cursor.execute(
+            f'CREATE INDEX wallets_op_history_idx ON {TABLE} (wallet_id, created_at DESC, id DESC) '
+            f'INCLUDE (operation_type, amount)'
+        )
+        cursor.execute(f'CREATE INDEX wallets_op_pending_idx ON {TABLE} (wallet_id) WHERE NOT compacted')
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY и проверка CHECK выполняются вне транзакции
+    atomic = False
+
+    dependencies = [
+        ('wallets', '0006_operation_history_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS wallets_op_partition_key '
+            'ON wallets_operation (id, created_at)',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RunPython(partition_operations, merge_operations),
+    ]
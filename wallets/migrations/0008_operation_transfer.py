@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 09:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0007_partition_operations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='operation',
+            name='transfer_id',
+            field=models.UUIDField(blank=True, help_text='Общий для списания и пополнения одного перевода между кошельками', null=True, verbose_name='Перевод'),
+        ),
+    ]
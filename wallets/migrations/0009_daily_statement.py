@@ -0,0 +1,36 @@
+# Generated by Django 5.2 on 2026-10-18 09:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from wallets.statements import CREATE_TRIGGER, DROP_TRIGGER
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0008_operation_transfer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStatement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='День (UTC)')),
+                ('slot', models.PositiveSmallIntegerField(verbose_name='Слот')),
+                ('deposit_total', models.DecimalField(decimal_places=2, default=0, max_digits=20, verbose_name='Сумма пополнений')),
+                ('deposit_count', models.PositiveIntegerField(default=0, verbose_name='Число пополнений')),
+                ('withdraw_total', models.DecimalField(decimal_places=2, default=0, max_digits=20, verbose_name='Сумма списаний')),
+                ('withdraw_count', models.PositiveIntegerField(default=0, verbose_name='Число списаний')),
+                ('wallet', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='daily_statements', to='wallets.wallet', verbose_name='Кошелек')),
+            ],
+            options={
+                'verbose_name': 'Дневные итоги',
+                'verbose_name_plural': 'Дневные итоги',
+                'constraints': [models.UniqueConstraint(fields=('wallet', 'day', 'slot'), name='wallets_statement_wallet_day_uniq')],
+            },
+        ),
+        # Итоги обновляются в транзакции каждой вставки операций; прошлые операции - командой backfill_statements
+        migrations.RunSQL(CREATE_TRIGGER, reverse_sql=DROP_TRIGGER),
+    ]
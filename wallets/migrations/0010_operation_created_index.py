@@ -0,0 +1,48 @@
+from django.db import migrations, models
+
+from wallets.partitions import TABLE, list_partitions
+
+INDEX = 'wallets_op_created_idx'
+
+
+def create_index(apps, schema_editor):
+    """
+    Индекс секционированной таблицы без блокировки записи: индекс родителя
+    создается пустым (ON ONLY), индексы разделов - CONCURRENTLY и
+    присоединяются к нему; после присоединения всех разделов индекс действителен
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {INDEX} ON ONLY {TABLE} (created_at DESC, id DESC)')
+        for name, lower, upper in list_partitions(cursor):
+            cursor.execute(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name}_created_idx ON {name} (created_at DESC, id DESC)'
+            )
+            cursor.execute(f'ALTER INDEX {INDEX} ATTACH PARTITION {name}_created_idx')
+
+
+def drop_index(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'DROP INDEX IF EXISTS {INDEX}')
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY выполняется вне транзакции
+    atomic = False
+
+    dependencies = [
+        ('wallets', '0009_daily_statement'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='operation',
+                    index=models.Index(fields=['-created_at', '-id'], name=INDEX),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(create_index, drop_index),
+            ],
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.2 on 2026-10-18 10:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, migrations, models
+
+
+def fill_directory(apps, schema_editor):
+    """
+    Существующие кошельки живут в базе миграции: справочник есть только в default
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO wallets_walletdirectory (wallet_uuid, owner_id, alias) '
+            'SELECT uuid, owner_id, %s FROM wallets_wallet',
+            [schema_editor.connection.alias]
+        )
+
+
+def drop_owner_constraint(apps, schema_editor):
+    """
+    Пользователи живут только в default: в других шардах владелец кошелька -
+    строка чужой базы, внешний ключ на пустую таблицу пользователей снимается
+    """
+    connection = schema_editor.connection
+    if connection.alias == DEFAULT_DB_ALIAS:
+        return
+    table = apps.get_model('wallets', 'Wallet')._meta.db_table
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+    for name, constraint in constraints.items():
+        if constraint['foreign_key'] and constraint['columns'] == ['owner_id']:
+            schema_editor.execute(schema_editor.sql_delete_fk % {
+                'table': schema_editor.quote_name(table),
+                'name': schema_editor.quote_name(name),
+            })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0010_operation_created_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_owner_constraint, migrations.RunPython.noop, hints={'model_name': 'wallet'}),
+        migrations.CreateModel(
+            name='WalletDirectory',
+            fields=[
+                ('wallet_uuid', models.UUIDField(primary_key=True, serialize=False, verbose_name='UUID кошелька')),
+                ('alias', models.CharField(max_length=64, verbose_name='База кошелька')),
+                ('owner', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='wallet_location', to=settings.AUTH_USER_MODEL, verbose_name='Владелец кошелька')),
+            ],
+            options={
+                'verbose_name': 'Размещение кошелька',
+                'verbose_name_plural': 'Размещение кошельков',
+            },
+        ),
+        migrations.RunPython(fill_directory, migrations.RunPython.noop, hints={'model_name': 'walletdirectory'}),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2 on 2026-10-18 10:53
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0011_wallet_directory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedOperation',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, verbose_name='Идентификатор')),
+                ('operation_type', models.CharField(choices=[('DEPOSIT', 'Deposit'), ('WITHDRAW', 'Withdraw')], max_length=8, verbose_name='Тип операции')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=20, verbose_name='Сумма операции')),
+                ('idempotency_key', models.CharField(blank=True, max_length=255, null=True, verbose_name='Ключ идемпотентности')),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='PENDING', max_length=8, verbose_name='Статус')),
+                ('balance', models.DecimalField(blank=True, decimal_places=2, max_digits=20, null=True, verbose_name='Баланс после операции')),
+                ('error', models.CharField(blank=True, default='', max_length=255, verbose_name='Ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата и время приема')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата и время обработки')),
+                ('wallet', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='queued_operations', to='wallets.wallet', verbose_name='Кошелек')),
+            ],
+            options={
+                'verbose_name': 'Операция в очереди',
+                'verbose_name_plural': 'Операции в очереди',
+                'indexes': [models.Index(condition=models.Q(('status', 'PENDING')), fields=['wallet', 'created_at'], name='wallets_queued_pending_idx'), models.Index(fields=['processed_at'], name='wallets_queued_processed_idx')],
+                'constraints': [models.UniqueConstraint(fields=('wallet', 'idempotency_key'), name='wallets_queued_wallet_key_uniq')],
+            },
+        ),
+    ]
@@ -1,11 +1,18 @@
 import uuid
+from datetime import date, timedelta
 from decimal import Decimal
 
-from django.db import models, transaction
-from django.db.models import F
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, models, router, transaction
+from django.db.models import Case, F, Q, Sum, When
+from django.utils import timezone
 from rest_framework.exceptions import ValidationError
 
 from config.settings import AUTH_USER_MODEL
+from wallets import async_db
+from wallets.cache import get_balance_cache, run_cache
+from wallets.contention import LockTimer
+from wallets.sharding import atomic, wallet_db
 
 
 class Wallet(models.Model):
@@ -30,33 +37,414 @@ class Wallet(models.Model):
         related_name='wallet',
         verbose_name='Владелец кошелька'
     )
+    shard_count = models.PositiveSmallIntegerField(
+        default=0,
+        verbose_name='Число суб-балансов',
+        help_text='0 - баланс хранится в самом кошельке'
+    )
+    ledger_mode = models.BooleanField(
+        default=False,
+        verbose_name='Баланс из журнала операций',
+        help_text='Баланс - снимок в поле balance плюс еще не свернутые операции'
+    )
+    version = models.PositiveBigIntegerField(
+        default=0,
+        verbose_name='Версия состояния',
+        help_text='Увеличивается при каждом изменении баланса'
+    )
+
+    # Пополнение суб-баланса: свободная (не заблокированная) строка,
+    # а если заняты все - случайная, и запись операции одним запросом
+    deposit_to_shard_sql = """
+        WITH free AS (
+            SELECT id FROM {shard} WHERE wallet_id = %(uuid)s
+            ORDER BY random() LIMIT 1 FOR UPDATE SKIP LOCKED
+        ), updated AS (
+            UPDATE {shard} SET balance = balance + %(amount)s, version = version + 1
+            WHERE id = COALESCE(
+                (SELECT id FROM free),
+                (SELECT id FROM {shard} WHERE wallet_id = %(uuid)s ORDER BY random() LIMIT 1)
+            )
+            RETURNING id, balance
+        ), created AS (
+            INSERT INTO {operation} (wallet_id, operation_type, amount, created_at)
+            SELECT %(uuid)s, %(operation_type)s, %(amount)s, now() FROM updated
+        )
+        SELECT (SELECT balance FROM updated) + COALESCE((
+            SELECT SUM(balance) FROM {shard}
+            WHERE wallet_id = %(uuid)s AND id <> (SELECT id FROM updated)
+        ), 0)
+    """
+
+    # Свертка операций в снимок баланса: операции помечаются свернутыми,
+    # их сумма прибавляется к balance кошелька в той же транзакции
+    compact_sql = """
+        WITH batch AS (
+            SELECT id, created_at FROM {operation} WHERE NOT compacted {wallet_filter}
+            ORDER BY id LIMIT %(limit)s FOR UPDATE {skip_locked}
+        ), compacted AS (
+            UPDATE {operation} AS operation SET compacted = true
+            FROM batch WHERE operation.id = batch.id AND operation.created_at = batch.created_at
+            RETURNING operation.wallet_id,
+                CASE WHEN operation.operation_type = 'DEPOSIT' THEN operation.amount ELSE -operation.amount END AS delta
+        ), totals AS (
+            SELECT wallet_id, SUM(delta) AS delta, COUNT(*) AS count FROM compacted GROUP BY wallet_id
+        ), updated AS (
+            UPDATE {wallet} AS wallet
+            SET balance = wallet.balance + totals.delta, version = wallet.version + totals.count
+            FROM totals WHERE wallet.uuid = totals.wallet_id
+            RETURNING totals.count
+        )
+        SELECT COALESCE(SUM(count), 0) FROM updated
+    """
 
-    @transaction.atomic
-    def update_balance(self, operation_type: str, amount: Decimal):
+    # Состояние кошелька одним запросом (один снимок данных): версия и баланс
+    # складываются из строки кошелька, суб-балансов и несвернутых операций.
+    # Свертка переносит сумму и число операций в balance и version кошелька,
+    # смена числа суб-балансов - их сумму и версии, поэтому версия только растет
+    state_sql = """
+        SELECT
+            wallet.uuid,
+            wallet.version + COALESCE(shards.version, 0) + pending.count,
+            wallet.balance + COALESCE(shards.balance, 0) + COALESCE(pending.delta, 0),
+            wallet.owner_id
+        FROM {wallet} AS wallet
+        CROSS JOIN LATERAL (
+            SELECT SUM(version) AS version, SUM(balance) AS balance FROM {shard} WHERE wallet_id = wallet.uuid
+        ) AS shards
+        CROSS JOIN LATERAL (
+            SELECT COUNT(*) AS count, SUM(CASE WHEN operation_type = 'DEPOSIT' THEN amount ELSE -amount END) AS delta
+            FROM {operation} WHERE wallet_id = wallet.uuid AND NOT compacted
+        ) AS pending
+        WHERE wallet.uuid = ANY(%(uuids)s)
+    """
+
+    @classmethod
+    def get_state(cls, wallet_uuid, using: str = None):
         """
-        Обновление баланса с проверкой типа операции
+        Версия, баланс и владелец кошелька; None, если кошелька нет
+        """
+        return cls.get_states([wallet_uuid], using).get(str(wallet_uuid))
+
+    @classmethod
+    def get_states(cls, wallet_uuids, using: str = None) -> dict:
+        """
+        Состояния нескольких кошельков одним запросом: {str(uuid): состояние}.
+        Без using - из базы для чтения по маршрутизатору (реплика в GET-запросах)
+        """
+        with connections[using or router.db_for_read(cls)].cursor() as cursor:
+            cursor.execute(
+                cls.state_sql.format(
+                    wallet=cls._meta.db_table,
+                    shard=WalletShard._meta.db_table,
+                    operation=Operation._meta.db_table
+                ),
+                {'uuids': [uuid.UUID(str(wallet_uuid)) for wallet_uuid in wallet_uuids]}
+            )
+            return {
+                str(row[0]): {'version': row[1], 'balance': row[2], 'owner': row[3]}
+                for row in cursor.fetchall()
+            }
+
+    @classmethod
+    async def aget_states(cls, wallet_uuids) -> dict:
+        """
+        get_states через асинхронный пул
+        """
+        rows = await async_db.fetchall(
+            cls.state_sql.format(
+                wallet=cls._meta.db_table,
+                shard=WalletShard._meta.db_table,
+                operation=Operation._meta.db_table
+            ),
+            {'uuids': [uuid.UUID(str(wallet_uuid)) for wallet_uuid in wallet_uuids]},
+            using=wallet_db()
+        )
+        return {str(row[0]): {'version': row[1], 'balance': row[2], 'owner': row[3]} for row in rows}
+
+    @classmethod
+    async def aget_state(cls, wallet_uuid):
+        return (await cls.aget_states([wallet_uuid])).get(str(wallet_uuid))
+
+    @classmethod
+    def cache_state(cls, wallet_uuid, state: dict = None):
+        """
+        Запись состояния кошелька в кэш после фиксации транзакции.
+        Без state оно перечитывается из базы уже после фиксации.
+        """
+        using = wallet_db()
+
+        def write():
+            current = state or cls.get_state(wallet_uuid, using)
+            if current is None:
+                get_balance_cache().delete(wallet_uuid)
+            else:
+                get_balance_cache().set(wallet_uuid, current)
+
+        transaction.on_commit(write, using=using, robust=True)
+
+    @classmethod
+    async def acache_state(cls, wallet_uuid, state: dict = None):
+        """
+        Запись в кэш из асинхронного кода: запросы пула уже зафиксированы
+        """
+        cache = get_balance_cache()
+        current = state or await cls.aget_state(wallet_uuid)
+        if current is None:
+            await run_cache(cache, cache.delete, wallet_uuid)
+        else:
+            await run_cache(cache, cache.set, wallet_uuid, current)
+
+    def get_balance(self) -> Decimal:
+        """
+        Баланс кошелька с учетом суб-балансов и несвернутых операций
+        """
+        if not self.shard_count and not self.ledger_mode:
+            return self.balance
+        # Снимок и журнал читаются одним запросом, иначе свертка между ними учтется дважды
+        state = Wallet.get_state(self.pk)
+        return state['balance'] if state is not None else self.balance
+
+    @classmethod
+    def compact(cls, limit: int, wallet_uuid=None) -> int:
+        """
+        Свертка не более limit операций в снимки балансов.
+
+        Без wallet_uuid сворачиваются операции всех кошельков, занятые другой
+        сверткой строки пропускаются. Возвращает число свернутых операций.
+        """
+        sql = cls.compact_sql.format(
+            operation=Operation._meta.db_table,
+            wallet=cls._meta.db_table,
+            wallet_filter='AND wallet_id = %(uuid)s' if wallet_uuid else '',
+            skip_locked='' if wallet_uuid else 'SKIP LOCKED'
+        )
+        with connections[wallet_db()].cursor() as cursor:
+            cursor.execute(sql, {'limit': limit, 'uuid': wallet_uuid})
+            return cursor.fetchone()[0]
+
+    def apply_to_ledger(self, operation_type: str, amount: Decimal, idempotency_key: str = None):
+        """
+        Операция с кошельком в режиме журнала.
+
+        Пополнение - только вставка операции, без блокировки кошелька.
+        Списание блокирует строку кошелька (FOR NO KEY UPDATE не мешает
+        вставке пополнений) и проверяет баланс уже после блокировки.
+        Возвращает None, если кошелек уже не в режиме журнала.
+        """
+        with LockTimer('ledger', [self.pk]) as timer, atomic():
+            if operation_type == Operation.WITHDRAW:
+                wallet = Wallet.objects.select_for_update(no_key=True).get(pk=self.pk)
+                timer.acquired()
+                if not wallet.ledger_mode:
+                    return None
+                balance = wallet.get_balance()
+                if balance < amount:
+                    raise ValidationError('Недостаточно средств')
+                balance -= amount
+            Operation.objects.create(
+                wallet_id=self.pk,
+                operation_type=operation_type,
+                amount=amount,
+                compacted=False
+            )
+            if operation_type == Operation.DEPOSIT:
+                wallet = Wallet.objects.get(pk=self.pk)
+                balance = wallet.get_balance()
+            if idempotency_key:
+                IdempotencyKey.remember(self.pk, idempotency_key, operation_type, amount, balance)
+            Wallet.cache_state(self.pk)
+        return balance
+
+    @atomic
+    def set_ledger_mode(self, ledger_mode: bool):
+        """
+        Включение или отключение режима журнала.
+        При отключении все операции сворачиваются в balance.
         """
-        # Блокировка записи
         wallet = Wallet.objects.select_for_update().get(pk=self.pk)
+        if ledger_mode and wallet.shard_count:
+            raise ValidationError('Кошелек с суб-балансами нельзя перевести в режим журнала')
+        Wallet.objects.filter(pk=self.pk).update(ledger_mode=ledger_mode)
+        if not ledger_mode:
+            while Wallet.compact(10000, wallet_uuid=self.pk):
+                pass
+        Wallet.cache_state(self.pk)
+        self.refresh_from_db()
 
-        # Проверка для списания
-        if operation_type == 'WITHDRAW' and wallet.balance < amount:
-            raise ValidationError('Недостаточно средств')
+    def apply_to_shards(self, operation_type: str, amount: Decimal, idempotency_key: str = None):
+        """
+        Операция с разделенным на суб-балансы кошельком.
+
+        Пополнение меняет одну строку суб-баланса. Списание блокирует все
+        суб-балансы в порядке индекса (поэтому взаимных блокировок нет)
+        и забирает средства по порядку, начиная с первого.
+        Возвращает None, если суб-балансов уже нет.
+        """
+        if operation_type == Operation.DEPOSIT and idempotency_key:
+            with atomic():
+                balance = self.apply_to_shards(operation_type, amount)
+                if balance is not None:
+                    IdempotencyKey.remember(self.pk, idempotency_key, operation_type, amount, balance)
+            return balance
 
-        # Определение дельты
-        delta = amount if operation_type == 'DEPOSIT' else -amount
+        if operation_type == Operation.DEPOSIT:
+            with connections[wallet_db()].cursor() as cursor:
+                cursor.execute(
+                    self.deposit_to_shard_sql.format(
+                        shard=WalletShard._meta.db_table, operation=Operation._meta.db_table
+                    ),
+                    {'uuid': self.pk, 'amount': amount, 'operation_type': operation_type}
+                )
+                balance = cursor.fetchone()[0]
+            # Баланс из этого запроса не учитывает незафиксированные пополнения
+            # других суб-балансов, поэтому кэш обновляется перечитыванием
+            Wallet.cache_state(self.pk)
+            return balance
+
+        with LockTimer('shards', [self.pk]) as timer, atomic():
+            shards = list(WalletShard.objects.select_for_update().filter(wallet_id=self.pk).order_by('index'))
+            timer.acquired()
+            if not shards:
+                return None
+            total = sum(shard.balance for shard in shards)
+            if total < amount:
+                raise ValidationError('Недостаточно средств')
+
+            changed, remaining = [], amount
+            for shard in shards:
+                if not remaining:
+                    break
+                taken = min(shard.balance, remaining)
+                if taken:
+                    shard.balance -= taken
+                    shard.version += 1
+                    remaining -= taken
+                    changed.append(shard)
+            WalletShard.objects.bulk_update(changed, ['balance', 'version'])
+            Operation.objects.create(wallet_id=self.pk, operation_type=operation_type, amount=amount)
+            if idempotency_key:
+                IdempotencyKey.remember(self.pk, idempotency_key, operation_type, amount, total - amount)
+            Wallet.cache_state(self.pk)
+        return total - amount
+
+    @atomic
+    def set_shard_count(self, shard_count: int):
+        """
+        Включение, изменение числа или отключение (0) суб-балансов.
+        Весь баланс переносится в первый суб-баланс или обратно в кошелек.
+        """
+        wallet = Wallet.objects.select_for_update().get(pk=self.pk)
+        if wallet.ledger_mode:
+            raise ValidationError('Кошелек в режиме журнала нельзя разделить на суб-балансы')
+        # Операции, оставшиеся несвернутыми после отключения режима журнала
+        while Wallet.compact(10000, wallet_uuid=self.pk):
+            pass
+        wallet.refresh_from_db()
+        shards = WalletShard.objects.select_for_update().filter(wallet=wallet).order_by('index')
+        balance = wallet.balance + sum(shard.balance for shard in shards)
+        version = wallet.version + sum(shard.version for shard in shards) + 1
+        shards.delete()
 
-        # Атомарное обновление
+        WalletShard.objects.bulk_create(
+            WalletShard(wallet=wallet, index=index, balance=balance if index == 0 else 0)
+            for index in range(shard_count)
+        )
         Wallet.objects.filter(pk=self.pk).update(
-            balance=F('balance') + delta
+            balance=0 if shard_count else balance,
+            shard_count=shard_count,
+            version=version
         )
+        Wallet.cache_state(self.pk)
         self.refresh_from_db()
 
+    def update_balance(self, operation_type: str, amount: Decimal, idempotency_key: str = None):
+        """
+        Обновление баланса с проверкой типа операции
+        """
+        # Блокировка записи; ожидание и работа под блокировкой до фиксации - в телеметрию
+        with LockTimer('update_balance', [self.pk]) as timer, atomic():
+            wallet = Wallet.objects.select_for_update().get(pk=self.pk)
+            timer.acquired()
+
+            # Баланс разделен на суб-балансы или хранится в журнале: операцию замеряет их метод
+            if wallet.shard_count or wallet.ledger_mode:
+                timer.cancel()
+            if wallet.shard_count:
+                return wallet.apply_to_shards(operation_type, amount, idempotency_key)
+            if wallet.ledger_mode:
+                return wallet.apply_to_ledger(operation_type, amount, idempotency_key)
+
+            # Проверка для списания
+            if operation_type == 'WITHDRAW' and wallet.balance < amount:
+                raise ValidationError('Недостаточно средств')
+
+            # Определение дельты
+            delta = amount if operation_type == 'DEPOSIT' else -amount
+
+            # Атомарное обновление
+            Wallet.objects.filter(pk=self.pk).update(
+                balance=F('balance') + delta,
+                version=F('version') + 1
+            )
+            # Логирование операции в той же транзакции
+            Operation.objects.create(
+                wallet=self,
+                operation_type=operation_type,
+                amount=amount
+            )
+            self.refresh_from_db()
+            if idempotency_key:
+                IdempotencyKey.remember(self.pk, idempotency_key, operation_type, amount, self.balance)
+            # Строка заблокирована, поэтому версия и баланс согласованы
+            Wallet.cache_state(self.pk, {'version': self.version, 'balance': self.balance, 'owner': self.owner_id})
+            return self.balance
+
+    def save(self, *args, **kwargs):
+        """
+        Новый кошелек записывается в справочник в той же транзакции default:
+        она фиксируется после транзакции шарда, поэтому записи без кошелька
+        не бывает, а второй кошелек владельца в любом шарде - IntegrityError
+        """
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        using = kwargs.get('using') or router.db_for_write(Wallet, instance=self)
+        with transaction.atomic(using=DEFAULT_DB_ALIAS), transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+            WalletDirectory.objects.create(wallet_uuid=self.pk, owner_id=self.owner_id, alias=using)
+
     class Meta:
         verbose_name = 'Кошелек'
         verbose_name_plural = 'Кошельки'
 
 
+class WalletDirectory(models.Model):
+    """
+    Модель справочника шардов: в какой базе живет кошелек (wallets/sharding.py).
+
+    Хранится только в default. Уникальность владельца - правило «один
+    кошелек на пользователя» для всех шардов сразу.
+    """
+    wallet_uuid = models.UUIDField(
+        primary_key=True,
+        verbose_name='UUID кошелька'
+    )
+    owner = models.OneToOneField(
+        AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='wallet_location',
+        verbose_name='Владелец кошелька'
+    )
+    alias = models.CharField(
+        max_length=64,
+        verbose_name='База кошелька'
+    )
+
+    class Meta:
+        verbose_name = 'Размещение кошелька'
+        verbose_name_plural = 'Размещение кошельков'
+
+
 class Operation(models.Model):
     """
     Модель операций
@@ -71,6 +459,8 @@ class Operation(models.Model):
         Wallet,
         on_delete=models.CASCADE,
         related_name='operations',
+        # Поиск по кошельку обслуживает индекс истории wallets_op_history_idx
+        db_index=False,
         verbose_name='Кошелек'
     )
     operation_type = models.CharField(
@@ -87,7 +477,311 @@ class Operation(models.Model):
         auto_now_add=True,
         verbose_name='Дата и время операции'
     )
+    compacted = models.BooleanField(
+        db_default=True,
+        verbose_name='Учтена в снимке баланса',
+        help_text='False - операция кошелька в режиме журнала, еще не свернутая в balance'
+    )
+    transfer_id = models.UUIDField(
+        null=True,
+        blank=True,
+        verbose_name='Перевод',
+        help_text='Общий для списания и пополнения одного перевода между кошельками'
+    )
+
+    @classmethod
+    def signed_amount(cls):
+        """
+        Сумма операции со знаком: пополнение положительное, списание отрицательное
+        """
+        return Case(When(operation_type=cls.DEPOSIT, then=F('amount')), default=-F('amount'))
 
     class Meta:
+        # Таблица секционирована по месяцам created_at (миграция 0007,
+        # wallets/partitions.py): первичный ключ в базе - (id, created_at),
+        # индексы создаются без CONCURRENTLY, внешние ключи на операции
+        # невозможны
         verbose_name = 'Операция'
         verbose_name_plural = 'Операции'
+        indexes = [
+            # История кошелька: страница по ключу (created_at, id) читается
+            # только из индекса, без обращения к таблице
+            models.Index(
+                fields=('wallet', '-created_at', '-id'),
+                include=('operation_type', 'amount'),
+                name='wallets_op_history_idx'
+            ),
+            # Несвернутые операции: чтение баланса и свертка касаются только их
+            models.Index(fields=('wallet',), condition=Q(compacted=False), name='wallets_op_pending_idx'),
+            # Общий список операций (админка): порядок, страницы по ключу и фильтр по дате
+            models.Index(fields=('-created_at', '-id'), name='wallets_op_created_idx'),
+        ]
+
+
+class WalletShard(models.Model):
+    """
+    Модель суб-баланса кошелька
+    """
+    wallet = models.ForeignKey(
+        Wallet,
+        on_delete=models.CASCADE,
+        related_name='shards',
+        verbose_name='Кошелек'
+    )
+    index = models.PositiveSmallIntegerField(
+        verbose_name='Номер суб-баланса'
+    )
+    balance = models.DecimalField(
+        max_digits=20,
+        decimal_places=2,
+        default=0,
+        verbose_name='Суб-баланс'
+    )
+    version = models.PositiveBigIntegerField(
+        default=0,
+        verbose_name='Версия суб-баланса'
+    )
+
+    class Meta:
+        verbose_name = 'Суб-баланс'
+        verbose_name_plural = 'Суб-балансы'
+        constraints = [
+            models.UniqueConstraint(fields=('wallet', 'index'), name='wallets_shard_wallet_index_uniq'),
+        ]
+
+
+def idempotency_key_expires_at():
+    return timezone.now() + timedelta(hours=settings.IDEMPOTENCY_KEY_TTL_HOURS)
+
+
+class IdempotencyKey(models.Model):
+    """
+    Модель ключа идемпотентности операции.
+
+    Создается в той же транзакции, что и операция; повтор запроса с тем же
+    ключом возвращает сохраненный ответ без блокировки кошелька.
+    """
+    wallet = models.ForeignKey(
+        Wallet,
+        on_delete=models.CASCADE,
+        related_name='idempotency_keys',
+        verbose_name='Кошелек'
+    )
+    key = models.CharField(
+        max_length=255,
+        verbose_name='Ключ идемпотентности'
+    )
+    operation_type = models.CharField(
+        max_length=8,
+        choices=Operation.OPERATION_TYPES,
+        verbose_name='Тип операции'
+    )
+    amount = models.DecimalField(
+        max_digits=20,
+        decimal_places=2,
+        verbose_name='Сумма операции'
+    )
+    balance = models.DecimalField(
+        max_digits=20,
+        decimal_places=2,
+        verbose_name='Баланс после операции'
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name='Дата и время создания'
+    )
+    expires_at = models.DateTimeField(
+        default=idempotency_key_expires_at,
+        db_index=True,
+        verbose_name='Срок хранения'
+    )
+
+    @classmethod
+    def remember(cls, wallet_id, key: str, operation_type: str, amount: Decimal, balance: Decimal):
+        """
+        Сохранение ключа; повторный ключ вызывает IntegrityError
+        """
+        return cls.objects.create(
+            wallet_id=wallet_id,
+            key=key,
+            operation_type=operation_type,
+            amount=amount,
+            balance=balance
+        )
+
+    def matches(self, operation_type: str, amount: Decimal) -> bool:
+        """
+        Совпадают ли параметры повторного запроса с исходными
+        """
+        return self.operation_type == operation_type and self.amount == amount
+
+    class Meta:
+        verbose_name = 'Ключ идемпотентности'
+        verbose_name_plural = 'Ключи идемпотентности'
+        constraints = [
+            models.UniqueConstraint(fields=('wallet', 'key'), name='wallets_idempotency_wallet_key_uniq'),
+        ]
+
+
+class QueuedOperation(models.Model):
+    """
+    Модель операции, принятой в асинхронном режиме (wallets/operation_queue.py).
+
+    Хранится в шарде кошелька: до применения обработчиком очереди и еще
+    OPERATION_QUEUE_RETENTION_HOURS после него - для опроса статуса.
+    """
+    PENDING = 'PENDING'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    # uuid, а не номер последовательности: id в ссылке на статус не меняется при переносе кошелька в другой шард
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False,
+        verbose_name='Идентификатор'
+    )
+    wallet = models.ForeignKey(
+        Wallet,
+        on_delete=models.CASCADE,
+        related_name='queued_operations',
+        # Поиск по кошельку обслуживает индекс уникальности (wallet, idempotency_key)
+        db_index=False,
+        verbose_name='Кошелек'
+    )
+    operation_type = models.CharField(
+        max_length=8,
+        choices=Operation.OPERATION_TYPES,
+        verbose_name='Тип операции'
+    )
+    amount = models.DecimalField(
+        max_digits=20,
+        decimal_places=2,
+        verbose_name='Сумма операции'
+    )
+    idempotency_key = models.CharField(
+        max_length=255,
+        null=True,
+        blank=True,
+        verbose_name='Ключ идемпотентности'
+    )
+    status = models.CharField(
+        max_length=8,
+        choices=STATUSES,
+        default=PENDING,
+        verbose_name='Статус'
+    )
+    balance = models.DecimalField(
+        max_digits=20,
+        decimal_places=2,
+        null=True,
+        blank=True,
+        verbose_name='Баланс после операции'
+    )
+    error = models.CharField(
+        max_length=255,
+        blank=True,
+        default='',
+        verbose_name='Ошибка'
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name='Дата и время приема'
+    )
+    processed_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name='Дата и время обработки'
+    )
+
+    def matches(self, operation_type: str, amount: Decimal) -> bool:
+        """
+        Совпадают ли параметры повторного запроса с исходными
+        """
+        return self.operation_type == operation_type and self.amount == amount
+
+    class Meta:
+        verbose_name = 'Операция в очереди'
+        verbose_name_plural = 'Операции в очереди'
+        indexes = [
+            # Очередь кошелька в порядке приема: обработчик читает только ожидающие операции
+            models.Index(
+                fields=('wallet', 'created_at'), condition=Q(status='PENDING'), name='wallets_queued_pending_idx'
+            ),
+            # Удаление обработанных операций по истечении срока хранения
+            models.Index(fields=('processed_at',), name='wallets_queued_processed_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=('wallet', 'idempotency_key'), name='wallets_queued_wallet_key_uniq'),
+        ]
+
+
+class DailyStatement(models.Model):
+    """
+    Модель дневных итогов операций кошелька (сутки по UTC, как у разделов операций).
+
+    Обновляется триггером на вставку операций (миграция 0009) в той же
+    транзакции. Итоги дня хранятся в нескольких слотах: соединения пишут в
+    разные строки, поэтому частые операции одного кошелька (суб-балансы,
+    режим журнала) не ждут друг друга на строке итогов. Выписка суммирует слоты.
+    """
+    SLOTS = 8
+
+    wallet = models.ForeignKey(
+        Wallet,
+        on_delete=models.CASCADE,
+        related_name='daily_statements',
+        # Поиск по кошельку обслуживает индекс уникальности (wallet, day, slot)
+        db_index=False,
+        verbose_name='Кошелек'
+    )
+    day = models.DateField(
+        verbose_name='День (UTC)'
+    )
+    slot = models.PositiveSmallIntegerField(
+        verbose_name='Слот'
+    )
+    deposit_total = models.DecimalField(
+        max_digits=20,
+        decimal_places=2,
+        default=0,
+        verbose_name='Сумма пополнений'
+    )
+    deposit_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Число пополнений'
+    )
+    withdraw_total = models.DecimalField(
+        max_digits=20,
+        decimal_places=2,
+        default=0,
+        verbose_name='Сумма списаний'
+    )
+    withdraw_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Число списаний'
+    )
+
+    @classmethod
+    def for_wallet(cls, wallet_uuid, date_from: date, date_to: date):
+        """
+        Итоги по дням за [date_from, date_to] - только дни с операциями
+        """
+        return cls.objects.filter(wallet_id=wallet_uuid, day__range=(date_from, date_to)).values('day').annotate(
+            deposited=Sum('deposit_total'),
+            deposits=Sum('deposit_count'),
+            withdrawn=Sum('withdraw_total'),
+            withdrawals=Sum('withdraw_count'),
+        ).order_by('day')
+
+    class Meta:
+        verbose_name = 'Дневные итоги'
+        verbose_name_plural = 'Дневные итоги'
+        constraints = [
+            models.UniqueConstraint(fields=('wallet', 'day', 'slot'), name='wallets_statement_wallet_day_uniq'),
+        ]
@@ -0,0 +1,112 @@
+"""
+Асинхронный режим операций: принять сейчас, применить позже.
+
+POST .../<uuid>/operation/ с заголовком Prefer: respond-async проверяет
+запрос, сохраняет операцию в очередь (QueuedOperation в шарде кошелька) и
+сразу отвечает 202 со ссылкой на статус GET .../<uuid>/operations/<id>/
+(с параметром wait ответ ждет обработки). Прием не блокирует строку
+кошелька, поэтому массовые выплаты не ждут друг друга в потоках сервера.
+
+Очередь разбирает пул потоков команды process_operations. Операции
+кошелька применяются в порядке приема пачкой до --batch-size одной
+транзакцией apply_operations, каждая со своим результатом или отказом.
+Пачка берется под блокировкой строки кошелька: второй обработчик того же
+кошелька ждет и видит операции первого уже обработанными, порядок не
+нарушается. OPERATION_QUEUE_EAGER - обработка сразу после фиксации
+приема в процессе запроса, без обработчиков (тесты, разработка).
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Min
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from wallets.engines import PendingOperation, apply_operations
+from wallets.models import QueuedOperation, Wallet
+from wallets.sharding import atomic, use_shard, wallet_db
+
+
+def enqueue(wallet_uuid, operation_type: str, amount: Decimal, idempotency_key: str = None) -> QueuedOperation:
+    """
+    Сохранение операции в очередь; повторный ключ идемпотентности вызывает IntegrityError
+    """
+    with atomic():
+        queued = QueuedOperation.objects.create(
+            wallet_id=wallet_uuid,
+            operation_type=operation_type,
+            amount=amount,
+            idempotency_key=idempotency_key
+        )
+    if settings.OPERATION_QUEUE_EAGER:
+        alias = wallet_db()
+
+        def process():
+            with use_shard(alias):
+                process_wallet(wallet_uuid)
+
+        transaction.on_commit(process, using=alias, robust=True)
+    return queued
+
+
+def error_message(error) -> str:
+    if isinstance(error, ValidationError):
+        return str(error.detail[0])
+    return str(error)
+
+
+def process_wallet(wallet_uuid, limit: int = 100) -> int:
+    """
+    Применение не более limit ожидающих операций кошелька в порядке приема.
+    Возвращает число обработанных операций.
+    """
+    with atomic():
+        # Обработчики одного кошелька идут по очереди: порядок приема не нарушается
+        if not Wallet.objects.select_for_update(no_key=True).filter(uuid=wallet_uuid).values_list('uuid'):
+            return 0
+        queued = list(
+            QueuedOperation.objects.filter(wallet_id=wallet_uuid, status=QueuedOperation.PENDING)
+            .order_by('created_at', 'id')[:limit]
+        )
+        if not queued:
+            return 0
+        batch = [
+            PendingOperation(item.operation_type, item.amount, wallet_uuid, idempotency_key=item.idempotency_key)
+            for item in queued
+        ]
+        apply_operations(batch)
+
+        now = timezone.now()
+        for item, pending in zip(queued, batch):
+            item.status = QueuedOperation.DONE if pending.error is None else QueuedOperation.FAILED
+            item.balance = pending.balance
+            item.error = '' if pending.error is None else error_message(pending.error)
+            item.processed_at = now
+        QueuedOperation.objects.bulk_update(queued, ['status', 'balance', 'error', 'processed_at'])
+    return len(queued)
+
+
+def pending_wallets(limit: int) -> list:
+    """
+    Кошельки шарда с ожидающими операциями, начиная с самой давней
+    """
+    return list(
+        QueuedOperation.objects.filter(status=QueuedOperation.PENDING).values('wallet_id').annotate(
+            first=Min('created_at')
+        ).order_by('first').values_list('wallet_id', flat=True)[:limit]
+    )
+
+
+def purge(limit: int) -> int:
+    """
+    Удаление не более limit операций, обработанных раньше срока хранения
+    """
+    table = QueuedOperation._meta.db_table
+    with connections[wallet_db()].cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE processed_at < %s LIMIT %s)',
+            [timezone.now() - timedelta(hours=settings.OPERATION_QUEUE_RETENTION_HOURS), limit]
+        )
+        return cursor.rowcount
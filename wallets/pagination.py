@@ -0,0 +1,67 @@
+import base64
+import binascii
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Постраничный вывод по ключу (created_at, id), от новых к старым.
+
+    Курсор - ключ последней записи страницы, следующая страница начинается
+    строго после него. В отличие от OFFSET, база не пропускает предыдущие
+    строки, поэтому время ответа не зависит от номера страницы.
+    """
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            created_at, pk = self.decode_cursor(cursor)
+            # Условие created_at <= курсора - граница поиска по индексу,
+            # совпадения created_at разрешаются по id
+            queryset = queryset.filter(
+                Q(created_at__lte=created_at) & (Q(created_at__lt=created_at) | Q(id__lt=pk))
+            )
+        page = list(queryset.order_by('-created_at', '-id')[:self.limit + 1])
+        self.has_next = len(page) > self.limit
+        self.page = page[:self.limit]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, self.encode_cursor(last.created_at, last.pk)
+        )
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get(self.limit_query_param, settings.OPERATION_PAGE_SIZE))
+        except ValueError:
+            raise ValidationError({self.limit_query_param: 'Должно быть целым числом'})
+        return min(max(limit, 1), settings.OPERATION_PAGE_MAX_SIZE)
+
+    @staticmethod
+    def encode_cursor(created_at, pk):
+        return base64.urlsafe_b64encode(f'{created_at.isoformat()}|{pk}'.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            return datetime.fromisoformat(created_at), int(pk)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise ValidationError({self.cursor_query_param: 'Некорректный курсор'})
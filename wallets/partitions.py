@@ -0,0 +1,133 @@
+"""
+Помесячные разделы таблицы операций.
+
+Таблица wallets_operation секционирована по created_at (RANGE). Разделы
+называются wallets_operation_yYYYYmMM и покрывают календарный месяц по UTC.
+Раздел wallets_operation_legacy - исходная таблица со всеми операциями до
+перехода на разделы, wallets_operation_default принимает строки, для
+месяца которых раздел еще не создан.
+
+Модуль не зависит от моделей и используется в миграции. Функции работают
+в базе переданного курсора (шарды кошельков, wallets/sharding.py).
+"""
+import gzip
+import os
+import re
+from datetime import date, datetime, timezone
+
+from django.db import transaction
+
+from wallets.ledger_io import copy_to
+
+TABLE = 'wallets_operation'
+LEGACY = f'{TABLE}_legacy'
+DEFAULT = f'{TABLE}_default'
+
+
+def month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def month_bound(month: date) -> datetime:
+    """
+    Начало месяца по UTC - граница раздела
+    """
+    return datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+
+
+def partition_name(month: date) -> str:
+    return f'{TABLE}_y{month.year}m{month.month:02d}'
+
+
+def list_partitions(cursor):
+    """
+    Разделы таблицы операций: [(имя, нижняя граница, верхняя граница)].
+    Граница None - MINVALUE; у раздела по умолчанию обе границы None.
+    Таблица ищется по search_path соединения, как и в остальных запросах.
+    """
+    cursor.execute(
+        """
+        SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+        FROM pg_inherits
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = %s::regclass
+        ORDER BY child.relname
+        """,
+        [TABLE]
+    )
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = re.match(r"FOR VALUES FROM \((.+)\) TO \((.+)\)", bound)
+        lower, upper = (None, None) if match is None else (parse_bound(match[1]), parse_bound(match[2]))
+        partitions.append((name, lower, upper))
+    return partitions
+
+
+def parse_bound(value: str):
+    if value == 'MINVALUE':
+        return None
+    return datetime.fromisoformat(value.strip("'"))
+
+
+def is_covered(partitions, moment: datetime) -> bool:
+    """
+    Попадает ли момент в диапазон одного из разделов (кроме раздела по умолчанию)
+    """
+    return any(
+        upper is not None and (lower is None or lower <= moment) and moment < upper
+        for name, lower, upper in partitions
+    )
+
+
+def create_partition(cursor, month: date) -> bool:
+    """
+    Создание раздела месяца. Строки этого месяца, уже попавшие в раздел
+    по умолчанию, переносятся в новый раздел. Возвращает False, если
+    месяц уже покрыт разделом.
+    """
+    name = partition_name(month)
+    lower, upper = month_bound(month), month_bound(add_months(month, 1))
+    if is_covered(list_partitions(cursor), lower):
+        return False
+    with transaction.atomic(using=cursor.db.alias):
+        cursor.execute(
+            f'SELECT EXISTS (SELECT 1 FROM {DEFAULT} WHERE created_at >= %s AND created_at < %s)', [lower, upper]
+        )
+        if cursor.fetchone()[0]:
+            cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)')
+            cursor.execute(
+                f'WITH moved AS (DELETE FROM {DEFAULT} WHERE created_at >= %s AND created_at < %s RETURNING *) '
+                f'INSERT INTO {name} SELECT * FROM moved',
+                [lower, upper]
+            )
+            cursor.execute(f'ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)', [lower, upper])
+        else:
+            cursor.execute(f'CREATE TABLE {name} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)', [lower, upper])
+    return True
+
+
+def archive_partition(cursor, name: str, archive_dir: str) -> str:
+    """
+    Выгрузка раздела в сжатый CSV, затем отсоединение и удаление.
+    Раздел с несвернутыми операциями (режим журнала) не архивируется:
+    их сумма еще не учтена в балансе кошелька.
+    """
+    cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {name} WHERE NOT compacted)')
+    if cursor.fetchone()[0]:
+        raise ValueError(f'В разделе {name} есть несвернутые операции')
+
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f'{name}.csv.gz')
+    with gzip.open(f'{path}.tmp', 'wb') as archive:
+        copy_to(cursor, f'COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)', archive)
+    os.replace(f'{path}.tmp', path)
+
+    with transaction.atomic(using=cursor.db.alias):
+        cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {name}')
+        cursor.execute(f'DROP TABLE {name}')
+    return path
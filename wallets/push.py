@@ -0,0 +1,255 @@
+"""
+Изменения баланса кошелька потоком вместо опроса GET .../<uuid>/.
+
+GET .../<uuid>/events/ - поток Server-Sent Events (WalletEventsView), тот же
+путь по WebSocket обслуживает websocket_application из config.asgi. Доступ -
+как к просмотру кошелька: владелец или администратор, JWT в заголовке
+Authorization. Оба потока работают только под ASGI-сервером.
+
+Событие несет состояние кошелька целиком: version, uuid, balance, owner.
+Источник - запись состояния в кэш после фиксации операции
+(Wallet.cache_state): кэш рассылает новую версию ожидающим (Redis - через
+канал кошелька одному подписчику процесса, кэш в памяти - в пределах
+процесса; записи других процессов он не видит, поэтому состояние
+перечитывается из базы каждые WALLET_LONG_POLL_INTERVAL секунд).
+
+Переподключение продолжает поток с версии: Last-Event-ID (EventSource
+отправляет его сам) или параметр version. Если кошелек уже изменился,
+его текущее состояние приходит сразу. Версии, вышедшие между событиями,
+сливаются в одно: последнее событие всегда актуально, отдельные операции -
+в истории .../operations/. Поток закрывается через WALLET_PUSH_MAX_AGE
+секунд или по истечении токена (клиент переподключается с новым токеном)
+и после события deleted - удаления кошелька.
+"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, QueryDict, StreamingHttpResponse
+from django.urls import Resolver404, resolve
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotAuthenticated, ValidationError
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from users.permissions import IsAdmin, IsOwner
+from wallets.cache import TOMBSTONE_VERSION, get_balance_cache
+from wallets.models import Wallet
+from wallets.serializers import compiled_wallet
+from wallets.sharding import aon_shard, on_wallet_shard
+from wallets.views import AsyncAPIView, aget_wallet_state
+
+# Пауза EventSource перед переподключением, миллисекунды
+RETRY_MS = 1000
+
+
+def parse_version(value):
+    """
+    Версия, с которой продолжается поток; None - с текущего состояния
+    """
+    if value in (None, ''):
+        return None
+    try:
+        version = int(value)
+    except ValueError:
+        version = -1
+    if version < 0:
+        raise ValidationError({'version': 'Должно быть неотрицательным целым числом'})
+    return version
+
+
+async def read_state(wallet_uuid, refresh: bool = False):
+    """
+    Состояние кошелька в его шарде; у удаленного - с balance None
+    """
+    try:
+        return await aon_shard(wallet_uuid, aget_wallet_state, wallet_uuid, get_balance_cache(), refresh)
+    except Http404:
+        return {'version': TOMBSTONE_VERSION, 'balance': None, 'owner': None}
+
+
+async def changes(wallet_uuid, version, seconds: float):
+    """
+    Состояния кошелька новее version по мере фиксации в течение seconds
+    секунд; None - пора отправить сигнал поддержания соединения
+    (WALLET_PUSH_HEARTBEAT секунд без событий). Удаленный кошелек
+    завершает поток.
+    """
+    cache = get_balance_cache()
+    deadline = time.monotonic() + min(seconds, settings.WALLET_PUSH_MAX_AGE)
+    state = await read_state(wallet_uuid)
+    sent = time.monotonic()
+    while True:
+        if version is None or state['version'] > version:
+            version = state['version']
+            sent = time.monotonic()
+            yield state
+            if state['balance'] is None:
+                return
+        elif time.monotonic() - sent >= settings.WALLET_PUSH_HEARTBEAT:
+            sent = time.monotonic()
+            yield None
+
+        if deadline <= time.monotonic():
+            return
+        remaining = min(deadline, sent + settings.WALLET_PUSH_HEARTBEAT) - time.monotonic()
+        if not cache.shared:
+            remaining = min(remaining, settings.WALLET_LONG_POLL_INTERVAL)
+        changed = await cache.await_change(wallet_uuid, version, max(remaining, 0))
+        state = await read_state(wallet_uuid, refresh=not changed and not cache.shared)
+
+
+def event(wallet_uuid, state) -> dict:
+    """
+    Событие состояния кошелька
+    """
+    if state['balance'] is None:
+        return {'event': 'deleted', 'version': state['version'], 'data': {'uuid': str(wallet_uuid)}}
+    wallet = Wallet(uuid=wallet_uuid, balance=state['balance'], owner_id=state['owner'])
+    return {'event': 'balance', 'version': state['version'], 'data': compiled_wallet.to_representation(wallet)}
+
+
+def render(data) -> bytes:
+    # Рендерер JSON из настроек REST_FRAMEWORK (первый в списке), как у AsyncAPIView
+    return api_settings.DEFAULT_RENDERER_CLASSES[0]().render(data)
+
+
+def token_seconds(token) -> float:
+    """
+    Сколько секунд действителен токен
+    """
+    return token['exp'] - time.time() if token is not None and 'exp' in token else settings.WALLET_PUSH_MAX_AGE
+
+
+class WalletEventsView(AsyncAPIView):
+    """
+    Изменения баланса кошелька потоком Server-Sent Events
+    """
+    permission_classes = (IsAdmin | IsOwner,)
+    token = None
+
+    async def authenticate(self, request):
+        # Токен нужен потоку: он закрывается, когда токен истекает
+        result = await self.authentication_class().aauthenticate(request)
+        if result is None:
+            return AnonymousUser()
+        user, self.token = result
+        return user
+
+    @on_wallet_shard
+    async def get(self, request, wallet_uuid):
+        if not isinstance(request, ASGIRequest):
+            # Под WSGI бесконечный поток собирался бы в память целиком
+            return Response(
+                {'error': 'Поток событий доступен только под ASGI-сервером'},
+                status=status.HTTP_501_NOT_IMPLEMENTED
+            )
+        version = parse_version(request.headers.get('Last-Event-ID', request.GET.get('version')))
+        state = await aget_wallet_state(wallet_uuid)
+
+        # Проверка пермишенов для объекта
+        self.check_object_permissions(request, Wallet(uuid=wallet_uuid, owner_id=state['owner']))
+
+        stream = changes(wallet_uuid, version, token_seconds(self.token))
+        return StreamingHttpResponse(
+            self.events(wallet_uuid, stream),
+            content_type='text/event-stream',
+            # Без буферизации в nginx: событие уходит клиенту сразу
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    @staticmethod
+    async def events(wallet_uuid, stream):
+        # Заголовки ответа уходят сразу, до первого изменения
+        yield f'retry: {RETRY_MS}\n\n'.encode()
+        async for state in stream:
+            if state is None:
+                yield b': keep-alive\n\n'
+                continue
+            item = event(wallet_uuid, state)
+            yield f'id: {item["version"]}\nevent: {item["event"]}\ndata: '.encode() + render(item['data']) + b'\n\n'
+
+
+def websocket_request(scope):
+    """
+    Заголовки и параметры соединения в виде запроса для аутентификации и пермишенов
+    """
+    meta = {}
+    for name, value in scope.get('headers', []):
+        meta['HTTP_' + name.decode('latin1').upper().replace('-', '_')] = value.decode('latin1')
+    return SimpleNamespace(META=meta, GET=QueryDict(scope.get('query_string', b'').decode('latin1')), user=None)
+
+
+async def websocket_application(scope, receive, send):
+    """
+    Поток изменений кошелька по WebSocket на пути WalletEventsView.
+
+    Версия для продолжения - параметр version. Сообщения - JSON
+    {"event": "balance" | "deleted", "version": ..., "data": {...}}.
+    Отказ закрывает соединение после принятия с кодом 4000 + HTTP-статус
+    (4401 - нужен новый токен, 4403, 4404) и текстом ошибки; окончание
+    потока - с кодом 1000. Ping-кадры поддержания соединения отправляет
+    ASGI-сервер.
+    """
+    if (await receive())['type'] != 'websocket.connect':
+        return
+    try:
+        match = resolve(scope['path'])
+    except Resolver404:
+        match = None
+    if match is None or getattr(match.func, 'view_class', None) is not WalletEventsView:
+        # До принятия: сервер отвечает на рукопожатие 403
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+
+    wallet_uuid = match.kwargs['wallet_uuid']
+    await send({'type': 'websocket.accept'})
+    try:
+        stream = await websocket_stream(scope, wallet_uuid)
+    except (APIException, Http404) as exc:
+        code = exc.status_code if isinstance(exc, APIException) else status.HTTP_404_NOT_FOUND
+        reason = str(exc.detail if isinstance(exc, APIException) else exc)
+        await send({'type': 'websocket.close', 'code': 4000 + code, 'reason': reason[:120]})
+        return
+
+    async def forward():
+        async for state in stream:
+            if state is not None:
+                await send({'type': 'websocket.send', 'text': render(event(wallet_uuid, state)).decode()})
+
+    async def disconnected():
+        # Сообщения клиента не нужны: ждем только закрытия
+        while (await receive())['type'] != 'websocket.disconnect':
+            pass
+
+    sender, receiver = asyncio.ensure_future(forward()), asyncio.ensure_future(disconnected())
+    try:
+        done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        sender.cancel()
+        receiver.cancel()
+        await asyncio.gather(sender, receiver, return_exceptions=True)
+    if sender in done:
+        code = 1000 if sender.exception() is None else 1011
+        await send({'type': 'websocket.close', 'code': code})
+        sender.result()
+
+
+async def websocket_stream(scope, wallet_uuid):
+    """
+    Аутентификация и проверка доступа как у WalletEventsView; поток изменений
+    """
+    request = websocket_request(scope)
+    view = WalletEventsView()
+    result = await view.authentication_class().aauthenticate(request)
+    if result is None:
+        raise NotAuthenticated()
+    request.user, token = result
+    version = parse_version(request.GET.get('version'))
+    view.check_permissions(request)
+    state = await aon_shard(wallet_uuid, aget_wallet_state, wallet_uuid)
+    view.check_object_permissions(request, Wallet(uuid=wallet_uuid, owner_id=state['owner']))
+    return changes(wallet_uuid, version, token_seconds(token))
@@ -0,0 +1,292 @@
+"""
+Чтение с реплик базы.
+
+ReplicaRoutingMiddleware выбирает для запроса с безопасным методом (GET,
+HEAD, OPTIONS) одну из реплик DATABASE_REPLICAS, и ReplicaRouter
+отправляет на нее чтения ORM и Wallet.get_states. Запись, запросы с
+изменением данных, чтения внутри транзакции и все вне HTTP-запросов
+(команды, фоновые задачи) идут в default. Асинхронные представления
+читают через async_db с основной базы.
+
+Чтение своих записей: после успешного запроса с изменением клиент
+(пользователь из JWT, сессия) закрепляется за основной базой на
+REPLICA_PIN_SECONDS секунд вместе с LSN своей записи
+(pg_current_wal_lsn()). Закрепленный клиент читает с реплики, которая уже
+воспроизвела этот LSN (pg_last_wal_replay_lsn(), опрос реплики не чаще
+раза в REPLICA_LSN_CHECK_INTERVAL секунд), иначе - с основной базы; если
+LSN неизвестен - с основной базы все окно. Закрепления хранятся в Redis
+(REDIS_URL), общие для всех процессов, иначе в памяти процесса.
+"""
+import contextvars
+import random
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+# Позиция сервера, который не воспроизводит журнал (основная база вместо реплики): догнал любой LSN
+NOT_IN_RECOVERY = float('inf')
+
+_replica = contextvars.ContextVar('wallet_read_replica', default=None)
+
+
+def parse_lsn(value: str) -> int:
+    """
+    LSN Postgres ('16/B374D848') в число для сравнения
+    """
+    high, low = value.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+class ReplicaRouter:
+    """
+    Чтения - на реплику, выбранную для текущего запроса; запись - всегда в default
+    """
+
+    def db_for_read(self, model, **hints):
+        alias = _replica.get()
+        if alias is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        # Иначе Django пишет экземпляр в базу, из которой он прочитан
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики - копии default: связи между их объектами допустимы
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class BasePins:
+    """
+    Закрепления клиентов за основной базой: ключ клиента -> LSN записи
+    (0 - неизвестен), пока не истечет окно закрепления
+    """
+    name = None
+    shared = False
+
+    def pin(self, keys, lsn: int, seconds: float):
+        raise NotImplementedError
+
+    def pinned(self, keys):
+        """
+        Наибольший LSN живых закреплений ключей; None - клиент не закреплен
+        """
+        raise NotImplementedError
+
+
+class LocalPins(BasePins):
+    """
+    Закрепления в памяти процесса - замена Redis, когда REDIS_URL не задан
+    """
+    name = 'local'
+    # Размер таблицы, после которого из нее удаляются истекшие закрепления
+    prune_size = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # ключ -> (истекает, LSN)
+        self.entries = {}
+
+    def pin(self, keys, lsn, seconds):
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                self.entries[key] = (now + seconds, max(lsn, entry[1]) if entry and entry[0] > now else lsn)
+            if len(self.entries) > self.prune_size:
+                for key in [key for key, (expires, _) in self.entries.items() if expires <= now]:
+                    del self.entries[key]
+
+    def pinned(self, keys):
+        now = time.monotonic()
+        with self.lock:
+            positions = [entry[1] for entry in map(self.entries.get, keys) if entry is not None and entry[0] > now]
+        return max(positions, default=None)
+
+
+class RedisPins(BasePins):
+    """
+    Закрепления в Redis, общие для всех процессов. Если Redis недоступен,
+    клиент считается закрепленным с неизвестным LSN: чтение с основной базы.
+    """
+    name = 'redis'
+    shared = True
+
+    prefix = 'wallet:replica:pin:'
+
+    def __init__(self, url: str):
+        import redis
+
+        self.errors = redis.RedisError
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+
+    def pin(self, keys, lsn, seconds):
+        try:
+            with self.client.pipeline(transaction=False) as pipeline:
+                for key in keys:
+                    pipeline.set(self.prefix + key, lsn, px=int(seconds * 1000))
+                pipeline.execute()
+        except self.errors:
+            pass
+
+    def pinned(self, keys):
+        if not keys:
+            return None
+        try:
+            values = self.client.mget([self.prefix + key for key in keys])
+        except self.errors:
+            return 0
+        return max((int(value) for value in values if value is not None), default=None)
+
+
+_pins = None
+_pins_lock = threading.Lock()
+
+
+def get_pins() -> BasePins:
+    """
+    Закрепления процесса: Redis при заданном REDIS_URL, иначе в памяти
+    """
+    global _pins
+    if _pins is None:
+        with _pins_lock:
+            if _pins is None:
+                _pins = RedisPins(settings.REDIS_URL) if settings.REDIS_URL else LocalPins()
+    return _pins
+
+
+_positions = {}
+
+
+def replay_position(alias: str):
+    """
+    LSN, воспроизведенный репликой (не чаще раза в REPLICA_LSN_CHECK_INTERVAL);
+    None - реплика недоступна
+    """
+    checked = _positions.get(alias)
+    if checked is not None and time.monotonic() - checked[0] < settings.REPLICA_LSN_CHECK_INTERVAL:
+        return checked[1]
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute('SELECT pg_last_wal_replay_lsn()')
+            value = cursor.fetchone()[0]
+        position = NOT_IN_RECOVERY if value is None else parse_lsn(value)
+    except DatabaseError:
+        position = None
+    _positions[alias] = (time.monotonic(), position)
+    return position
+
+
+def current_lsn():
+    """
+    LSN записей основной базы для закрепления; 0, если в этом запросе
+    соединения Django с default не было (запись через async_db)
+    """
+    connection = connections[DEFAULT_DB_ALIAS]
+    if connection.connection is None:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_current_wal_lsn()')
+        return parse_lsn(cursor.fetchone()[0])
+
+
+def client_keys(request, response=None) -> list:
+    """
+    Ключи клиента для закрепления: пользователь из JWT (без обращения к
+    базе), сессия из запроса и новая сессия из ответа (вход в админку)
+    """
+    keys = []
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header is not None else None
+    if raw_token is not None:
+        try:
+            keys.append(f'user:{authentication.get_validated_token(raw_token)[jwt_settings.USER_ID_CLAIM]}')
+        except (InvalidToken, KeyError):
+            pass
+    session = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if session:
+        keys.append(f'session:{session}')
+    if response is not None and settings.SESSION_COOKIE_NAME in response.cookies:
+        session = response.cookies[settings.SESSION_COOKIE_NAME].value
+        if session:
+            keys.append(f'session:{session}')
+    return keys
+
+
+def choose_replica(request):
+    """
+    Реплика для чтений запроса; None - читать с основной базы
+    """
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        # Чтения в транзакции маршрутизатор все равно отправит в default
+        return None
+    pinned = get_pins().pinned(client_keys(request))
+    if pinned == 0:
+        return None
+    candidates = [
+        alias for alias in settings.DATABASE_REPLICAS
+        if (position := replay_position(alias)) is not None and (pinned is None or position >= pinned)
+    ]
+    return random.choice(candidates) if candidates else None
+
+
+def pin_client(request, response):
+    """
+    Закрепление клиента за основной базой после успешного запроса с изменением
+    """
+    keys = client_keys(request, response)
+    if keys:
+        get_pins().pin(keys, current_lsn(), settings.REPLICA_PIN_SECONDS)
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Выбор базы для чтений запроса и закрепление клиента после его записей.
+    В асинхронном стеке выбор и закрепление (запросы к базе и Redis) идут в потоке.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if request.method not in SAFE_METHODS:
+            response = self.get_response(request)
+            if response.status_code < 400:
+                pin_client(request, response)
+            return response
+        token = _replica.set(choose_replica(request))
+        try:
+            return self.get_response(request)
+        finally:
+            _replica.reset(token)
+
+    async def __acall__(self, request):
+        if request.method not in SAFE_METHODS:
+            response = await self.get_response(request)
+            if response.status_code < 400:
+                await sync_to_async(pin_client)(request, response)
+            return response
+        token = _replica.set(await sync_to_async(choose_replica)(request))
+        try:
+            return await self.get_response(request)
+        finally:
+            _replica.reset(token)
@@ -1,13 +1,23 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
 from rest_framework import serializers
 from rest_framework.serializers import ModelSerializer
 
-from wallets.models import Operation, Wallet
+from users.serializers import ClaimsTokenObtainPairSerializer
+from wallets.compiled import CompiledSerializer
+from wallets.models import Operation, QueuedOperation, Wallet, WalletDirectory
+from wallets.sharding import placement, use_shard
 
 
 class WalletSerializer(ModelSerializer):
     """
     Сериализатор модели Wallet
     """
+    # Сумма суб-балансов для разделенного кошелька
+    balance = serializers.DecimalField(max_digits=20, decimal_places=2, source='get_balance', read_only=True)
+
     class Meta:
         model = Wallet
         fields = ('uuid', 'balance', 'owner')
@@ -23,7 +33,10 @@ class WalletCreateSerializer(ModelSerializer):
     def create(self, validated_data):
         # Добавляем текущего пользователя в данные для сохранения
         validated_data['owner'] = self.context['request'].user
-        return super().create(validated_data)
+        # Кошелек создается в шарде, который выбирает его uuid
+        validated_data['uuid'] = uuid.uuid4()
+        with use_shard(placement(validated_data['uuid'])):
+            return super().create(validated_data)
 
 
 class OperationSerializer(ModelSerializer):
@@ -41,3 +54,138 @@ class OperationSerializer(ModelSerializer):
         if value <= 0:
             raise serializers.ValidationError('Сумма должна быть положительной')
         return value
+
+
+class OperationHistorySerializer(ModelSerializer):
+    """
+    Сериализатор операции в истории кошелька
+    """
+    class Meta:
+        model = Operation
+        fields = ('id', 'operation_type', 'amount', 'created_at')
+
+
+class QueuedOperationSerializer(ModelSerializer):
+    """
+    Сериализатор статуса операции, принятой в асинхронном режиме
+    """
+    wallet_uuid = serializers.UUIDField(source='wallet_id')
+
+    class Meta:
+        model = QueuedOperation
+        fields = (
+            'id', 'wallet_uuid', 'operation_type', 'amount', 'status', 'balance', 'error', 'created_at', 'processed_at'
+        )
+
+
+class OperationFilterSerializer(serializers.Serializer):
+    """
+    Фильтры истории операций: тип и полуинтервал времени [created_after, created_before)
+    """
+    operation_type = serializers.ChoiceField(choices=Operation.OPERATION_TYPES, required=False)
+    created_after = serializers.DateTimeField(required=False)
+    created_before = serializers.DateTimeField(required=False)
+
+
+class BatchOperationItemSerializer(OperationSerializer):
+    """
+    Сериализатор операции в пачке
+    """
+    wallet_uuid = serializers.UUIDField()
+
+    class Meta(OperationSerializer.Meta):
+        fields = ('wallet_uuid', 'operation_type', 'amount')
+
+
+class BatchOperationSerializer(serializers.Serializer):
+    """
+    Сериализатор пачки операций
+    """
+    ALL_OR_NOTHING = 'all_or_nothing'
+    PER_ITEM = 'per_item'
+    MODES = [
+        (ALL_OR_NOTHING, 'All or nothing'),
+        (PER_ITEM, 'Per item'),
+    ]
+
+    mode = serializers.ChoiceField(choices=MODES, default=ALL_OR_NOTHING)
+    operations = BatchOperationItemSerializer(
+        many=True,
+        allow_empty=False,
+        max_length=settings.WALLET_BATCH_MAX_SIZE
+    )
+
+
+class TransferSerializer(OperationSerializer):
+    """
+    Сериализатор перевода между кошельками
+    """
+    source = serializers.UUIDField()
+    destination = serializers.UUIDField()
+
+    class Meta(OperationSerializer.Meta):
+        fields = ('source', 'destination', 'amount')
+
+    def validate(self, attrs):
+        if attrs['source'] == attrs['destination']:
+            raise serializers.ValidationError('Кошельки перевода должны различаться')
+        return attrs
+
+
+class StatementFilterSerializer(serializers.Serializer):
+    """
+    Интервал выписки: дни [from, to] по UTC, по умолчанию - последние 30 дней
+    """
+
+    def get_fields(self):
+        # from - ключевое слово, поля нельзя объявить атрибутами класса
+        return {
+            'from': serializers.DateField(required=False),
+            'to': serializers.DateField(required=False),
+        }
+
+    def validate(self, attrs):
+        date_to = attrs.get('to') or datetime.now(timezone.utc).date()
+        date_from = attrs.get('from') or date_to - timedelta(days=29)
+        if date_from > date_to:
+            raise serializers.ValidationError('Начало интервала позже конца')
+        if (date_to - date_from).days >= settings.WALLET_STATEMENT_MAX_DAYS:
+            raise serializers.ValidationError(f'Интервал длиннее {settings.WALLET_STATEMENT_MAX_DAYS} дней')
+        return {'from': date_from, 'to': date_to}
+
+
+class StatementTotalSerializer(serializers.Serializer):
+    """
+    Итоги выписки: суммы и число пополнений и списаний
+    """
+    deposited = serializers.DecimalField(max_digits=20, decimal_places=2)
+    deposits = serializers.IntegerField()
+    withdrawn = serializers.DecimalField(max_digits=20, decimal_places=2)
+    withdrawals = serializers.IntegerField()
+
+
+class StatementDaySerializer(StatementTotalSerializer):
+    """
+    Итоги дня в выписке
+    """
+    day = serializers.DateField()
+
+
+# Сериализаторы горячих путей (баланс, операция, перевод) с полями, созданными один раз
+class WalletTokenObtainPairSerializer(ClaimsTokenObtainPairSerializer):
+    """
+    Пара токенов с кошельком пользователя: IsOwner проверяет его без запроса к базе
+    """
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        # Кошелек пользователя в любом шарде - по справочнику в default
+        wallet = WalletDirectory.objects.filter(owner=user).values_list('wallet_uuid', flat=True).first()
+        token['wallet'] = str(wallet) if wallet is not None else None
+        return token
+
+
+compiled_wallet = CompiledSerializer(WalletSerializer)
+compiled_operation = CompiledSerializer(OperationSerializer)
+compiled_transfer = CompiledSerializer(TransferSerializer)
@@ -0,0 +1,242 @@
+"""
+Горизонтальное шардирование кошельков.
+
+Кошелек со всеми его данными (суб-балансы, операции, ключи идемпотентности,
+дневные итоги) живет в одной базе из WALLET_SHARDS. Новый кошелек
+создается в шарде placement(uuid) - рандеву-хэширование uuid по списку
+шардов: при добавлении шарда на новое место претендует только часть
+кошельков, их переносит команда rebalance_wallets.
+
+Где живет кошелек, записано в справочнике WalletDirectory в default: одна
+строка на кошелек, уникальная по владельцу - так правило «один кошелек на
+пользователя» действует во всех шардах. locate читает справочник с
+кэшем в памяти процесса; кэш после переноса кошелька устаревает, поэтому
+обработчик, не нашедший кошелек (404) в шарде из кэша, перечитывает
+справочник и повторяется в новом шарде (on_shard, on_wallet_shard).
+
+Шард запроса хранится в контекстной переменной: ShardRouter направляет в
+него ORM-запросы моделей кошельков, wallet_db() и atomic() - SQL-запросы и
+транзакции методов моделей и движков. С одним шардом (по умолчанию) все
+идет в default, справочник только ведется.
+"""
+import contextvars
+import functools
+import hashlib
+import uuid
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.http import Http404
+
+DIRECTORY = 'wallets_walletdirectory'
+# Ошибки обработчика, после которых кошелек ищется заново: его могли перенести в другой шард
+MOVED_ERRORS = (Http404, ObjectDoesNotExist, IntegrityError)
+
+_shard = contextvars.ContextVar('wallet_shard', default=None)
+# uuid кошелька -> шард, при переполнении очищается
+_locations = {}
+LOCATIONS_SIZE = 100000
+
+
+def sharded() -> bool:
+    return len(settings.WALLET_SHARDS) > 1
+
+
+def wallet_db() -> str:
+    """
+    База кошелька текущего запроса
+    """
+    return _shard.get() or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def use_shard(alias: str):
+    """
+    Запросы моделей кошельков внутри блока - в базу alias
+    """
+    token = _shard.set(alias)
+    try:
+        yield
+    finally:
+        _shard.reset(token)
+
+
+def atomic(func=None):
+    """
+    transaction.atomic в базе кошелька текущего запроса; как и он, работает
+    и менеджером контекста, и декоратором (база выбирается при вызове)
+    """
+    if func is None:
+        return transaction.atomic(using=wallet_db())
+
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        with transaction.atomic(using=wallet_db()):
+            return func(*args, **kwargs)
+
+    return inner
+
+
+def placement(wallet_uuid) -> str:
+    """
+    Шард, в котором должен жить кошелек: наибольший хэш (шард, uuid)
+    """
+    if not sharded():
+        return settings.WALLET_SHARDS[0]
+    key = str(uuid.UUID(str(wallet_uuid))).encode()
+    return max(
+        settings.WALLET_SHARDS,
+        key=lambda alias: hashlib.blake2b(alias.encode() + b'/' + key, digest_size=8).digest()
+    )
+
+
+def remember(wallet_uuid, alias: str):
+    if len(_locations) >= LOCATIONS_SIZE:
+        _locations.clear()
+    _locations[str(wallet_uuid)] = alias
+
+
+def forget(wallet_uuid):
+    _locations.pop(str(wallet_uuid), None)
+
+
+def locate_many(wallet_uuids, refresh: bool = False) -> dict:
+    """
+    Шарды кошельков {str(uuid): шард} по справочнику одним запросом.
+    Кошелек без записи (неизвестный) ищется в default.
+    """
+    keys = {str(wallet_uuid) for wallet_uuid in wallet_uuids}
+    if not sharded():
+        return dict.fromkeys(keys, DEFAULT_DB_ALIAS)
+    found = {} if refresh else {key: _locations[key] for key in keys if key in _locations}
+    missing = keys - found.keys()
+    if missing:
+        with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+            cursor.execute(
+                f'SELECT wallet_uuid, alias FROM {DIRECTORY} WHERE wallet_uuid = ANY(%s)',
+                [[uuid.UUID(key) for key in missing]]
+            )
+            rows = {str(wallet_uuid): alias for wallet_uuid, alias in cursor.fetchall()}
+        for key in missing:
+            found[key] = rows.get(key, DEFAULT_DB_ALIAS)
+            remember(key, found[key])
+    return found
+
+
+def locate(wallet_uuid, refresh: bool = False) -> str:
+    """
+    Шард кошелька; refresh - мимо кэша процесса
+    """
+    return locate_many([wallet_uuid], refresh)[str(wallet_uuid)]
+
+
+async def alocate(wallet_uuid, refresh: bool = False) -> str:
+    """
+    locate для асинхронного кода: справочник читается через асинхронный пул
+    """
+    if not sharded():
+        return DEFAULT_DB_ALIAS
+    key = str(wallet_uuid)
+    if not refresh and key in _locations:
+        return _locations[key]
+    from wallets import async_db
+
+    row = await async_db.fetchone(
+        f'SELECT alias FROM {DIRECTORY} WHERE wallet_uuid = %s', [uuid.UUID(key)], using=DEFAULT_DB_ALIAS
+    )
+    alias = row[0] if row is not None else DEFAULT_DB_ALIAS
+    remember(key, alias)
+    return alias
+
+
+def on_shard(wallet_uuid, func, /, *args, **kwargs):
+    """
+    Вызов func в шарде кошелька. Если кошелек не найден, а справочник
+    указывает уже на другой шард (кошелек перенесли), вызов повторяется там.
+    """
+    alias = locate(wallet_uuid)
+    try:
+        with use_shard(alias):
+            return func(*args, **kwargs)
+    except MOVED_ERRORS:
+        if locate(wallet_uuid, refresh=True) == alias:
+            raise
+    with use_shard(locate(wallet_uuid)):
+        return func(*args, **kwargs)
+
+
+async def aon_shard(wallet_uuid, func, /, *args, **kwargs):
+    """
+    on_shard для корутины func
+    """
+    alias = await alocate(wallet_uuid)
+    try:
+        with use_shard(alias):
+            return await func(*args, **kwargs)
+    except MOVED_ERRORS:
+        if await alocate(wallet_uuid, refresh=True) == alias:
+            raise
+    with use_shard(await alocate(wallet_uuid)):
+        return await func(*args, **kwargs)
+
+
+def on_wallet_shard(handler):
+    """
+    Декоратор обработчика представления с uuid кошелька в URL (wallet_uuid
+    или uuid): обработчик выполняется в шарде кошелька
+    """
+    if iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def async_inner(view, request, *args, **kwargs):
+            wallet_uuid = kwargs.get('wallet_uuid', kwargs.get('uuid'))
+            return await aon_shard(wallet_uuid, handler, view, request, *args, **kwargs)
+
+        return async_inner
+
+    @functools.wraps(handler)
+    def inner(view, request, *args, **kwargs):
+        return on_shard(kwargs.get('wallet_uuid', kwargs.get('uuid')), handler, view, request, *args, **kwargs)
+
+    return inner
+
+
+class ShardRouter:
+    """
+    Модели кошельков - в шард текущего запроса (или в базу, из которой
+    прочитан экземпляр), справочник - всегда в default. В default маршрутизатор
+    решение не принимает: его чтения может отправить на реплику ReplicaRouter.
+    """
+
+    @staticmethod
+    def route(model, hints):
+        instance = hints.get('instance')
+        if model._meta.app_label != 'wallets':
+            # Иначе Django ищет связанный объект (владельца кошелька) в базе экземпляра
+            if instance is not None and instance._state.db in settings.WALLET_SHARDS[1:]:
+                return DEFAULT_DB_ALIAS
+            return None
+        if model._meta.db_table == DIRECTORY:
+            return DEFAULT_DB_ALIAS
+        alias = _shard.get()
+        if alias is None and instance is not None:
+            alias = instance._state.db
+        return alias if alias != DEFAULT_DB_ALIAS else None
+
+    def db_for_read(self, model, **hints):
+        return self.route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.route(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Владелец кошелька (default) и кошелек (шард) связаны без внешнего ключа
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Схема всех приложений - в каждом шарде, справочник - только в default
+        if app_label == 'wallets' and model_name == 'walletdirectory':
+            return db == DEFAULT_DB_ALIAS
+        return None
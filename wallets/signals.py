@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+
+from users.models import User
+from wallets.models import Wallet, WalletDirectory
+from wallets.sharding import forget
+
+
+@receiver(post_delete, sender=Wallet)
+def unregister_wallet(sender, instance, using, **kwargs):
+    """
+    Удаленный кошелек уходит из справочника; запись другой базы (кошелек
+    уже перенесли, удалена копия) не трогается
+    """
+    WalletDirectory.objects.filter(wallet_uuid=instance.pk, alias=using).delete()
+    forget(instance.pk)
+
+
+@receiver(pre_delete, sender=User)
+def delete_sharded_wallets(sender, instance, **kwargs):
+    """
+    Каскад удаления пользователя в default не видит кошельков других шардов
+    """
+    for alias in settings.WALLET_SHARDS:
+        if alias != DEFAULT_DB_ALIAS:
+            Wallet.objects.using(alias).filter(owner_id=instance.pk).delete()
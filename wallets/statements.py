@@ -0,0 +1,85 @@
+"""
+Дневные итоги операций кошельков (wallets_dailystatement).
+
+Итоги поддерживает триггер уровня оператора на вставку в таблицу операций:
+одна вставка итогов на пару (кошелек, день) каждого INSERT, в той же
+транзакции, включая bulk_create и загрузку import_ledger. Строки итогов
+блокируются в порядке (кошелек, день), поэтому пачки не создают взаимных
+блокировок. Сутки - по UTC, как у разделов операций.
+
+Модуль не зависит от моделей и используется в миграции.
+"""
+from datetime import date, datetime, time, timezone
+
+TABLE = 'wallets_dailystatement'
+OPERATIONS = 'wallets_operation'
+# Число слотов итогов дня, DailyStatement.SLOTS
+SLOTS = 8
+
+TOTALS = """
+    wallet_id, (created_at AT TIME ZONE 'UTC')::date AS day, {slot},
+    COALESCE(SUM(amount) FILTER (WHERE operation_type = 'DEPOSIT'), 0),
+    COUNT(*) FILTER (WHERE operation_type = 'DEPOSIT'),
+    COALESCE(SUM(amount) FILTER (WHERE operation_type = 'WITHDRAW'), 0),
+    COUNT(*) FILTER (WHERE operation_type = 'WITHDRAW')
+"""
+
+UPSERT = f"""
+    INSERT INTO {TABLE} (wallet_id, day, slot, deposit_total, deposit_count, withdraw_total, withdraw_count)
+    SELECT {{totals}} FROM {{source}}
+    GROUP BY wallet_id, day ORDER BY wallet_id, day
+    ON CONFLICT (wallet_id, day, slot) DO UPDATE SET
+        deposit_total = {TABLE}.deposit_total + excluded.deposit_total,
+        deposit_count = {TABLE}.deposit_count + excluded.deposit_count,
+        withdraw_total = {TABLE}.withdraw_total + excluded.withdraw_total,
+        withdraw_count = {TABLE}.withdraw_count + excluded.withdraw_count
+"""
+
+# Слот - по процессу соединения: разные соединения пишут итоги одного дня в разные строки
+CREATE_TRIGGER = f"""
+    CREATE FUNCTION wallets_statement_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        {UPSERT.format(totals=TOTALS.format(slot=f'pg_backend_pid() % {SLOTS}'), source='new_operations')};
+        RETURN NULL;
+    END
+    $$;
+    CREATE TRIGGER wallets_statement_insert AFTER INSERT ON {OPERATIONS}
+    REFERENCING NEW TABLE AS new_operations
+    FOR EACH STATEMENT EXECUTE FUNCTION wallets_statement_apply();
+"""
+
+DROP_TRIGGER = f"""
+    DROP TRIGGER IF EXISTS wallets_statement_insert ON {OPERATIONS};
+    DROP FUNCTION IF EXISTS wallets_statement_apply();
+"""
+
+
+def day_bound(day: date) -> datetime:
+    """
+    Начало суток по UTC
+    """
+    return datetime.combine(day, time(), tzinfo=timezone.utc)
+
+
+def rebuild(cursor, day_from: date, day_to: date) -> int:
+    """
+    Пересчет итогов за дни [day_from, day_to) из операций, вызывается в транзакции.
+
+    Итоги дней блокируются в порядке триггера и удаляются, пересчитанные
+    записываются в слот 0. Операции, зафиксированные после снимка запроса,
+    добавляют свои суммы триггером к пересчитанным строкам, поэтому
+    пересчет можно выполнять под нагрузкой. Возвращает число строк итогов.
+    """
+    cursor.execute(
+        f'SELECT 1 FROM {TABLE} WHERE day >= %s AND day < %s ORDER BY wallet_id, day, slot FOR UPDATE',
+        [day_from, day_to]
+    )
+    cursor.execute(f'DELETE FROM {TABLE} WHERE day >= %s AND day < %s', [day_from, day_to])
+    cursor.execute(
+        UPSERT.format(
+            totals=TOTALS.format(slot=0),
+            source=f'{OPERATIONS} WHERE created_at >= %s AND created_at < %s'
+        ),
+        [day_bound(day_from), day_bound(day_to)]
+    )
+    return cursor.rowcount
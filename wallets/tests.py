@@ -1,10 +1,55 @@
-from django.test import override_settings
-from django.urls import reverse
-from rest_framework.test import APITestCase
+import asyncio
+import csv
+import functools
+import gzip
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from datetime import date, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections, router, transaction
+from django.db.models import F, Q, Sum
+from django.db.models.functions import TruncDate
+from django.http import QueryDict
+from django.test import AsyncRequestFactory, override_settings, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from psycopg_pool import ConnectionPool, PoolTimeout
+from django.utils import timezone
+from rest_framework.exceptions import ErrorDetail, ParseError, ValidationError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APITestCase
 from rest_framework import status
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
 
-from wallets.models import Wallet
-from users.models import User
+from wallets import admission, async_db, engines, ledger_io, operation_queue, partitions, replicas, sharding
+from wallets.admin import OperationAdmin
+from wallets.admin_utils import SkipScanQuerySet
+from wallets.cache import LocalBalanceCache, RedisBalanceCache, get_balance_cache
+from wallets.contention import SpaceSaving, metric_key, telemetry
+from wallets.engines import get_engine, ENGINES, CombinerEngine, PendingOperation, transfer
+from wallets.metrics import RequestMetricsMiddleware, registry
+from wallets.models import Wallet, WalletDirectory, Operation, IdempotencyKey, DailyStatement, QueuedOperation
+from wallets.renderers import ORJSONParser, ORJSONRenderer
+from wallets.serializers import (
+    OperationSerializer, TransferSerializer, WalletSerializer, compiled_operation, compiled_transfer, compiled_wallet
+)
+from wallets.push import WalletEventsView
+from wallets.views import DatabasePoolStatsView, WalletOperationAsyncView, WalletRetrieveAsyncView
+from users.denylist import TokenDenylist, get_token_denylist
+from users.models import RevokedToken, User
 
 
 @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
@@ -141,3 +186,2492 @@ class OperationTests(APITestCase):
         data = {'operation_type': 'DEPOSIT', 'amount': '-500.00'}
         response = self.client.post(url, data)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_operation_wallet_not_found(self):
+        """Тест операции с несуществующим кошельком"""
+        url = reverse('wallets:wallet_operation', args=[uuid.uuid4()])
+        data = {'operation_type': 'DEPOSIT', 'amount': '500.00'}
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_operation_logged(self):
+        """Тест записи операции в журнал вместе с изменением баланса"""
+        url = reverse('wallets:wallet_operation', args=[self.wallet.uuid])
+        response = self.client.post(url, {'operation_type': 'DEPOSIT', 'amount': '500.00'})
+        self.assertEqual(response.data['balance'], Decimal('1500.00'))
+        self.client.post(url, {'operation_type': 'WITHDRAW', 'amount': '5000.00'})
+        self.assertEqual(
+            list(Operation.objects.values_list('operation_type', 'amount')),
+            [('DEPOSIT', Decimal('500.00'))]
+        )
+
+    @override_settings(WALLET_OPERATION_ENGINE='locking')
+    def test_locking_engine(self):
+        """Тест исходного движка с блокировкой строки"""
+        url = reverse('wallets:wallet_operation', args=[self.wallet.uuid])
+        response = self.client.post(url, {'operation_type': 'WITHDRAW', 'amount': '400.00'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['balance'], Decimal('600.00'))
+        response = self.client.post(url, {'operation_type': 'WITHDRAW', 'amount': '700.00'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Operation.objects.count(), 1)
+
+
+class ShardedWalletTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(
+            email='test1@example.com',
+            password='qwe123',
+            first_name='Jon',
+            last_name='Snow'
+        )
+        self.wallet = Wallet.objects.create(owner=self.user, balance=1000.00)
+        self.wallet.set_shard_count(4)
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('wallets:wallet_operation', args=[self.wallet.uuid])
+
+    def test_enable_sharding(self):
+        """Тест переноса баланса в суб-балансы"""
+        self.assertEqual(self.wallet.balance, 0)
+        self.assertEqual(self.wallet.shards.count(), 4)
+        response = self.client.get(reverse('wallets:wallet_retrieve', args=[self.wallet.uuid]))
+        self.assertEqual(response.data['balance'], '1000.00')
+
+    def test_sharded_operations(self):
+        """Тест пополнения и списания, затрагивающего несколько суб-балансов"""
+        for engine in ENGINES:
+            with self.subTest(engine=engine), override_settings(WALLET_OPERATION_ENGINE=engine):
+                response = self.client.post(self.url, {'operation_type': 'DEPOSIT', 'amount': '500.00'})
+                self.assertEqual(response.data['balance'], Decimal('1500.00'))
+                response = self.client.post(self.url, {'operation_type': 'WITHDRAW', 'amount': '1200.00'})
+                self.assertEqual(response.data['balance'], Decimal('300.00'))
+                response = self.client.post(self.url, {'operation_type': 'WITHDRAW', 'amount': '301.00'})
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn('Недостаточно средств', response.content.decode('utf-8'))
+                self.client.post(self.url, {'operation_type': 'DEPOSIT', 'amount': '700.00'})
+        self.assertEqual(self.wallet.get_balance(), Decimal('1000.00'))
+        self.assertEqual(self.wallet.operations.count(), 3 * len(ENGINES))
+
+    def test_disable_sharding(self):
+        """Тест отключения суб-балансов"""
+        self.client.post(self.url, {'operation_type': 'DEPOSIT', 'amount': '500.00'})
+        self.wallet.set_shard_count(0)
+        self.assertEqual(self.wallet.balance, Decimal('1500.00'))
+        self.assertFalse(self.wallet.shards.exists())
+
+
+class LedgerWalletTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(
+            email='test1@example.com',
+            password='qwe123',
+            first_name='Jon',
+            last_name='Snow'
+        )
+        self.wallet = Wallet.objects.create(owner=self.user, balance=1000.00)
+        self.wallet.set_ledger_mode(True)
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('wallets:wallet_operation', args=[self.wallet.uuid])
+
+    def test_ledger_operations(self):
+        """Тест пополнения и списания в режиме журнала"""
+        for engine in ENGINES:
+            with self.subTest(engine=engine), override_settings(WALLET_OPERATION_ENGINE=engine):
+                response = self.client.post(self.url, {'operation_type': 'DEPOSIT', 'amount': '500.00'})
+                self.assertEqual(response.data['balance'], Decimal('1500.00'))
+                response = self.client.post(self.url, {'operation_type': 'WITHDRAW', 'amount': '1200.00'})
+                self.assertEqual(response.data['balance'], Decimal('300.00'))
+                response = self.client.post(self.url, {'operation_type': 'WITHDRAW', 'amount': '301.00'})
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.client.post(self.url, {'operation_type': 'DEPOSIT', 'amount': '700.00'})
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('1000.00'))
+        self.assertEqual(self.wallet.get_balance(), Decimal('1000.00'))
+        self.assertEqual(self.wallet.operations.filter(compacted=False).count(), 3 * len(ENGINES))
+
+    def test_compact(self):
+        """Тест свертки журнала в снимок баланса"""
+        self.client.post(self.url, {'operation_type': 'DEPOSIT', 'amount': '500.00'})
+        self.client.post(self.url, {'operation_type': 'WITHDRAW', 'amount': '200.00'})
+        self.assertEqual(Wallet.compact(1), 1)
+        self.assertEqual(self.wallet.get_balance(), Decimal('1300.00'))
+        call_command('compact_ledger', stdout=StringIO())
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('1300.00'))
+        self.assertFalse(self.wallet.operations.filter(compacted=False).exists())
+        response = self.client.get(reverse('wallets:wallet_retrieve', args=[self.wallet.uuid]))
+        self.assertEqual(response.data['balance'], '1300.00')
+
+    def test_disable_ledger_mode(self):
+        """Тест отключения режима журнала"""
+        self.client.post(self.url, {'operation_type': 'DEPOSIT', 'amount': '500.00'})
+        self.wallet.set_ledger_mode(False)
+        self.assertEqual(self.wallet.balance, Decimal('1500.00'))
+        self.assertFalse(self.wallet.operations.filter(compacted=False).exists())
+
+    def test_sharded_wallet_rejected(self):
+        """Тест несовместимости режима журнала и суб-балансов"""
+        with self.assertRaises(ValidationError):
+            self.wallet.set_shard_count(2)
+
+
+class BatchOperationTests(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create(email='admin@example.com', is_staff=True, is_superuser=True)
+        self.first = Wallet.objects.create(
+            owner=User.objects.create(email='test1@example.com'), balance=Decimal('100.00')
+        )
+        self.second = Wallet.objects.create(
+            owner=User.objects.create(email='test2@example.com'), balance=Decimal('50.00')
+        )
+        self.client.force_authenticate(user=self.admin)
+        self.url = reverse('wallets:batch_operation')
+
+    def operations(self, *items):
+        return [
+            {'wallet_uuid': str(wallet.uuid), 'operation_type': operation_type, 'amount': amount}
+            for wallet, operation_type, amount in items
+        ]
+
+    def test_all_or_nothing_success(self):
+        """Тест успешного применения пачки операций"""
+        data = {'operations': self.operations(
+            (self.first, 'WITHDRAW', '80.00'),
+            (self.second, 'DEPOSIT', '80.00'),
+            (self.first, 'DEPOSIT', '10.00'),
+        )}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [result['balance'] for result in response.data['results']],
+            [Decimal('20.00'), Decimal('130.00'), Decimal('30.00')]
+        )
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertEqual((self.first.balance, self.second.balance), (Decimal('30.00'), Decimal('130.00')))
+        self.assertEqual(Operation.objects.count(), 3)
+
+    def test_all_or_nothing_failure(self):
+        """Тест отката всей пачки при ошибке в одной операции"""
+        data = {'operations': self.operations(
+            (self.second, 'DEPOSIT', '80.00'),
+            (self.first, 'WITHDRAW', '180.00'),
+        )}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['errors'][0]['index'], 1)
+        self.assertEqual(response.data['errors'][0]['error'], 'Недостаточно средств')
+        self.second.refresh_from_db()
+        self.assertEqual(self.second.balance, Decimal('50.00'))
+        self.assertEqual(Operation.objects.count(), 0)
+
+    def test_per_item(self):
+        """Тест пачки с результатом по каждой операции"""
+        operations = self.operations(
+            (self.first, 'WITHDRAW', '180.00'),
+            (self.second, 'WITHDRAW', '50.00'),
+        )
+        operations.append({'wallet_uuid': str(uuid.uuid4()), 'operation_type': 'DEPOSIT', 'amount': '1.00'})
+        response = self.client.post(self.url, {'mode': 'per_item', 'operations': operations}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data['results']
+        self.assertEqual(results[0]['error'], 'Недостаточно средств')
+        self.assertEqual(results[1]['balance'], Decimal('0.00'))
+        self.assertIn('error', results[2])
+        self.assertEqual(Operation.objects.count(), 1)
+
+    def test_sharded_wallet(self):
+        """Тест пачки с кошельком, разделенным на суб-балансы"""
+        self.first.set_shard_count(3)
+        data = {'operations': self.operations(
+            (self.first, 'DEPOSIT', '20.00'),
+            (self.first, 'WITHDRAW', '110.00'),
+        )}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.first.get_balance(), Decimal('10.00'))
+
+    def test_invalid_item(self):
+        """Тест валидации операций пачки"""
+        data = {'operations': self.operations((self.first, 'DEPOSIT', '-1.00'))}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_not_admin(self):
+        """Тест доступа к пакетным операциям без прав администратора"""
+        self.client.force_authenticate(user=self.first.owner)
+        data = {'operations': self.operations((self.first, 'DEPOSIT', '1.00'))}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class TransferTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='test1@example.com')
+        self.other = User.objects.create(email='test2@example.com')
+        self.source = Wallet.objects.create(owner=self.user, balance=Decimal('100.00'))
+        self.destination = Wallet.objects.create(owner=self.other, balance=Decimal('10.00'))
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('wallets:transfer')
+
+    def post(self, amount, source=None, destination=None):
+        return self.client.post(self.url, {
+            'source': source or self.source.uuid,
+            'destination': destination or self.destination.uuid,
+            'amount': amount,
+        })
+
+    def test_transfer(self):
+        """Тест перевода: парные операции с общим transfer_id"""
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post('30.00')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['balance'], Decimal('70.00'))
+        self.source.refresh_from_db()
+        self.destination.refresh_from_db()
+        self.assertEqual(self.source.balance, Decimal('70.00'))
+        self.assertEqual(self.destination.balance, Decimal('40.00'))
+        operations = Operation.objects.filter(transfer_id=response.data['transfer_id'])
+        self.assertEqual(
+            sorted(operations.values_list('wallet_id', 'operation_type', 'amount')),
+            sorted([
+                (self.source.uuid, Operation.WITHDRAW, Decimal('30.00')),
+                (self.destination.uuid, Operation.DEPOSIT, Decimal('30.00')),
+            ])
+        )
+        self.assertEqual(get_balance_cache().get(self.destination.uuid)['balance'], Decimal('40.00'))
+
+    def test_transfer_sharded_and_ledger(self):
+        """Тест перевода между разделенным кошельком и кошельком в режиме журнала"""
+        self.source.set_shard_count(3)
+        self.destination.set_ledger_mode(True)
+        self.assertEqual(self.post('100.00').status_code, status.HTTP_200_OK)
+        self.source.refresh_from_db()
+        self.destination.refresh_from_db()
+        self.assertEqual(self.source.get_balance(), Decimal('0.00'))
+        self.assertEqual(self.destination.get_balance(), Decimal('110.00'))
+
+    def test_transfer_errors(self):
+        """Тест ошибок перевода: ничего не записывается"""
+        response = self.post('100.01')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {'error': 'Недостаточно средств'})
+        self.assertEqual(self.post('-1').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.post('1', destination=self.source.uuid).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.post('1', destination=uuid.uuid4()).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.post('1', source=uuid.uuid4()).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(Operation.objects.count(), 0)
+        self.source.refresh_from_db()
+        self.assertEqual(self.source.balance, Decimal('100.00'))
+
+    def test_transfer_permissions(self):
+        """Тест перевода только из своего кошелька (или администратором)"""
+        response = self.post('1', source=self.destination.uuid, destination=self.source.uuid)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(user=User.objects.create(email='admin@example.com', is_superuser=True))
+        response = self.post('1', source=self.destination.uuid, destination=self.source.uuid)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.force_authenticate(user=None)
+        self.assertEqual(self.post('1').status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class IdempotencyTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='test1@example.com')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal('100.00'))
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('wallets:wallet_operation', args=[self.wallet.uuid])
+
+    def test_replay(self):
+        """Тест повтора операции с тем же ключом"""
+        for engine in ENGINES:
+            with self.subTest(engine=engine), override_settings(WALLET_OPERATION_ENGINE=engine):
+                data = {'operation_type': 'DEPOSIT', 'amount': '50.00'}
+                first = self.client.post(self.url, data, HTTP_IDEMPOTENCY_KEY=engine)
+                second = self.client.post(self.url, data, HTTP_IDEMPOTENCY_KEY=engine)
+                self.assertEqual(second.status_code, status.HTTP_200_OK)
+                self.assertEqual(second.data['balance'], first.data['balance'])
+                self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.wallet.operations.count(), len(ENGINES))
+        self.assertEqual(IdempotencyKey.objects.count(), len(ENGINES))
+
+    def test_rejected_operation_not_stored(self):
+        """Тест повтора отклоненной операции"""
+        data = {'operation_type': 'WITHDRAW', 'amount': '150.00'}
+        self.client.post(self.url, data, HTTP_IDEMPOTENCY_KEY='key')
+        self.client.post(self.url, {'operation_type': 'DEPOSIT', 'amount': '50.00'})
+        response = self.client.post(self.url, data, HTTP_IDEMPOTENCY_KEY='key')
+        self.assertEqual(response.data['balance'], Decimal('0.00'))
+
+    def test_key_reused_with_other_payload(self):
+        """Тест ключа, повторно использованного с другими параметрами"""
+        self.client.post(self.url, {'operation_type': 'DEPOSIT', 'amount': '50.00'}, HTTP_IDEMPOTENCY_KEY='key')
+        response = self.client.post(
+            self.url, {'operation_type': 'DEPOSIT', 'amount': '60.00'}, HTTP_IDEMPOTENCY_KEY='key'
+        )
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_invalid_key(self):
+        """Тест слишком длинного ключа"""
+        response = self.client.post(
+            self.url, {'operation_type': 'DEPOSIT', 'amount': '50.00'}, HTTP_IDEMPOTENCY_KEY='k' * 256
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_purge_expired_keys(self):
+        """Тест удаления просроченных ключей"""
+        IdempotencyKey.remember(self.wallet.uuid, 'old', 'DEPOSIT', Decimal('1.00'), Decimal('1.00'))
+        IdempotencyKey.remember(self.wallet.uuid, 'new', 'DEPOSIT', Decimal('1.00'), Decimal('1.00'))
+        IdempotencyKey.objects.filter(key='old').update(expires_at=timezone.now() - timedelta(minutes=1))
+        call_command('purge_idempotency_keys', batch_size=1, stdout=StringIO())
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['new'])
+
+
+class BalanceCacheTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='test1@example.com')
+        self.admin = User.objects.create(email='admin@example.com', is_superuser=True)
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal('100.00'))
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('wallets:wallet_retrieve', args=[self.wallet.uuid])
+        self.operation_url = reverse('wallets:wallet_operation', args=[self.wallet.uuid])
+
+    def test_write_through(self):
+        """Тест обновления кэша после фиксации операции"""
+        self.client.get(self.url)
+        for engine in ENGINES:
+            with self.subTest(engine=engine), override_settings(WALLET_OPERATION_ENGINE=engine):
+                with self.captureOnCommitCallbacks(execute=True):
+                    operation = self.client.post(self.operation_url, {'operation_type': 'DEPOSIT', 'amount': '10.00'})
+                hits = get_balance_cache().stats()['hits']
+                response = self.client.get(self.url)
+                self.assertEqual(Decimal(response.data['balance']), operation.data['balance'])
+                self.assertEqual(get_balance_cache().stats()['hits'], hits + 1)
+        self.assertEqual(response.data['balance'], '130.00')
+
+    def test_version_bumped(self):
+        """Тест роста версии при каждом изменении баланса во всех режимах"""
+        for mode in ('rows', 'shards', 'ledger'):
+            with self.subTest(mode=mode):
+                if mode == 'shards':
+                    self.wallet.set_shard_count(3)
+                if mode == 'ledger':
+                    self.wallet.set_shard_count(0)
+                    self.wallet.set_ledger_mode(True)
+                for engine in ENGINES:
+                    version = Wallet.get_state(self.wallet.uuid)['version']
+                    get_engine(engine).apply(self.wallet.uuid, Operation.DEPOSIT, Decimal('10.00'))
+                    self.assertGreater(Wallet.get_state(self.wallet.uuid)['version'], version)
+                    version = Wallet.get_state(self.wallet.uuid)['version']
+                    get_engine(engine).apply(self.wallet.uuid, Operation.WITHDRAW, Decimal('10.00'))
+                    self.assertGreater(Wallet.get_state(self.wallet.uuid)['version'], version)
+        version = Wallet.get_state(self.wallet.uuid)['version']
+        Wallet.compact(1000)
+        self.assertEqual(Wallet.get_state(self.wallet.uuid), {'version': version, 'balance': Decimal('100.00'),
+                                                              'owner': self.user.pk})
+
+    def test_stale_state_rejected(self):
+        """Тест отказа в записи устаревшего состояния"""
+        cache = LocalBalanceCache(ttl=60)
+        self.assertTrue(cache.set(self.wallet.uuid, {'version': 2, 'balance': Decimal('20.00'), 'owner': 1}))
+        self.assertFalse(cache.set(self.wallet.uuid, {'version': 1, 'balance': Decimal('10.00'), 'owner': 1}))
+        self.assertEqual(cache.get(self.wallet.uuid)['balance'], Decimal('20.00'))
+        cache.delete(self.wallet.uuid)
+        self.assertFalse(cache.set(self.wallet.uuid, {'version': 3, 'balance': Decimal('30.00'), 'owner': 1}))
+        self.assertIsNone(cache.get(self.wallet.uuid)['balance'])
+
+    def test_other_process_write(self):
+        """Тест: запись в обход кэша процесса (другой воркер) видна после срока жизни записи в памяти"""
+        with mock.patch('wallets.cache._cache', LocalBalanceCache(ttl=0.05)):
+            self.assertEqual(self.client.get(self.url).data['balance'], '100.00')
+            Wallet.objects.filter(pk=self.wallet.pk).update(balance=Decimal('70.00'), version=F('version') + 1)
+            self.assertEqual(self.client.get(self.url).data['balance'], '100.00')
+            time.sleep(0.1)
+            self.assertEqual(self.client.get(self.url).data['balance'], '70.00')
+
+    def test_destroyed_wallet(self):
+        """Тест удаленного кошелька в кэше"""
+        wallet = Wallet.objects.create(owner=self.admin)
+        self.client.force_authenticate(user=self.admin)
+        url = reverse('wallets:wallet_retrieve', args=[wallet.uuid])
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse('wallets:wallet_destroy', args=[wallet.uuid]))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stats(self):
+        """Тест счетчиков кэша"""
+        response = self.client.get(reverse('wallets:cache_stats'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get(reverse('wallets:cache_stats'))
+        self.assertEqual(response.data['backend'], 'local')
+        self.assertIn('hits', response.data)
+        self.assertIn('misses', response.data)
+
+    def test_stats_redis_unavailable(self):
+        """Тест счетчиков кэша при недоступном Redis: ответ без счетчиков, а не ошибка"""
+        import redis
+
+        cache = RedisBalanceCache('redis://localhost:6379/0', 60)
+        self.client.force_authenticate(user=self.admin)
+        with mock.patch('wallets.cache._cache', cache):
+            with mock.patch.object(cache.client, 'mget', side_effect=redis.ConnectionError):
+                response = self.client.get(reverse('wallets:cache_stats'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data, {'backend': 'redis', 'hits': None, 'misses': None, 'error': 'unavailable'}
+        )
+
+
+class DatabasePoolTests(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create(email='admin@example.com', is_superuser=True)
+
+    def test_health(self):
+        """Тест проверки готовности без аутентификации"""
+        response = self.client.get(reverse('wallets:health'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'status': 'ok'})
+
+    def test_stats(self):
+        """Тест счетчиков пула: ожидания и таймауты"""
+        response = self.client.get(reverse('wallets:db_pool_stats'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get(reverse('wallets:db_pool_stats'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        if connection.pool is None:
+            self.assertIsNone(response.data['default'])
+        else:
+            self.assertGreater(response.data['default']['checkouts'], 0)
+
+        with ConnectionPool(async_db.conninfo(), min_size=1, max_size=1, timeout=0.1) as pool:
+            pool.wait()
+            with pool.connection():
+                with self.assertRaises(PoolTimeout):
+                    pool.getconn()
+            with pool.connection():
+                pass
+            stats = DatabasePoolStatsView.describe(pool)
+        self.assertEqual(stats['checkouts'], 3)
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['max_size'], 1)
+
+
+class ConditionalRetrieveTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='test1@example.com')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal('100.00'))
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('wallets:wallet_retrieve', args=[self.wallet.uuid])
+
+    def test_not_modified(self):
+        """Тест ответа 304 для неизменившейся версии"""
+        response = self.client.get(self.url)
+        etag = response.headers['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertFalse(response.content)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('wallets:wallet_operation', args=[self.wallet.uuid]),
+                             {'operation_type': 'DEPOSIT', 'amount': '10.00'})
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.data['balance'], '110.00')
+
+    def test_not_modified_forbidden(self):
+        """Тест проверки прав до ответа 304"""
+        etag = self.client.get(self.url).headers['ETag']
+        self.client.force_authenticate(user=User.objects.create(email='other@example.com'))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_long_poll(self):
+        """Тест ожидания изменения версии"""
+        etag = self.client.get(self.url).headers['ETag']
+        state = Wallet.get_state(self.wallet.uuid)
+        state.update(version=state['version'] + 1, balance=Decimal('150.00'))
+        timer = threading.Timer(0.1, get_balance_cache().set, args=(self.wallet.uuid, state))
+        timer.start()
+        started = time.monotonic()
+        response = self.client.get(self.url, {'wait': 5}, HTTP_IF_NONE_MATCH=etag)
+        timer.join()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['balance'], '150.00')
+
+    def test_long_poll_timeout(self):
+        """Тест ответа 304 по истечении ожидания"""
+        etag = self.client.get(self.url).headers['ETag']
+        response = self.client.get(self.url, {'wait': '0.2'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(self.url, {'wait': 'soon'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class OperationHistoryTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='test1@example.com')
+        self.wallet = Wallet.objects.create(owner=self.user)
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('wallets:wallet_operations', args=[self.wallet.uuid])
+        now = timezone.now()
+        # Пары операций с одинаковым временем проверяют разрешение совпадений по id
+        self.operations = Operation.objects.bulk_create(
+            Operation(
+                wallet=self.wallet,
+                operation_type=Operation.DEPOSIT if index % 3 else Operation.WITHDRAW,
+                amount=Decimal(index + 1)
+            )
+            for index in range(25)
+        )
+        for index, operation in enumerate(self.operations):
+            operation.created_at = now - timedelta(minutes=index // 2)
+        Operation.objects.bulk_update(self.operations, ['created_at'])
+
+    def fetch_all(self, params):
+        ids, url = [], self.url
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [item['id'] for item in response.data['results']]
+            url, params = response.data['next'], None
+        return ids
+
+    def test_pages(self):
+        """Тест обхода истории по страницам без пропусков и повторов"""
+        expected = [
+            operation.pk
+            for operation in sorted(self.operations, key=lambda item: (item.created_at, item.pk), reverse=True)
+        ]
+        self.assertEqual(self.fetch_all({'limit': 4}), expected)
+
+    def test_filters(self):
+        """Тест фильтров по типу и времени"""
+        ids = self.fetch_all({'limit': 5, 'operation_type': 'WITHDRAW'})
+        self.assertEqual(len(ids), 9)
+        self.assertTrue(all(Operation.objects.get(pk=pk).operation_type == 'WITHDRAW' for pk in ids))
+
+        created_after = self.operations[5].created_at
+        ids = self.fetch_all({'created_after': created_after.isoformat()})
+        self.assertEqual(set(ids), {operation.pk for operation in self.operations[:6]})
+
+        response = self.client.get(self.url, {'operation_type': 'REFUND'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_invalid_cursor(self):
+        """Тест некорректного курсора"""
+        response = self.client.get(self.url, {'cursor': 'broken'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_not_owner(self):
+        """Тест истории чужого кошелька"""
+        self.client.force_authenticate(user=User.objects.create(email='other@example.com'))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class StatementTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='test1@example.com')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal('100.00'))
+        self.other = Wallet.objects.create(owner=User.objects.create(email='test2@example.com'))
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('wallets:wallet_statement', args=[self.wallet.uuid])
+
+    def operate(self, operation_type, amount):
+        url = reverse('wallets:wallet_operation', args=[self.wallet.uuid])
+        self.assertEqual(
+            self.client.post(url, {'operation_type': operation_type, 'amount': amount}).status_code, status.HTTP_200_OK
+        )
+
+    def test_statement(self):
+        """Тест выписки из дневных итогов во всех режимах кошелька"""
+        for mode in ('rows', 'shards', 'ledger'):
+            with self.subTest(mode=mode):
+                if mode == 'shards':
+                    self.wallet.set_shard_count(3)
+                if mode == 'ledger':
+                    self.wallet.set_shard_count(0)
+                    self.wallet.set_ledger_mode(True)
+                self.operate('DEPOSIT', '50.00')
+                self.operate('WITHDRAW', '30.00')
+        self.client.post(reverse('wallets:transfer'), {
+            'source': self.wallet.uuid, 'destination': self.other.uuid, 'amount': '5.00'
+        })
+        Operation.objects.bulk_create([
+            Operation(wallet=self.wallet, operation_type=Operation.DEPOSIT, amount=Decimal('1.00')) for _ in range(3)
+        ])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(any(Operation._meta.db_table in query['sql'] for query in queries))
+        today = str(timezone.now().astimezone(dt_timezone.utc).date())
+        totals = {'deposited': '153.00', 'deposits': 6, 'withdrawn': '95.00', 'withdrawals': 4}
+        self.assertEqual(response.data['days'], [{'day': today, **totals}])
+        self.assertEqual(response.data['total'], totals)
+
+        response = self.client.get(self.url, {'from': '2020-01-01', 'to': '2020-01-31'})
+        self.assertEqual(response.data['days'], [])
+        self.assertEqual(
+            response.data['total'], {'deposited': '0.00', 'deposits': 0, 'withdrawn': '0.00', 'withdrawals': 0}
+        )
+
+    def test_statement_errors(self):
+        """Тест проверки интервала и пермишенов выписки"""
+        self.assertEqual(self.client.get(self.url, {'from': '2024-02-01', 'to': '2024-01-01'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'from': '2020-01-01', 'to': '2024-01-01'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'from': 'yesterday'}).status_code, 400)
+        url = reverse('wallets:wallet_statement', args=[self.other.uuid])
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+
+class StatementBackfillTests(TransactionTestCase):
+    def test_backfill(self):
+        """Тест пересчета дневных итогов из операций параллельными порциями"""
+        wallets = [
+            Wallet.objects.create(owner=User.objects.create(email=f'backfill-{number}@example.com'))
+            for number in range(3)
+        ]
+        now = timezone.now()
+        operations = Operation.objects.bulk_create(
+            Operation(
+                wallet=wallets[index % 3],
+                operation_type=Operation.DEPOSIT if index % 4 else Operation.WITHDRAW,
+                amount=Decimal(index + 1)
+            )
+            for index in range(200)
+        )
+        # Перенос в прошлые дни (в том числе прошлые месяцы) триггер не учитывает - итоги расходятся с операциями
+        for index, operation in enumerate(operations):
+            operation.created_at = now - timedelta(hours=index * 7)
+        Operation.objects.bulk_update(operations, ['created_at'])
+
+        def expected():
+            return {
+                (row['wallet_id'], row['day']): (row['deposited'], row['withdrawn'])
+                for row in Operation.objects.annotate(day=TruncDate('created_at', tzinfo=dt_timezone.utc)).values(
+                    'wallet_id', 'day'
+                ).annotate(
+                    deposited=Sum('amount', filter=Q(operation_type=Operation.DEPOSIT), default=Decimal(0)),
+                    withdrawn=Sum('amount', filter=Q(operation_type=Operation.WITHDRAW), default=Decimal(0)),
+                )
+            }
+
+        def actual():
+            return {
+                (row['wallet_id'], row['day']): (row['deposited'], row['withdrawn'])
+                for row in DailyStatement.objects.values('wallet_id', 'day').annotate(
+                    deposited=Sum('deposit_total'), withdrawn=Sum('withdraw_total')
+                )
+            }
+
+        self.assertNotEqual(actual(), expected())
+        out = StringIO()
+        call_command('backfill_statements', chunk_days=5, workers=3, stdout=out)
+        self.assertIn('Пересчитано дней', out.getvalue())
+        self.assertEqual(actual(), expected())
+        self.assertEqual(set(DailyStatement.objects.values_list('slot', flat=True)), {0})
+
+        # Новые операции добавляются к пересчитанным итогам
+        Operation.objects.create(wallet=wallets[0], operation_type=Operation.DEPOSIT, amount=Decimal('1000.00'))
+        self.assertEqual(actual(), expected())
+
+
+class AdminTests(APITestCase):
+    """
+    Списки админки: число запросов не зависит от числа строк, страницы по ключу
+    """
+
+    def setUp(self):
+        self.admin = User.objects.create(email='admin@example.com', is_staff=True, is_superuser=True)
+        self.client.force_login(self.admin)
+        self.wallets = [
+            Wallet.objects.create(owner=User.objects.create(email=f'admin-{number}@example.com'))
+            for number in range(3)
+        ]
+        self.url = reverse('admin:wallets_operation_changelist')
+        self.create_operations(30)
+
+    def create_operations(self, count):
+        now = timezone.now()
+        operations = Operation.objects.bulk_create(
+            Operation(wallet=self.wallets[index % 3], operation_type=Operation.DEPOSIT, amount=Decimal(index + 1))
+            for index in range(count)
+        )
+        # Пары операций с одинаковым временем проверяют разрешение совпадений по id
+        for index, operation in enumerate(operations):
+            operation.created_at = now - timedelta(days=index // 2)
+        Operation.objects.bulk_update(operations, ['created_at'])
+
+    def get(self, url, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        return response, [query['sql'] for query in queries]
+
+    @mock.patch.object(OperationAdmin, 'list_per_page', 7)
+    def test_operation_pages(self):
+        """Тест обхода операций по страницам без пропусков и повторов"""
+        ids, params = [], {}
+        while True:
+            response, queries = self.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            cl = response.context['cl']
+            ids += [operation.pk for operation in cl.result_list]
+            self.assertFalse(any('OFFSET' in query for query in queries))
+            self.assertFalse(any(Wallet._meta.db_table in query for query in queries))
+            if cl.next_cursor is None:
+                break
+            params = {'cursor': cl.next_cursor}
+        self.assertEqual(ids, list(Operation.objects.order_by('-created_at', '-id').values_list('id', flat=True)))
+
+        self.assertEqual(self.client.get(self.url, {'cursor': 'invalid'}).status_code, status.HTTP_302_FOUND)
+        # Сортировка по другому столбцу - обычные страницы
+        response = self.client.get(self.url, {'o': '4', 'p': '2'})
+        self.assertEqual(len(response.context['cl'].result_list), 7)
+
+    def test_constant_queries(self):
+        """Тест числа запросов списков, не зависящего от числа строк"""
+        urls = [
+            self.url,
+            reverse('admin:wallets_wallet_changelist'),
+            reverse('admin:users_user_changelist'),
+        ]
+        counts = [len(self.get(url)[1]) for url in urls]
+        self.create_operations(30)
+        for number in range(10):
+            Wallet.objects.create(owner=User.objects.create(email=f'more-{number}@example.com'))
+        self.assertEqual([len(self.get(url)[1]) for url in urls], counts)
+
+        # Оценка вместо COUNT(*)
+        with override_settings(ADMIN_EXACT_COUNT_MAX=0):
+            response, queries = self.get(self.url)
+        self.assertTrue(response.context['cl'].paginator.estimated)
+        self.assertFalse(any('COUNT(' in query for query in queries))
+
+    def test_date_hierarchy(self):
+        """Тест иерархии дат без DISTINCT по всем строкам"""
+        response, queries = self.get(self.url)
+        self.assertFalse(any('DISTINCT' in query for query in queries))
+        today = timezone.localtime()
+        response, queries = self.get(self.url, {
+            'created_at__year': today.year, 'created_at__month': today.month, 'created_at__day': today.day
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.context['cl'].result_list), 2)
+
+        months = Operation.objects.datetimes('created_at', 'month')
+        queryset = SkipScanQuerySet(Operation)
+        self.assertEqual(list(queryset.datetimes('created_at', 'month')), list(months))
+        self.assertEqual(
+            list(queryset.datetimes('created_at', 'day', order='DESC')),
+            list(Operation.objects.datetimes('created_at', 'day', order='DESC'))
+        )
+
+    def test_change_form(self):
+        """Тест формы операции и кошелька с полями raw id"""
+        operation = Operation.objects.first()
+        response = self.client.get(reverse('admin:wallets_operation_change', args=[operation.pk]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, 'vForeignKeyRawIdAdminField')
+        response = self.client.get(reverse('admin:wallets_wallet_change', args=[self.wallets[0].pk]))
+        self.assertContains(response, 'vForeignKeyRawIdAdminField')
+
+
+class PartitionTests(APITestCase):
+    def setUp(self):
+        self.wallet = Wallet.objects.create(owner=User.objects.create(email='test1@example.com'))
+        self.month = date(2099, 1, 1)
+
+    def create_operation(self, created_at, **kwargs):
+        operation = Operation.objects.create(wallet=self.wallet, operation_type='DEPOSIT', amount=1, **kwargs)
+        # Смена created_at переносит строку в другой раздел
+        Operation.objects.filter(pk=operation.pk).update(created_at=created_at)
+        return operation
+
+    def partition_of(self, operation):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT tableoid::regclass::text FROM wallets_operation WHERE id = %s', [operation.pk])
+            return cursor.fetchone()[0]
+
+    def test_partitions_ahead(self):
+        """Тест разделов, созданных миграцией и командой"""
+        call_command('manage_partitions', ahead=5, stdout=StringIO())
+        with connection.cursor() as cursor:
+            names = {partition[0] for partition in partitions.list_partitions(cursor)}
+        current = partitions.month_start(timezone.now())
+        self.assertTrue({partitions.LEGACY, partitions.DEFAULT} <= names)
+        for ahead in range(1, 6):
+            self.assertIn(partitions.partition_name(partitions.add_months(current, ahead)), names)
+        self.assertEqual(self.partition_of(self.create_operation(timezone.now())), partitions.LEGACY)
+
+    def test_rows_moved_from_default(self):
+        """Тест переноса строк из раздела по умолчанию в новый раздел"""
+        operation = self.create_operation(partitions.month_bound(self.month))
+        self.assertEqual(self.partition_of(operation), partitions.DEFAULT)
+        with connection.cursor() as cursor:
+            self.assertTrue(partitions.create_partition(cursor, self.month))
+            self.assertFalse(partitions.create_partition(cursor, self.month))
+        self.assertEqual(self.partition_of(operation), partitions.partition_name(self.month))
+
+    def test_partition_pruning(self):
+        """Тест запроса с интервалом времени только к нужному разделу"""
+        with connection.cursor() as cursor:
+            partitions.create_partition(cursor, self.month)
+        plan = Operation.objects.filter(
+            wallet=self.wallet,
+            created_at__gte=partitions.month_bound(self.month),
+            created_at__lt=partitions.month_bound(partitions.add_months(self.month, 1))
+        ).explain()
+        self.assertIn(partitions.partition_name(self.month), plan)
+        self.assertNotIn(partitions.LEGACY, plan)
+        self.assertNotIn(partitions.DEFAULT, plan)
+
+    def test_archive(self):
+        """Тест архивации раздела в сжатый CSV"""
+        with connection.cursor() as cursor:
+            partitions.create_partition(cursor, self.month)
+        pending = self.create_operation(partitions.month_bound(self.month), compacted=False)
+        with tempfile.TemporaryDirectory() as archive_dir, connection.cursor() as cursor:
+            with self.assertRaises(ValueError):
+                partitions.archive_partition(cursor, partitions.partition_name(self.month), archive_dir)
+
+            Operation.objects.filter(pk=pending.pk).update(compacted=True)
+            # Отложенные проверки внешних ключей тестовой транзакции мешают DROP TABLE
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            path = partitions.archive_partition(cursor, partitions.partition_name(self.month), archive_dir)
+            with gzip.open(path, 'rt') as archive:
+                rows = list(csv.DictReader(archive))
+            names = {partition[0] for partition in partitions.list_partitions(cursor)}
+        self.assertEqual([int(row['id']) for row in rows], [pending.pk])
+        self.assertNotIn(partitions.partition_name(self.month), names)
+        self.assertFalse(Operation.objects.filter(pk=pending.pk).exists())
+
+
+class ConcurrentOperationTests(TransactionTestCase):
+    """
+    Параллельные списания с одного кошелька
+    """
+
+    def test_no_overdraft(self):
+        """Тест отсутствия ухода в минус при параллельных списаниях"""
+        modes = [(0, False), (3, False), (0, True)]
+        for name, (shard_count, ledger_mode) in [(name, mode) for name in ENGINES for mode in modes]:
+            with self.subTest(engine=name, shard_count=shard_count, ledger_mode=ledger_mode):
+                user = User.objects.create(email=f'{name}-{shard_count}-{ledger_mode}@example.com')
+                wallet = Wallet.objects.create(owner=user, balance=Decimal('100.00'))
+                wallet.set_shard_count(shard_count)
+                wallet.set_ledger_mode(ledger_mode)
+                results = []
+
+                def withdraw():
+                    try:
+                        get_engine(name).apply(wallet.uuid, Operation.WITHDRAW, Decimal('30.00'))
+                        results.append(True)
+                    except ValidationError:
+                        results.append(False)
+                    finally:
+                        connection.close()
+
+                threads = [threading.Thread(target=withdraw) for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+                wallet.refresh_from_db()
+                self.assertEqual(results.count(True), 3)
+                self.assertEqual(wallet.get_balance(), Decimal('10.00'))
+                self.assertEqual(wallet.operations.count(), 3)
+
+    @override_settings(WALLET_COMBINER_WINDOW_MS=50)
+    def test_combiner_running_balance(self):
+        """Тест баланса каждой операции в общей пачке"""
+        user = User.objects.create(email='combiner@example.com')
+        wallet = Wallet.objects.create(owner=user, balance=Decimal('100.00'))
+        results = {}
+
+        def apply(number, operation_type):
+            try:
+                results[number] = get_engine('combiner').apply(wallet.uuid, operation_type, Decimal('60.00'))
+            except ValidationError:
+                results[number] = None
+            finally:
+                connection.close()
+
+        operation_types = ['WITHDRAW', 'DEPOSIT'] * 4
+        threads = [threading.Thread(target=apply, args=args) for args in enumerate(operation_types)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        applied = [number for number, balance in results.items() if balance is not None]
+        expected = Decimal('100.00') + sum(
+            60 if operation_types[number] == 'DEPOSIT' else -60 for number in applied
+        )
+        wallet.refresh_from_db()
+        self.assertEqual(wallet.balance, expected)
+        self.assertEqual(wallet.operations.count(), len(applied))
+        self.assertTrue(all(results[number] >= 0 for number in applied))
+
+    def test_concurrent_duplicate_keys(self):
+        """Тест параллельных запросов с одним ключом идемпотентности"""
+        for name in ENGINES:
+            with self.subTest(engine=name), override_settings(WALLET_OPERATION_ENGINE=name):
+                user = User.objects.create(email=f'idempotency-{name}@example.com')
+                wallet = Wallet.objects.create(owner=user, balance=Decimal('100.00'))
+                url = reverse('wallets:wallet_operation', args=[wallet.uuid])
+                responses = []
+
+                def post():
+                    client = APIClient()
+                    client.force_authenticate(user=user)
+                    try:
+                        responses.append(client.post(
+                            url, {'operation_type': 'WITHDRAW', 'amount': '10.00'}, HTTP_IDEMPOTENCY_KEY='retry'
+                        ))
+                    finally:
+                        connection.close()
+
+                threads = [threading.Thread(target=post) for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+                self.assertEqual([response.status_code for response in responses], [status.HTTP_200_OK] * 8)
+                self.assertEqual({response.data['balance'] for response in responses}, {Decimal('90.00')})
+                self.assertEqual(wallet.operations.count(), 1)
+
+
+class ConcurrentTransferTests(TransactionTestCase):
+    """
+    Встречные переводы между кошельками. Число переводов задается
+    переменной окружения TRANSFER_STRESS_COUNT
+    """
+    transfers = int(os.getenv('TRANSFER_STRESS_COUNT', 2000))
+
+    def test_crossing_transfers(self):
+        """Тест отсутствия взаимных блокировок и сохранения суммы при встречных переводах"""
+        admin = User.objects.create(email='admin@example.com', is_superuser=True)
+        wallets = [
+            Wallet.objects.create(owner=User.objects.create(email=f'transfer-{number}@example.com'),
+                                  balance=Decimal('1000.00'))
+            for number in range(8)
+        ]
+        wallets[0].set_shard_count(3)
+        wallets[1].set_ledger_mode(True)
+        url = reverse('wallets:transfer')
+        random.seed(15)
+        plan = [
+            (*random.sample(wallets, 2), Decimal(random.randint(1, 50000)) / 100) for _ in range(self.transfers)
+        ]
+        statuses, errors = [], []
+
+        def run(part):
+            client = APIClient()
+            client.force_authenticate(user=admin)
+            try:
+                for source, destination, amount in part:
+                    response = client.post(
+                        url, {'source': source.uuid, 'destination': destination.uuid, 'amount': amount}
+                    )
+                    statuses.append(response.status_code)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(plan[number::8],)) for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(set(statuses) - {status.HTTP_200_OK, status.HTTP_400_BAD_REQUEST}, set())
+        applied = statuses.count(status.HTTP_200_OK)
+        self.assertGreater(applied, 0)
+        balances = [Wallet.objects.get(uuid=wallet.uuid).get_balance() for wallet in wallets]
+        self.assertEqual(sum(balances), Decimal('8000.00'))
+        self.assertTrue(all(balance >= 0 for balance in balances))
+        self.assertEqual(Operation.objects.count(), 2 * applied)
+        self.assertEqual(Operation.objects.values('transfer_id').distinct().count(), applied)
+        # Дневные итоги, записанные из разных соединений, сходятся с операциями
+        totals = DailyStatement.objects.aggregate(deposited=Sum('deposit_total'), withdrawn=Sum('withdraw_total'))
+        self.assertEqual(totals['deposited'], totals['withdrawn'])
+        self.assertEqual(totals['deposited'], Operation.objects.aggregate(total=Sum('amount'))['total'] / 2)
+
+
+class CombinerBatchTests(APITestCase):
+    def test_apply_batch(self):
+        """Тест применения пачки операций по порядку"""
+        user = User.objects.create(email='combiner@example.com')
+        wallet = Wallet.objects.create(owner=user, balance=Decimal('100.00'))
+        batch = [
+            PendingOperation(operation_type, Decimal('60.00'))
+            for operation_type in ['WITHDRAW', 'WITHDRAW', 'DEPOSIT', 'WITHDRAW']
+        ]
+        CombinerEngine.apply_batch(wallet.uuid, batch)
+
+        self.assertEqual(
+            [item.balance for item in batch], [Decimal('40.00'), None, Decimal('100.00'), Decimal('40.00')]
+        )
+        self.assertIn('Недостаточно средств', str(batch[1].error))
+        wallet.refresh_from_db()
+        self.assertEqual(wallet.balance, Decimal('40.00'))
+        self.assertEqual(wallet.operations.count(), 3)
+
+    @override_settings(WALLET_OPERATION_ENGINE='combiner')
+    def test_combiner_view(self):
+        """Тест операций через представление в режиме групповой фиксации"""
+        user = User.objects.create(email='combiner@example.com')
+        wallet = Wallet.objects.create(owner=user, balance=Decimal('100.00'))
+        self.client.force_authenticate(user=user)
+        url = reverse('wallets:wallet_operation', args=[wallet.uuid])
+        response = self.client.post(url, {'operation_type': 'WITHDRAW', 'amount': '150.00'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(url, {'operation_type': 'DEPOSIT', 'amount': '50.00'})
+        self.assertEqual(response.data['balance'], Decimal('150.00'))
+        response = self.client.post(reverse('wallets:wallet_operation', args=[uuid.uuid4()]),
+                                    {'operation_type': 'DEPOSIT', 'amount': '50.00'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class LedgerCopyTests(TransactionTestCase):
+    """
+    Выгрузка и загрузка журнала через COPY. Объем данных задается
+    переменной окружения LEDGER_ROUNDTRIP_ROWS
+    """
+    rows = int(os.getenv('LEDGER_ROUNDTRIP_ROWS', 20000))
+
+    def setUp(self):
+        users = User.objects.bulk_create(User(email=f'ledger{number}@example.com') for number in range(20))
+        wallets = Wallet.objects.bulk_create(Wallet(owner=user) for user in users)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO wallets_operation (wallet_id, operation_type, amount, created_at, compacted)
+                SELECT (%(wallets)s::uuid[])[number %% %(count)s + 1],
+                    CASE WHEN number %% 3 = 0 THEN 'WITHDRAW' ELSE 'DEPOSIT' END,
+                    (number %% 1000 + 1) / 100.0, now() - number * interval '1 second', true
+                FROM generate_series(1, %(rows)s) AS number
+                """,
+                {'wallets': [wallet.uuid for wallet in wallets], 'count': len(wallets), 'rows': self.rows}
+            )
+            cursor.execute(
+                """
+                UPDATE wallets_wallet AS wallet SET balance = totals.balance FROM (
+                    SELECT wallet_id, SUM(CASE WHEN operation_type = 'DEPOSIT' THEN amount ELSE -amount END) AS balance
+                    FROM wallets_operation GROUP BY wallet_id
+                ) AS totals WHERE totals.wallet_id = wallet.uuid
+                """
+            )
+        # Разделенный кошелек и кошелек с несвернутыми операциями журнала
+        wallets[0].set_shard_count(3)
+        wallets[1].set_ledger_mode(True)
+        for wallet in wallets[:2]:
+            get_engine('atomic').apply(wallet.uuid, Operation.DEPOSIT, Decimal('7.50'))
+
+    def ledger(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT wallet_id, COUNT(*), SUM(CASE WHEN operation_type = 'DEPOSIT' THEN amount ELSE -amount END),
+                    MIN(created_at), MAX(created_at)
+                FROM wallets_operation GROUP BY wallet_id ORDER BY wallet_id
+                """
+            )
+            operations = cursor.fetchall()
+        balances = {wallet.uuid: wallet.get_balance() for wallet in Wallet.objects.all()}
+        return operations, balances
+
+    def test_roundtrip(self):
+        """Тест выгрузки и загрузки в форматах csv и binary"""
+        expected = self.ledger()
+        for copy_format, compress in [('csv', False), ('csv', True), ('binary', False), ('binary', True)]:
+            with self.subTest(format=copy_format, compress=compress), tempfile.TemporaryDirectory() as directory:
+                call_command('export_ledger', directory, format=copy_format, compress=compress, stdout=StringIO())
+                with connection.cursor() as cursor:
+                    cursor.execute('TRUNCATE wallets_wallet CASCADE')
+                output = StringIO()
+                call_command('import_ledger', directory, format=copy_format, chunk_size=3000, stdout=output)
+
+                self.assertEqual(self.ledger(), expected)
+                self.assertIn('Балансы совпадают с выгрузкой', output.getvalue())
+                self.assertFalse(Operation.objects.filter(compacted=False).exists())
+                wallet_uuid, balance = next(iter(expected[1].items()))
+                self.assertEqual(get_balance_cache().get(str(wallet_uuid))['balance'], balance)
+
+    def test_export_period(self):
+        """Тест выгрузки операций за интервал времени"""
+        until = Operation.objects.order_by('created_at')[100].created_at
+        with tempfile.TemporaryDirectory() as directory:
+            call_command('export_ledger', directory, until=until.isoformat(), stdout=StringIO())
+            with open(os.path.join(directory, 'operations.csv')) as file:
+                self.assertEqual(len(list(csv.DictReader(file))), 100)
+
+    def test_chunks(self):
+        """Тест разбиения ввода COPY на порции"""
+        for copy_format in ledger_io.FORMATS:
+            with self.subTest(format=copy_format), tempfile.TemporaryDirectory() as directory:
+                call_command('export_ledger', directory, format=copy_format, stdout=StringIO())
+                extension = ledger_io.FORMATS[copy_format][0]
+                with open(os.path.join(directory, f'operations.{extension}'), 'rb') as file:
+                    chunks = list(ledger_io.iter_chunks(file, copy_format, 7000))
+                self.assertEqual([rows for chunk, rows in chunks][:-1], [7000] * (len(chunks) - 1))
+                self.assertEqual(sum(rows for chunk, rows in chunks), Operation.objects.count())
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'CREATE TEMPORARY TABLE chunk '
+                        '(id bigint, wallet_id uuid, operation_type varchar(8), amount numeric(20, 2), '
+                        'created_at timestamptz)'
+                    )
+                    for chunk, rows in chunks:
+                        ledger_io.copy_from(
+                            cursor, f'COPY chunk FROM STDIN WITH ({ledger_io.FORMATS[copy_format][1]})', BytesIO(chunk)
+                        )
+                    cursor.execute('SELECT COUNT(*) FROM chunk')
+                    self.assertEqual(cursor.fetchone()[0], Operation.objects.count())
+                    cursor.execute('DROP TABLE chunk')
+
+
+def closing_pool(test):
+    """
+    Закрытие пула после асинхронного теста: у каждого теста свой цикл событий
+    """
+    @functools.wraps(test)
+    async def wrapper(self):
+        try:
+            await test(self)
+        finally:
+            await async_db.close_pool()
+    return wrapper
+
+
+class AsyncViewTests(TransactionTestCase):
+    """
+    Асинхронные представления баланса и операций. Пул psycopg 3 видит
+    только зафиксированные данные, поэтому тесты без общей транзакции
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='async@example.com')
+        self.other = User.objects.create(email='other@example.com')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal('100.00'))
+        self.factory = AsyncRequestFactory()
+
+    def headers(self, user):
+        token = AccessToken.for_user(user)
+        # Как при входе: токен, выпущенный сразу после отзыва (смены групп), действителен
+        token['auth_time'] = time.time()
+        return {'Authorization': f'Bearer {token}'}
+
+    async def retrieve(self, user=None, wallet_uuid=None, path='/', **headers):
+        request = self.factory.get(path, headers={**(self.headers(user) if user else {}), **headers})
+        return await WalletRetrieveAsyncView.as_view()(request, wallet_uuid=wallet_uuid or self.wallet.uuid)
+
+    async def operate(self, operation_type, amount, wallet_uuid=None, **headers):
+        request = self.factory.post(
+            '/', {'operation_type': operation_type, 'amount': amount},
+            content_type='application/json', headers={**self.headers(self.user), **headers}
+        )
+        return await WalletOperationAsyncView.as_view()(request, wallet_uuid=wallet_uuid or self.wallet.uuid)
+
+    @closing_pool
+    async def test_retrieve(self):
+        """Тест просмотра кошелька, ETag и пермишенов"""
+        response = await self.retrieve(self.user)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            json.loads(response.content), {'uuid': str(self.wallet.uuid), 'balance': '100.00', 'owner': self.user.pk}
+        )
+        response = await self.retrieve(self.user, If_None_Match=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.assertEqual((await self.retrieve(self.other)).status_code, status.HTTP_403_FORBIDDEN)
+        response = await self.retrieve()
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertIn('Bearer', response['WWW-Authenticate'])
+        response = await self.retrieve(self.user, Authorization='Bearer invalid')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual((await self.retrieve(self.user, uuid.uuid4())).status_code, status.HTTP_404_NOT_FOUND)
+
+        group = await Group.objects.acreate(name='admin')
+        await self.other.groups.aadd(group)
+        self.assertEqual((await self.retrieve(self.other)).status_code, status.HTTP_200_OK)
+
+    @closing_pool
+    async def test_same_as_sync(self):
+        """Тест совпадения ответов с синхронными представлениями"""
+        client = APIClient()
+        await sync_to_async(client.force_authenticate)(user=self.user)
+        url = reverse('wallets:wallet_retrieve', args=[self.wallet.uuid])
+        sync_response = await sync_to_async(client.get)(url)
+        response = await self.retrieve(self.user)
+        self.assertEqual(json.loads(response.content), sync_response.json())
+        self.assertEqual(response['ETag'], sync_response['ETag'])
+
+        response = await self.operate('WITHDRAW', '150.00')
+        sync_response = await sync_to_async(client.post)(
+            reverse('wallets:wallet_operation', args=[self.wallet.uuid]),
+            {'operation_type': 'WITHDRAW', 'amount': '150.00'}
+        )
+        self.assertEqual(response.status_code, sync_response.status_code)
+        self.assertEqual(json.loads(response.content), sync_response.json())
+
+    @closing_pool
+    async def test_operations(self):
+        """Тест пополнения, списания и ключа идемпотентности"""
+        response = await self.operate('DEPOSIT', '50.00')
+        self.assertEqual(json.loads(response.content), {'balance': 150.0})
+        response = await self.operate('WITHDRAW', '30.00', Idempotency_Key='retry')
+        self.assertEqual(json.loads(response.content), {'balance': 120.0})
+        response = await self.operate('WITHDRAW', '30.00', Idempotency_Key='retry')
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        response = await self.operate('WITHDRAW', '10.00', Idempotency_Key='retry')
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual((await self.operate('WITHDRAW', '500.00')).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual((await self.operate('DEPOSIT', '-1')).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual((await self.operate('DEPOSIT', '1', uuid.uuid4())).status_code, status.HTTP_404_NOT_FOUND)
+
+        await self.wallet.arefresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('120.00'))
+        self.assertEqual(get_balance_cache().get(self.wallet.uuid)['balance'], Decimal('120.00'))
+
+    @closing_pool
+    async def test_sharded_and_ledger(self):
+        """Тест списания с суб-балансов и из журнала через синхронный путь"""
+        for shard_count, ledger_mode in [(3, False), (0, True)]:
+            with self.subTest(shard_count=shard_count, ledger_mode=ledger_mode):
+                await sync_to_async(self.wallet.set_ledger_mode)(False)
+                await sync_to_async(self.wallet.set_shard_count)(shard_count)
+                await sync_to_async(self.wallet.set_ledger_mode)(ledger_mode)
+                balance = (await sync_to_async(self.wallet.get_balance)())
+                response = await self.operate('DEPOSIT', '10.00')
+                self.assertEqual(json.loads(response.content), {'balance': float(balance + 10)})
+                response = await self.operate('WITHDRAW', '20.00')
+                self.assertEqual(json.loads(response.content), {'balance': float(balance - 10)})
+                self.assertEqual((await self.operate('WITHDRAW', '500.00')).status_code, status.HTTP_400_BAD_REQUEST)
+
+    @closing_pool
+    async def test_concurrent_withdrawals(self):
+        """Тест параллельных списаний в одном цикле событий"""
+        responses = await asyncio.gather(*[self.operate('WITHDRAW', '30.00') for _ in range(50)])
+        self.assertEqual(sorted(response.status_code for response in responses).count(status.HTTP_200_OK), 3)
+        await self.wallet.arefresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('10.00'))
+        self.assertEqual(await self.wallet.operations.acount(), 3)
+
+    @closing_pool
+    async def test_long_poll(self):
+        """Тест ожидания изменения без потока"""
+        etag = (await self.retrieve(self.user))['ETag']
+        started = time.monotonic()
+        waiting = asyncio.ensure_future(self.retrieve(self.user, path='/?wait=5', If_None_Match=etag))
+        await asyncio.sleep(0.2)
+        await self.operate('DEPOSIT', '1.00')
+        response = await waiting
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['balance'], '101.00')
+        self.assertLess(time.monotonic() - started, 2)
+
+    @closing_pool
+    async def test_admission(self):
+        """Тест 429 без обращения к базе при пределе одновременных операций"""
+        with mock.patch('wallets.admission._admission', None), override_settings(ADMISSION_MAX_IN_FLIGHT=1):
+            self.assertIsNone(admission.get_admission().acquire(self.wallet.uuid, self.other.pk))
+            response = await self.operate('DEPOSIT', '10.00')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(response['Retry-After'], '1')
+            admission.get_admission().release(self.wallet.uuid)
+            self.assertEqual((await self.operate('DEPOSIT', '10.00')).status_code, status.HTTP_200_OK)
+            self.assertEqual(admission.get_admission().in_flight, {})
+        await self.wallet.arefresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('110.00'))
+
+    @closing_pool
+    async def test_metrics(self):
+        """Тест метрик асинхронного запроса: запросы через пул и рендер"""
+        registry.reset()
+
+        async def view(request):
+            return await WalletRetrieveAsyncView.as_view()(request, wallet_uuid=self.wallet.uuid)
+
+        url = reverse('wallets:wallet_retrieve', args=[self.wallet.uuid])
+        request = self.factory.get(url, headers=self.headers(self.user))
+        request.resolver_match = resolve(url)
+        with override_settings(METRICS_SERVER_TIMING=True):
+            response = await RequestMetricsMiddleware(view)(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('queries"', response['Server-Timing'])
+        series = registry.series[('wallets:wallet_retrieve', 'GET')]
+        values = len(registry.buckets) + 1
+        # Состояние кошелька и отзыв токена - из пула или кэша
+        self.assertEqual(sum(series[:values]), 1)
+        self.assertGreater(series[values + 3], 0)
+        self.assertEqual(series[values + 4], len(response.content))
+
+
+class StatelessAuthTests(APITestCase):
+    """
+    Аутентификация по утверждениям токена: горячие пути без запросов пользователя и групп
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='claims@example.com')
+        self.user.set_password('qwe123')
+        self.user.save()
+        self.admin = User.objects.create(email='admin@example.com', is_superuser=True)
+        self.admin.set_password('admin123')
+        self.admin.save()
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal('100.00'))
+        self.url = reverse('wallets:wallet_retrieve', args=[self.wallet.uuid])
+        self.operation_url = reverse('wallets:wallet_operation', args=[self.wallet.uuid])
+
+    def login(self, email, password):
+        response = self.client.post(reverse('users:login'), {'email': email, 'password': password})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()
+
+    def test_claims(self):
+        """Тест утверждений токена: администратор и кошелек"""
+        token = AccessToken(self.login('claims@example.com', 'qwe123')['access'])
+        self.assertFalse(token['is_admin'])
+        self.assertEqual(token['wallet'], str(self.wallet.uuid))
+        token = AccessToken(self.login('admin@example.com', 'admin123')['access'])
+        self.assertTrue(token['is_admin'])
+        self.assertIsNone(token['wallet'])
+
+    @override_settings(JWT_STATELESS_AUTH=True)
+    def test_no_auth_queries(self):
+        """Тест горячих путей без запросов аутентификации и пермишенов"""
+        user_access = self.login('claims@example.com', 'qwe123')['access']
+        admin_access = self.login('admin@example.com', 'admin123')['access']
+        get_token_denylist().reload()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {user_access}')
+        self.client.get(self.url)
+
+        # Баланс из кэша: ни одного запроса
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {admin_access}')
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Операция: только запросы самой операции, как при force_authenticate
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {user_access}')
+        with CaptureQueriesContext(connection) as stateless:
+            response = self.client.post(self.operation_url, {'operation_type': 'DEPOSIT', 'amount': '10.00'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.credentials()
+        self.client.force_authenticate(user=self.user)
+        with CaptureQueriesContext(connection) as forced:
+            self.client.post(self.operation_url, {'operation_type': 'DEPOSIT', 'amount': '10.00'})
+        self.assertEqual(len(stateless), len(forced))
+
+        # Без утверждений токена: пользователь и группа администратора (дважды, IsAdmin | IsOwner) из базы
+        self.client.force_authenticate(user=None)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {user_access}')
+        with override_settings(JWT_STATELESS_AUTH=False), self.assertNumQueries(3):
+            self.client.get(self.url)
+
+    def test_logout(self):
+        """Тест отзыва токенов при выходе"""
+        tokens = self.login('claims@example.com', 'qwe123')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+        response = self.client.post(reverse('users:logout'), {'refresh': tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response.json()['code'], 'token_revoked')
+
+        self.client.credentials()
+        response = self.client.post(reverse('users:token_refresh'), {'refresh': tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        other = self.login('admin@example.com', 'admin123')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {other["access"]}')
+        refresh = self.login('claims@example.com', 'qwe123')['refresh']
+        response = self.client.post(reverse('users:logout'), {'refresh': refresh})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_denylist_snapshot(self):
+        """Тест снимка отозванных токенов: access-токены в памяти, refresh-токены - по таблице"""
+        tokens = self.login('claims@example.com', 'qwe123')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        self.client.post(reverse('users:logout'), {'refresh': tokens['refresh']})
+
+        # Снимок другого процесса
+        denylist = TokenDenylist(60)
+        denylist.reload()
+        access, refresh = AccessToken(tokens['access'], verify=False), RefreshToken(tokens['refresh'], verify=False)
+        self.assertEqual(denylist.tokens, {access['jti']})
+        self.assertTrue(denylist.is_revoked(access))
+        self.assertTrue(denylist.is_revoked(refresh))
+
+        # Сохранение полей, не влияющих на токены, не читает прежние значения и не отзывает токены
+        revoked = RevokedToken.objects.count()
+        with self.assertNumQueries(1):
+            self.user.save(update_fields=['last_login'])
+        self.assertEqual(RevokedToken.objects.count(), revoked)
+
+    @override_settings(JWT_STATELESS_AUTH=True)
+    def test_security_change_revokes(self):
+        """Тест отзыва токенов при смене пароля и прав"""
+        tokens = self.login('claims@example.com', 'qwe123')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        self.user.set_password('new123')
+        self.user.save()
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.post(reverse('users:token_refresh'), {'refresh': tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        # Новый вход сразу после отзыва действителен
+        access = self.login('claims@example.com', 'new123')['access']
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+
+        # Права администратора в токене отзываются вместе с группой
+        group = Group.objects.create(name='admin')
+        self.user.groups.add(group)
+        access = self.login('claims@example.com', 'new123')['access']
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        self.assertEqual(self.client.get(reverse('users:users_list')).status_code, status.HTTP_200_OK)
+        group.user_set.remove(self.user)
+        self.assertEqual(self.client.get(reverse('users:users_list')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class FastPathTests(APITestCase):
+    """
+    Скомпилированные сериализаторы и JSON на orjson: результат как у стандартных классов
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='fast@example.com')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal('100.00'))
+        self.client.force_authenticate(user=self.user)
+
+    @staticmethod
+    def errors(validate):
+        try:
+            return validate()
+        except ValidationError as e:
+            return e.detail
+
+    def assertSameValidation(self, serializer_class, compiled, payload):
+        serializer = serializer_class(data=payload)
+        expected = self.errors(lambda: serializer.is_valid(raise_exception=True) and serializer.validated_data)
+        self.assertEqual(self.errors(lambda: compiled.validate(payload)), expected)
+
+    def test_validation(self):
+        """Тест совпадения проверенных данных и ошибок со стандартным сериализатором"""
+        payloads = [
+            {'operation_type': 'DEPOSIT', 'amount': '100.50'},
+            {'operation_type': 'WITHDRAW', 'amount': 7},
+            {},
+            {'operation_type': 'REFUND', 'amount': '1'},
+            {'operation_type': 'DEPOSIT', 'amount': 'abc'},
+            {'operation_type': 'DEPOSIT', 'amount': '-5.00'},
+            {'operation_type': 'DEPOSIT', 'amount': '0'},
+            {'operation_type': 'DEPOSIT', 'amount': '1.001'},
+            {'operation_type': 'DEPOSIT', 'amount': '1' * 20},
+            {'operation_type': None, 'amount': None},
+            ['DEPOSIT', '1.00'],
+            'DEPOSIT',
+        ]
+        for payload in payloads:
+            with self.subTest(payload=payload):
+                self.assertSameValidation(OperationSerializer, compiled_operation, payload)
+        query = QueryDict('operation_type=DEPOSIT&amount=10.00')
+        self.assertSameValidation(OperationSerializer, compiled_operation, query)
+        self.assertEqual(compiled_operation.validate(query), {'operation_type': 'DEPOSIT', 'amount': Decimal('10.00')})
+
+        destination = uuid.uuid4()
+        for payload in [
+            {'source': str(self.wallet.uuid), 'destination': str(destination), 'amount': '1.00'},
+            {'source': str(self.wallet.uuid), 'destination': str(self.wallet.uuid), 'amount': '1.00'},
+            {'source': 'bad', 'amount': '-1'},
+        ]:
+            with self.subTest(payload=payload):
+                self.assertSameValidation(TransferSerializer, compiled_transfer, payload)
+
+    def test_representation(self):
+        """Тест совпадения представления кошелька со стандартным сериализатором"""
+        self.assertEqual(compiled_wallet.to_representation(self.wallet), WalletSerializer(self.wallet).data)
+        wallet = Wallet(uuid=uuid.uuid4(), balance=Decimal('0.00'))
+        self.assertEqual(compiled_wallet.to_representation(wallet), WalletSerializer(wallet).data)
+
+    def test_orjson(self):
+        """Тест рендера и разбора JSON на orjson"""
+        data = {
+            'uuid': self.wallet.uuid, 'balance': Decimal('100.00'), 'created_at': timezone.now(), 'day': date.today(),
+            'error': [ErrorDetail('Недостаточно средств', code='invalid')], 'text': 'a\u2028b\u2029', 1: None,
+            'items': ({'amount': Decimal('1.5')},),
+        }
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(
+            ORJSONRenderer().render(data, 'application/json; indent=2'),
+            JSONRenderer().render(data, 'application/json; indent=2')
+        )
+        self.assertEqual(ORJSONRenderer().render(None), b'')
+
+        body = '{"operation_type": "DEPOSIT", "amount": 1.5, "note": "ё"}'.encode()
+        self.assertEqual(ORJSONParser().parse(BytesIO(body)), JSONParser().parse(BytesIO(body)))
+        with self.assertRaises(ParseError):
+            ORJSONParser().parse(BytesIO(b'{"amount": '))
+
+    def test_fast_json_api(self):
+        """Тест API с рендерером и парсером на orjson"""
+        with override_settings(REST_FRAMEWORK={
+            **settings.REST_FRAMEWORK,
+            'DEFAULT_RENDERER_CLASSES': ('wallets.renderers.ORJSONRenderer',),
+            'DEFAULT_PARSER_CLASSES': ('wallets.renderers.ORJSONParser',),
+        }):
+            url = reverse('wallets:wallet_operation', args=[self.wallet.uuid])
+            response = self.client.post(
+                url, {'operation_type': 'DEPOSIT', 'amount': '50.00'}, format='json'
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.json(), {'balance': 150.0})
+            response = self.client.post(url, b'{"amount": ', content_type='application/json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            response = self.client.post(url, {'amount': '1.00'}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.json(), {'operation_type': ['Обязательное поле.']})
+
+            response = self.client.get(reverse('wallets:wallet_retrieve', args=[self.wallet.uuid]))
+            self.assertEqual(
+                response.json(), {'uuid': str(self.wallet.uuid), 'balance': '150.00', 'owner': self.user.pk}
+            )
+
+
+class MetricsTests(APITestCase):
+    """
+    Метрики запросов (/metrics) и заголовок Server-Timing
+    """
+
+    def setUp(self):
+        registry.reset()
+        self.user = User.objects.create(email='metrics@example.com')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal('100.00'))
+        self.client.force_authenticate(user=self.user)
+        self.operation_url = reverse('wallets:wallet_operation', args=[self.wallet.uuid])
+
+    @staticmethod
+    def scrape(client, **headers):
+        return client.get(reverse('metrics'), headers=headers)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics(self):
+        """Тест счетчиков по маршруту: время, запросы к базе, рендер, размер ответа"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.operation_url, {'operation_type': 'DEPOSIT', 'amount': '10.00'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        refused = self.client.post(self.operation_url, {'operation_type': 'WITHDRAW', 'amount': '500.00'})
+        self.client.get(f'/api/v1/wallets/{self.wallet.uuid}/unknown/')
+
+        series = registry.series[('wallets:wallet_operation', 'POST')]
+        values = len(registry.buckets) + 1
+        self.assertEqual(sum(series[:values]), 2)
+        self.assertGreaterEqual(series[values + 1], len(queries) + 1)
+        self.assertGreater(series[values + 2], 0)
+        self.assertGreater(series[values + 3], 0)
+        self.assertEqual(series[values + 4], len(response.content) + len(refused.content))
+
+        response = self.scrape(APIClient(), Authorization='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        labels = 'view="wallets:wallet_operation",method="POST"'
+        self.assertIn(f'wallet_http_request_duration_seconds_count{{{labels}}} 2', text)
+        self.assertIn(f'wallet_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2', text)
+        self.assertIn(f'wallet_http_responses_total{{{labels},status="200"}} 1', text)
+        self.assertIn(f'wallet_http_responses_total{{{labels},status="400"}} 1', text)
+        self.assertIn(f'wallet_http_db_queries_total{{{labels}}} {series[values + 1]}', text)
+        self.assertIn('wallet_http_responses_total{view="<unmatched>",method="GET",status="404"} 1', text)
+
+    @override_settings(METRICS_SERVER_TIMING=True)
+    def test_server_timing(self):
+        """Тест заголовка Server-Timing"""
+        response = self.client.get(reverse('wallets:wallet_retrieve', args=[self.wallet.uuid]))
+        total, db, render = response['Server-Timing'].split(', ')
+        self.assertTrue(total.startswith('total;dur='))
+        self.assertRegex(db, r'^db;dur=[0-9.]+;desc="\d+ queries"$')
+        self.assertTrue(render.startswith('render;dur='))
+        with override_settings(METRICS_SERVER_TIMING=False):
+            self.assertNotIn('Server-Timing', self.client.get(reverse('wallets:health')).headers)
+
+    def test_access(self):
+        """Тест доступа к /metrics: по токену метрик или JWT администратора, без них - отказ"""
+        admin = User.objects.create(email='metrics-admin@example.com', is_superuser=True)
+        for token in ('', 'secret'):
+            with self.subTest(token=token), override_settings(METRICS_TOKEN=token):
+                response = self.scrape(APIClient())
+                self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+                self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+                for header in ('Bearer ', 'Bearer wrong'):
+                    self.assertEqual(
+                        self.scrape(APIClient(), Authorization=header).status_code, status.HTTP_401_UNAUTHORIZED
+                    )
+                user_access = f'Bearer {AccessToken.for_user(self.user)}'
+                self.assertEqual(
+                    self.scrape(APIClient(), Authorization=user_access).status_code, status.HTTP_403_FORBIDDEN
+                )
+                admin_access = f'Bearer {AccessToken.for_user(admin)}'
+                self.assertEqual(self.scrape(APIClient(), Authorization=admin_access).status_code, status.HTTP_200_OK)
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.scrape(APIClient(), Authorization='Bearer secret').status_code, status.HTTP_200_OK)
+
+
+class LockContentionTests(TransactionTestCase):
+    """
+    Телеметрия ожидания блокировок строк кошельков и горячие кошельки
+    """
+
+    def setUp(self):
+        telemetry.reset()
+        self.user = User.objects.create(email='hot@example.com')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal('100.00'))
+
+    def hold_lock(self, seconds, locked):
+        """
+        Поток, держащий блокировку строки кошелька seconds секунд
+        """
+        def hold():
+            try:
+                with transaction.atomic():
+                    Wallet.objects.select_for_update().get(pk=self.wallet.pk)
+                    locked.set()
+                    time.sleep(seconds)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        locked.wait()
+        return thread
+
+    def site(self, name):
+        size = len(telemetry.buckets) + 2
+        series = telemetry.sites[name]
+        return {
+            'count': sum(series[:size - 1]), 'wait': series[size - 1],
+            'execution': series[2 * size - 1], 'contended': series[2 * size],
+        }
+
+    def test_space_saving(self):
+        """Тест наброска top-K: вытеснение наименьшего с погрешностью"""
+        sketch = SpaceSaving(2)
+        sketch.add('a', 5)
+        sketch.add('b', 1)
+        sketch.add('a', 1)
+        sketch.add('c', 2)
+        self.assertEqual(sketch.top(), [('a', 6, 0, 2), ('c', 3, 1, 1)])
+        self.assertEqual(sketch.top(1), [('a', 6, 0, 2)])
+
+    @override_settings(LOCK_WAIT_CONTENDED_MS=100)
+    def test_wait_and_execution(self):
+        """Тест раздельного учета ожидания и работы под блокировкой по движкам"""
+        for engine, site in [('locking', 'update_balance'), ('atomic', 'atomic'), ('combiner', 'batch')]:
+            with self.subTest(engine=engine):
+                thread = self.hold_lock(0.3, threading.Event())
+                get_engine(engine).apply(self.wallet.uuid, Operation.DEPOSIT, Decimal('1.00'))
+                thread.join()
+                recorded = self.site(site)
+                self.assertEqual(recorded['count'], 1)
+                self.assertEqual(recorded['contended'], 1)
+                self.assertGreater(recorded['wait'], 0.2)
+                self.assertLess(recorded['execution'], 0.2)
+
+        get_engine('atomic').apply(self.wallet.uuid, Operation.DEPOSIT, Decimal('1.00'))
+        self.assertEqual(self.site('atomic')['contended'], 1)
+        (wallet_uuid, weight, error, count), = telemetry.sketch.top()
+        self.assertEqual((wallet_uuid, count, error), (str(self.wallet.uuid), 3, 0))
+        self.assertGreater(weight, 0.6)
+
+        other = Wallet.objects.create(owner=User.objects.create(email='cold@example.com'))
+        transfer(self.wallet.uuid, other.uuid, Decimal('1.00'))
+        self.assertEqual(self.site('batch')['count'], 2)
+
+        with override_settings(METRICS_TOKEN='secret'):
+            text = APIClient().get(reverse('metrics'), headers={'Authorization': 'Bearer secret'}).content.decode()
+        self.assertIn('wallet_lock_wait_seconds_count{site="atomic"} 2', text)
+        self.assertIn('wallet_lock_execution_seconds_count{site="update_balance"} 1', text)
+        self.assertIn('wallet_lock_contended_total{site="batch"} 1', text)
+        key = metric_key(self.wallet.uuid)
+        self.assertIn(f'wallet_hot_wallet_lock_wait_seconds{{wallet="{key}"}}', text)
+        self.assertIn(f'wallet_hot_wallet_lock_wait_error_seconds{{wallet="{key}"}}', text)
+        # Ни одного uuid кошелька ни в каком написании
+        self.assertNotRegex(text, r'[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}')
+        self.assertNotIn(self.wallet.uuid.hex[:16], text)
+
+    def test_execution_until_commit(self):
+        """Тест работы под блокировкой до фиксации внешней транзакции и одного замера при смене режима"""
+        with transaction.atomic():
+            get_engine('locking').apply(self.wallet.uuid, Operation.DEPOSIT, Decimal('1.00'))
+            time.sleep(0.2)
+            self.assertEqual(telemetry.sites, {})
+        self.assertGreater(self.site('update_balance')['execution'], 0.2)
+
+        # Режим сменили между чтением кошелька и блокировкой строки
+        stale = Wallet.objects.get(pk=self.wallet.pk)
+        self.wallet.set_shard_count(2)
+        stale.update_balance(Operation.WITHDRAW, Decimal('1.00'))
+        self.assertEqual(self.site('update_balance')['count'], 1)
+        self.assertEqual(self.site('shards')['count'], 1)
+
+    def test_hot_wallets_command(self):
+        """Тест команды горячих кошельков по ожидающим запросам всех соединений"""
+        thread = self.hold_lock(1, threading.Event())
+
+        def wait():
+            try:
+                get_engine('locking').apply(self.wallet.uuid, Operation.WITHDRAW, Decimal('1.00'))
+            finally:
+                connection.close()
+
+        waiters = [threading.Thread(target=wait) for _ in range(2)]
+        for waiter in waiters:
+            waiter.start()
+        out = StringIO()
+        call_command('hot_wallets', duration=0.5, interval=0.05, stdout=out)
+        thread.join()
+        for waiter in waiters:
+            waiter.join()
+        self.assertIn(f'{self.wallet.uuid} (ключ {metric_key(self.wallet.uuid)})  ожидание', out.getvalue())
+        self.assertIn('обычный', out.getvalue())
+
+        out = StringIO()
+        call_command('hot_wallets', duration=0.1, interval=0.05, stdout=out)
+        self.assertIn('Ожиданий блокировок кошельков нет', out.getvalue())
+
+
+class AdmissionTests(APITestCase):
+    """
+    Допуск операций к кошельку: одновременные операции и корзины токенов
+    """
+
+    def setUp(self):
+        patcher = mock.patch('wallets.admission._admission', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create(email='admission@example.com')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal('100.00'))
+        self.other = Wallet.objects.create(owner=User.objects.create(email='neighbour@example.com'))
+        self.client.force_authenticate(user=self.user)
+
+    def operate(self, wallet, operation_type='DEPOSIT', amount='1.00'):
+        return self.client.post(
+            reverse('wallets:wallet_operation', args=[wallet.uuid]),
+            {'operation_type': operation_type, 'amount': amount}
+        )
+
+    def test_disabled(self):
+        """Тест работы без пределов по умолчанию"""
+        for _ in range(30):
+            self.assertEqual(self.operate(self.wallet).status_code, status.HTTP_200_OK)
+        self.assertFalse(admission.enabled())
+
+    @override_settings(ADMISSION_MAX_IN_FLIGHT=2)
+    def test_in_flight(self):
+        """Тест предела одновременных операций кошелька и освобождения после ответа"""
+        counters = admission.get_admission()
+        for _ in range(2):
+            self.assertIsNone(counters.acquire(self.wallet.uuid, self.user.pk))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.operate(self.wallet)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '1')
+        # Отказ - до блокировки строки кошелька и записи операции
+        self.assertFalse(any('FOR UPDATE' in query['sql'] or 'UPDATE' in query['sql'] for query in queries))
+        self.assertEqual(self.operate(self.other).status_code, status.HTTP_200_OK)
+
+        counters.release(self.wallet.uuid)
+        self.assertEqual(self.operate(self.wallet).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.operate(self.wallet, 'WITHDRAW', '1000.00').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(counters.in_flight, {str(self.wallet.uuid): 1})
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('101.00'))
+
+    @override_settings(ADMISSION_WALLET_RATE=2, ADMISSION_WALLET_BURST=3)
+    def test_wallet_rate(self):
+        """Тест корзины токенов кошелька: запас, отказ с Retry-After, пополнение со временем"""
+        now = time.monotonic()
+        with mock.patch('wallets.admission.time.monotonic', return_value=now) as clock:
+            for _ in range(3):
+                self.assertEqual(self.operate(self.wallet).status_code, status.HTTP_200_OK)
+            response = self.operate(self.wallet)
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(response['Retry-After'], '1')
+            self.assertEqual(self.operate(self.other).status_code, status.HTTP_200_OK)
+
+            clock.return_value = now + 0.5
+            self.assertEqual(self.operate(self.wallet).status_code, status.HTTP_200_OK)
+            self.assertEqual(self.operate(self.wallet).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(self.wallet.operations.count(), 4)
+
+    @override_settings(
+        ADMISSION_USER_RATE=0.1, ADMISSION_USER_BURST=2, ADMISSION_WALLET_RATE=0.001, ADMISSION_WALLET_BURST=5
+    )
+    def test_user_rate(self):
+        """Тест корзины пользователя по всем кошелькам; отказ не расходует токены кошелька"""
+        self.assertEqual(self.operate(self.wallet).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.operate(self.other).status_code, status.HTTP_200_OK)
+        response = self.operate(self.wallet)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertGreaterEqual(int(response['Retry-After']), 9)
+
+        self.client.force_authenticate(user=self.other.owner)
+        self.assertEqual(self.operate(self.wallet).status_code, status.HTTP_200_OK)
+        bucket = admission.get_admission().buckets[f'wallet:{self.wallet.uuid}']
+        # Списано два токена кошелька: отказ по корзине пользователя не списал третий
+        self.assertAlmostEqual(bucket[0], 3, places=2)
+
+    def test_prune(self):
+        """Тест удаления полных корзин из памяти"""
+        counters = admission.LocalAdmission()
+        counters.prune_size = 5
+        with override_settings(ADMISSION_USER_RATE=1000, ADMISSION_USER_BURST=1):
+            for user_id in range(10):
+                counters.acquire(self.wallet.uuid, user_id)
+                time.sleep(0.002)
+        self.assertLessEqual(len(counters.buckets), 6)
+
+
+REPLICA = 'replica_test'
+
+
+@override_settings(
+    DATABASE_REPLICAS=[REPLICA],
+    DATABASE_ROUTERS=['wallets.replicas.ReplicaRouter'],
+    MIDDLEWARE=['wallets.replicas.ReplicaRoutingMiddleware'] + settings.MIDDLEWARE,
+    REPLICA_LSN_CHECK_INTERVAL=0,
+)
+class ReplicaTests(TransactionTestCase):
+    """
+    Чтение с реплики: отдельное соединение с тестовой базой вместо реплики,
+    отставание имитируется позицией воспроизведения журнала
+    """
+
+    def setUp(self):
+        # Соединение потока с той же тестовой базой; вне DATABASES Django не запрещает его в тестах
+        connections[REPLICA] = type(connections['default'])(dict(connection.settings_dict), alias=REPLICA)
+        self.addCleanup(connections.__delitem__, REPLICA)
+        self.addCleanup(connections[REPLICA].close)
+        for name, value in (('_pins', None), ('_positions', {})):
+            patcher = mock.patch(f'wallets.replicas.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create(email='replica@example.com')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal('100.00'))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def read(self, url=None):
+        """
+        GET-запрос (по умолчанию - история операций кошелька); возвращает
+        (ответ, запросов к реплике, запросов к основной базе)
+        """
+        with CaptureQueriesContext(connections[REPLICA]) as replica, CaptureQueriesContext(connection) as primary:
+            response = self.client.get(url or reverse('wallets:wallet_operations', args=[self.wallet.uuid]))
+        replica_queries = [query for query in replica if 'pg_last_wal_replay_lsn' not in query['sql']]
+        return response, len(replica_queries), len(primary)
+
+    def test_reads_from_replica(self):
+        """Тест чтения GET-запросов с реплики без заполнения кэша состояния"""
+        url = reverse('wallets:wallet_retrieve', args=[self.wallet.uuid])
+        response, replica_queries, primary_queries = self.read(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['balance'], '100.00')
+        # Пользователь из токена, группы и состояние кошелька
+        self.assertGreater(replica_queries, 0)
+        self.assertEqual(primary_queries, 0)
+        self.assertIsNone(get_balance_cache().get(self.wallet.uuid))
+
+        response, replica_queries, primary_queries = self.read()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(replica_queries, 0)
+        self.assertEqual(primary_queries, 0)
+
+    def test_read_your_writes(self):
+        """Тест закрепления клиента за основной базой до воспроизведения LSN его записи репликой"""
+        response = self.client.post(
+            reverse('wallets:wallet_operation', args=[self.wallet.uuid]),
+            {'operation_type': 'DEPOSIT', 'amount': '5.00'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        written = replicas.get_pins().pinned([f'user:{self.user.pk}'])
+        self.assertGreater(written, 0)
+
+        with mock.patch('wallets.replicas.replay_position', return_value=written - 1):
+            response, replica_queries, primary_queries = self.read()
+            self.assertEqual(response.data['results'][0]['amount'], '5.00')
+            self.assertEqual(replica_queries, 0)
+            self.assertGreater(primary_queries, 0)
+
+        with mock.patch('wallets.replicas.replay_position', return_value=written):
+            response, replica_queries, primary_queries = self.read()
+            self.assertGreater(replica_queries, 0)
+            self.assertEqual(primary_queries, 0)
+
+    @override_settings(REPLICA_PIN_SECONDS=0.2)
+    def test_pin_window(self):
+        """Тест чтения с реплики по истечении окна закрепления и для незакрепленных клиентов"""
+        replicas.get_pins().pin([f'user:{self.user.pk}'], 0, settings.REPLICA_PIN_SECONDS)
+        self.assertEqual(self.read()[1], 0)
+
+        other = User.objects.create(email='replica-other@example.com', is_superuser=True)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(other)}')
+        response, replica_queries, primary_queries = self.read(reverse('users:users_list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(replica_queries, 0)
+        self.assertEqual(primary_queries, 0)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        time.sleep(0.25)
+        response, replica_queries, primary_queries = self.read()
+        self.assertGreater(replica_queries, 0)
+        self.assertEqual(primary_queries, 0)
+
+    def test_unavailable_replica(self):
+        """Тест чтения с основной базы, если реплика недоступна"""
+        connections[REPLICA].settings_dict['PORT'] = '1'
+        self.assertIsNone(replicas.replay_position(REPLICA))
+        with CaptureQueriesContext(connection) as primary:
+            response = self.client.get(reverse('wallets:wallet_operations', args=[self.wallet.uuid]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(len(primary), 0)
+
+    def test_router(self):
+        """Тест записи в основную базу и чтения с основной базы вне запросов и в транзакции"""
+        self.assertEqual(router.db_for_read(Wallet), 'default')
+        token = replicas._replica.set(REPLICA)
+        try:
+            self.assertEqual(router.db_for_read(Wallet), REPLICA)
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Wallet), 'default')
+            wallet = Wallet.objects.get(pk=self.wallet.pk)
+            self.assertEqual(wallet._state.db, REPLICA)
+            self.assertEqual(router.db_for_write(Wallet, instance=wallet), 'default')
+        finally:
+            replicas._replica.reset(token)
+        self.assertFalse(router.allow_migrate(REPLICA, 'wallets'))
+        self.assertEqual(replicas.parse_lsn('16/B374D848'), (0x16 << 32) + 0xB374D848)
+
+
+SHARD = 'shard_test'
+
+
+@override_settings(WALLET_SHARDS=['default', SHARD], DATABASE_ROUTERS=['wallets.sharding.ShardRouter'])
+class ShardingTests(TransactionTestCase):
+    """
+    Шардирование: второй шард - схема shard_test в тестовой базе со своим
+    соединением (search_path), миграции применяются к нему отдельно
+    """
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE SCHEMA {SHARD}')
+        self.addCleanup(self.drop_schema)
+        settings_dict = dict(connection.settings_dict)
+        settings_dict['OPTIONS'] = {**settings_dict['OPTIONS'], 'options': f'-c search_path={SHARD}'}
+        connections[SHARD] = type(connections['default'])(settings_dict, alias=SHARD)
+        self.addCleanup(connections.__delitem__, SHARD)
+        self.addCleanup(connections[SHARD].close)
+        call_command('migrate', database=SHARD, verbosity=0)
+        patcher = mock.patch('wallets.sharding._locations', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create(email='shard@example.com')
+        self.other = User.objects.create(email='shard-other@example.com')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    @staticmethod
+    def drop_schema():
+        # Соединение шарда к этому времени уже закрыто
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP SCHEMA {SHARD} CASCADE')
+
+    def create(self, user, alias, balance='0.00'):
+        with sharding.use_shard(alias):
+            return Wallet.objects.create(owner=user, balance=Decimal(balance))
+
+    def deposit(self, wallet, amount, **extra):
+        return self.client.post(
+            reverse('wallets:wallet_operation', args=[wallet.uuid]),
+            {'operation_type': 'DEPOSIT', 'amount': amount}, **extra
+        )
+
+    @staticmethod
+    def statement(queryset):
+        return queryset.values('day').annotate(
+            total=Sum('deposit_total'), count=Sum('deposit_count')
+        ).order_by('day').values_list('day', 'total', 'count')
+
+    def test_placement(self):
+        """Тест размещения: шард определяется uuid и не меняется, кошельки делятся между шардами"""
+        uuids = [uuid.uuid4() for _ in range(200)]
+        shards = [sharding.placement(wallet_uuid) for wallet_uuid in uuids]
+        self.assertEqual(shards, [sharding.placement(str(wallet_uuid)) for wallet_uuid in uuids])
+        self.assertGreater(shards.count(SHARD), 50)
+        self.assertGreater(shards.count('default'), 50)
+        with override_settings(WALLET_SHARDS=['default']):
+            self.assertEqual(sharding.placement(uuids[0]), 'default')
+
+    def test_owner_constraint(self):
+        """Тест внешнего ключа владельца: в default он есть, в другом шарде пользователей нет - снят"""
+        for alias, expected in (('default', True), (SHARD, False)):
+            with connections[alias].cursor() as cursor:
+                constraints = connections[alias].introspection.get_constraints(cursor, Wallet._meta.db_table)
+            owner = [item for item in constraints.values() if item['foreign_key'] and item['columns'] == ['owner_id']]
+            self.assertEqual(bool(owner), expected, alias)
+
+    def test_create_and_operate(self):
+        """Тест создания кошелька в шарде, операций, истории и одного кошелька на пользователя во всех шардах"""
+        with mock.patch('wallets.serializers.placement', return_value=SHARD):
+            response = self.client.post(reverse('wallets:wallet_create'), {})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        wallet = Wallet.objects.using(SHARD).get(uuid=response.data['uuid'])
+        self.assertFalse(Wallet.objects.filter(uuid=wallet.uuid).exists())
+        self.assertEqual(WalletDirectory.objects.get(owner=self.user).alias, SHARD)
+
+        with mock.patch('wallets.serializers.placement', return_value='default'):
+            response = self.client.post(reverse('wallets:wallet_create'), {})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Wallet.objects.count(), 0)
+
+        response = self.deposit(wallet, '25.00', HTTP_IDEMPOTENCY_KEY='shard-key')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['balance'], Decimal('25.00'))
+        response = self.client.get(reverse('wallets:wallet_retrieve', args=[wallet.uuid]))
+        self.assertEqual(response.data['balance'], '25.00')
+        response = self.client.get(reverse('wallets:wallet_operations', args=[wallet.uuid]))
+        self.assertEqual([item['amount'] for item in response.data['results']], ['25.00'])
+        self.assertEqual(Operation.objects.using(SHARD).count(), 1)
+        self.assertEqual(IdempotencyKey.objects.using(SHARD).count(), 1)
+        self.assertEqual(Operation.objects.count(), 0)
+
+        response = self.client.get(reverse('wallets:wallet_retrieve', args=[uuid.uuid4()]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_rebalance(self):
+        """Тест переноса кошелька со всей историей и запроса по устаревшему адресу кошелька"""
+        wallet = self.create(self.user, 'default')
+        for amount in ('10.00', '20.00'):
+            self.assertEqual(self.deposit(wallet, amount, HTTP_IDEMPOTENCY_KEY=amount).status_code, status.HTTP_200_OK)
+        wallet.set_ledger_mode(True)
+        self.deposit(wallet, '5.00')
+        statement = list(self.statement(DailyStatement.objects.all()))
+
+        out = StringIO()
+        call_command('rebalance_wallets', wallet=str(wallet.uuid), to=SHARD, stdout=out)
+        self.assertIn('Перенесено кошельков: 1 из 1', out.getvalue())
+        self.assertFalse(Wallet.objects.filter(uuid=wallet.uuid).exists())
+        self.assertEqual(Operation.objects.count(), 0)
+        self.assertEqual(WalletDirectory.objects.get(wallet_uuid=wallet.uuid).alias, SHARD)
+        moved = Wallet.objects.using(SHARD).get(uuid=wallet.uuid)
+        self.assertTrue(moved.ledger_mode)
+        with sharding.use_shard(SHARD):
+            self.assertEqual(moved.get_balance(), Decimal('35.00'))
+        self.assertEqual(
+            sorted(Operation.objects.using(SHARD).values_list('amount', 'compacted')),
+            [(Decimal('5.00'), False), (Decimal('10.00'), True), (Decimal('20.00'), True)]
+        )
+        self.assertEqual(IdempotencyKey.objects.using(SHARD).count(), 2)
+        self.assertEqual(list(self.statement(DailyStatement.objects.using(SHARD))), statement)
+
+        # Процесс еще считает кошелек в default: запрос повторяется в новом шарде
+        sharding.remember(wallet.uuid, 'default')
+        response = self.client.get(reverse('wallets:wallet_retrieve', args=[wallet.uuid]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['balance'], '35.00')
+        sharding.remember(wallet.uuid, 'default')
+        self.assertEqual(self.deposit(wallet, '1.00').data['balance'], Decimal('36.00'))
+
+        out = StringIO()
+        call_command('rebalance_wallets', dry_run=True, stdout=out)
+        expected = 'Все кошельки на своих шардах' if sharding.placement(wallet.uuid) == SHARD else '-> default'
+        self.assertIn(expected, out.getvalue())
+
+    def test_repair(self):
+        """Тест сверки справочника: копия после сбоя, кошелек без записи, запись без кошелька"""
+        wallet = self.create(self.user, SHARD, '10.00')
+        with sharding.use_shard('default'):
+            Wallet.objects.bulk_create([Wallet(uuid=wallet.uuid, owner=self.user, balance=Decimal('10.00'))])
+        orphan = self.create(self.other, SHARD)
+        WalletDirectory.objects.filter(wallet_uuid=orphan.uuid).delete()
+        third = User.objects.create(email='shard-third@example.com')
+        WalletDirectory.objects.create(wallet_uuid=uuid.uuid4(), owner=third, alias=SHARD)
+
+        call_command('rebalance_wallets', repair=True, stdout=StringIO())
+        self.assertFalse(Wallet.objects.filter(uuid=wallet.uuid).exists())
+        self.assertTrue(Wallet.objects.using(SHARD).filter(uuid=wallet.uuid).exists())
+        self.assertEqual(
+            sorted(WalletDirectory.objects.values_list('wallet_uuid', 'alias')),
+            sorted([(wallet.uuid, SHARD), (orphan.uuid, SHARD)])
+        )
+
+    def test_transfer(self):
+        """Тест перевода между шардами и возврата списания при ошибке пополнения"""
+        source = self.create(self.user, 'default', '100.00')
+        destination = self.create(self.other, SHARD, '10.00')
+        response = self.client.post(
+            reverse('wallets:transfer'), {'source': source.uuid, 'destination': destination.uuid, 'amount': '30.00'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['balance'], Decimal('70.00'))
+        self.assertEqual(Wallet.objects.using(SHARD).get(uuid=destination.uuid).balance, Decimal('40.00'))
+        transfer_id = response.data['transfer_id']
+        self.assertEqual(Operation.objects.get(transfer_id=transfer_id).operation_type, Operation.WITHDRAW)
+        self.assertEqual(Operation.objects.using(SHARD).get(transfer_id=transfer_id).operation_type, Operation.DEPOSIT)
+
+        apply_operations = engines.apply_operations
+
+        def unavailable(batch, all_or_nothing=False):
+            if sharding.wallet_db() == SHARD:
+                raise DatabaseError('Шард недоступен')
+            return apply_operations(batch, all_or_nothing)
+
+        with mock.patch('wallets.engines.apply_operations', unavailable), self.assertRaises(DatabaseError):
+            engines.transfer(source.uuid, destination.uuid, Decimal('20.00'))
+        source.refresh_from_db()
+        self.assertEqual(source.balance, Decimal('70.00'))
+        self.assertEqual(Operation.objects.filter(amount=Decimal('20.00')).count(), 2)
+
+        response = self.client.post(
+            reverse('wallets:transfer'), {'source': source.uuid, 'destination': uuid.uuid4(), 'amount': '1.00'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_batch(self):
+        """Тест пачки: all_or_nothing - только в одном шарде, per_item - в нескольких"""
+        first = self.create(self.user, 'default', '10.00')
+        second = self.create(self.other, SHARD, '10.00')
+        self.client.force_authenticate(user=User.objects.create(email='shard-admin@example.com', is_superuser=True))
+        operations = [
+            {'wallet_uuid': str(wallet.uuid), 'operation_type': 'DEPOSIT', 'amount': '1.00'}
+            for wallet in (first, second)
+        ]
+        response = self.client.post(reverse('wallets:batch_operation'), {'operations': operations}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('одного шарда', response.data['error'])
+
+        response = self.client.post(
+            reverse('wallets:batch_operation'), {'mode': 'per_item', 'operations': operations}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result['balance'] for result in response.data['results']], [Decimal('11.00')] * 2)
+
+    def test_delete_user(self):
+        """Тест удаления пользователя вместе с кошельком в другом шарде и записью справочника"""
+        wallet = self.create(self.user, SHARD)
+        self.user.delete()
+        self.assertFalse(Wallet.objects.using(SHARD).filter(uuid=wallet.uuid).exists())
+        self.assertFalse(WalletDirectory.objects.exists())
+
+
+@override_settings(WALLET_LONG_POLL_INTERVAL=0.05)
+class QueuedOperationTests(TransactionTestCase):
+    """
+    Асинхронный режим операций: прием в очередь (202), обработка и статус
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='queue@example.com')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal('10.00'))
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def accept(self, operation_type, amount, wallet=None, **headers):
+        return self.client.post(
+            reverse('wallets:wallet_operation', args=[(wallet or self.wallet).uuid]),
+            {'operation_type': operation_type, 'amount': amount},
+            HTTP_PREFER='respond-async', **headers
+        )
+
+    def status(self, response, **params):
+        return self.client.get(response['Location'], params)
+
+    @override_settings(OPERATION_QUEUE_EAGER=True)
+    def test_eager(self):
+        """Тест приема с ответом 202 и обработки сразу после фиксации в режиме OPERATION_QUEUE_EAGER"""
+        response = self.accept('DEPOSIT', '5.00')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response['Preference-Applied'], 'respond-async')
+        self.assertEqual(response.data['status'], QueuedOperation.PENDING)
+        self.assertEqual(
+            response['Location'], reverse('wallets:queued_operation', args=[self.wallet.uuid, response.data['id']])
+        )
+        response = self.status(response)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], QueuedOperation.DONE)
+        self.assertEqual(response.data['balance'], '15.00')
+
+        response = self.status(self.accept('WITHDRAW', '50.00'))
+        self.assertEqual(response.data['status'], QueuedOperation.FAILED)
+        self.assertEqual(response.data['error'], 'Недостаточно средств')
+        self.assertIsNone(response.data['balance'])
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('15.00'))
+
+    def test_worker_fifo(self):
+        """Тест обработки очереди пулом: операции кошелька по порядку приема, отказ не останавливает очередь"""
+        other = Wallet.objects.create(owner=User.objects.create(email='queue-other@example.com'))
+        accepted = [
+            self.accept('DEPOSIT', '5.00'),
+            self.accept('WITHDRAW', '20.00'),
+            self.accept('WITHDRAW', '15.00'),
+            self.accept('DEPOSIT', '1.00'),
+        ]
+        self.assertTrue(all(response.status_code == status.HTTP_202_ACCEPTED for response in accepted))
+        self.client.force_authenticate(user=other.owner)
+        other_response = self.accept('DEPOSIT', '3.00', wallet=other)
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(Operation.objects.count(), 0)
+
+        call_command('process_operations', workers=2, batch_size=3, interval=0, stdout=StringIO())
+        results = [self.status(response).data for response in accepted]
+        self.assertEqual(
+            [(result['status'], result['balance']) for result in results],
+            [('DONE', '15.00'), ('FAILED', None), ('DONE', '0.00'), ('DONE', '1.00')]
+        )
+        self.client.force_authenticate(user=other.owner)
+        self.assertEqual(self.status(other_response).data['balance'], '3.00')
+        self.assertEqual(Operation.objects.filter(wallet=self.wallet).count(), 3)
+        self.assertFalse(QueuedOperation.objects.filter(status=QueuedOperation.PENDING).exists())
+
+    def test_idempotency(self):
+        """Тест повтора приема с тем же ключом: та же операция, другие параметры - 422"""
+        first = self.accept('DEPOSIT', '5.00', HTTP_IDEMPOTENCY_KEY='payout-1')
+        second = self.accept('DEPOSIT', '5.00', HTTP_IDEMPOTENCY_KEY='payout-1')
+        self.assertEqual(second.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(second.data['id'], first.data['id'])
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        response = self.accept('DEPOSIT', '6.00', HTTP_IDEMPOTENCY_KEY='payout-1')
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        call_command('process_operations', interval=0, stdout=StringIO())
+        self.assertEqual(IdempotencyKey.objects.get(key='payout-1').balance, Decimal('15.00'))
+        # После обработки повтор в любом режиме получает сохраненный результат
+        response = self.accept('DEPOSIT', '5.00', HTTP_IDEMPOTENCY_KEY='payout-1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['balance'], Decimal('15.00'))
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('15.00'))
+
+    def test_wait(self):
+        """Тест ожидания обработки с параметром wait"""
+        response = self.accept('DEPOSIT', '5.00')
+        started = time.monotonic()
+        self.assertEqual(self.status(response, wait=0.2).data['status'], QueuedOperation.PENDING)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+        def process():
+            try:
+                operation_queue.process_wallet(self.wallet.uuid)
+            finally:
+                connection.close()
+
+        timer = threading.Timer(0.1, process)
+        timer.start()
+        self.addCleanup(timer.join)
+        started = time.monotonic()
+        result = self.status(response, wait=5).data
+        self.assertEqual(result['status'], QueuedOperation.DONE)
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_not_found_and_permissions(self):
+        """Тест приема для несуществующего кошелька, статуса чужой и неизвестной операции"""
+        response = self.client.post(
+            reverse('wallets:wallet_operation', args=[uuid.uuid4()]),
+            {'operation_type': 'DEPOSIT', 'amount': '1.00'}, HTTP_PREFER='respond-async'
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(QueuedOperation.objects.exists())
+
+        response = self.accept('DEPOSIT', '1.00')
+        url = reverse('wallets:queued_operation', args=[self.wallet.uuid, uuid.uuid4()])
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        self.client.force_authenticate(user=User.objects.create(email='queue-stranger@example.com'))
+        self.assertEqual(self.status(response).status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(OPERATION_QUEUE_EAGER=True, OPERATION_QUEUE_RETENTION_HOURS=1)
+    def test_purge(self):
+        """Тест удаления обработанных операций по истечении срока хранения"""
+        old, recent = self.accept('DEPOSIT', '1.00'), self.accept('DEPOSIT', '2.00')
+        pending = QueuedOperation.objects.create(wallet=self.wallet, operation_type='DEPOSIT', amount=Decimal('3.00'))
+        QueuedOperation.objects.filter(pk=old.data['id']).update(processed_at=timezone.now() - timedelta(hours=2))
+        self.assertEqual(operation_queue.purge(100), 1)
+        self.assertEqual(
+            set(QueuedOperation.objects.values_list('pk', flat=True)), {uuid.UUID(recent.data['id']), pending.pk}
+        )
+
+
+@override_settings(WALLET_LONG_POLL_INTERVAL=0.05, WALLET_PUSH_HEARTBEAT=0.2)
+class PushTests(TransactionTestCase):
+    """
+    Поток изменений баланса: Server-Sent Events, WebSocket и продолжение с версии
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='push@example.com')
+        self.other = User.objects.create(email='push-other@example.com')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal('100.00'))
+        self.factory = AsyncRequestFactory()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def token(self, user):
+        token = AccessToken.for_user(user)
+        token['auth_time'] = time.time()
+        return f'Bearer {token}'
+
+    async def events(self, user=None, wallet_uuid=None, data=None, **headers):
+        if user is not None:
+            headers['Authorization'] = self.token(user)
+        request = self.factory.get('/', data, headers=headers)
+        return await WalletEventsView.as_view()(request, wallet_uuid=wallet_uuid or self.wallet.uuid)
+
+    def deposit(self, amount):
+        # Синхронный путь: состояние попадает в кэш после фиксации update_balance
+        response = self.client.post(
+            reverse('wallets:wallet_operation', args=[self.wallet.uuid]),
+            {'operation_type': 'DEPOSIT', 'amount': amount}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def version(self):
+        return Wallet.get_state(self.wallet.uuid)['version']
+
+    @staticmethod
+    async def receive(stream):
+        chunk = await asyncio.wait_for(anext(stream), 5)
+        if chunk.startswith(b':') or chunk.startswith(b'retry'):
+            return chunk
+        fields = dict(line.split(': ', 1) for line in chunk.decode().strip().split('\n'))
+        return {'id': int(fields['id']), 'event': fields['event'], 'data': json.loads(fields['data'])}
+
+    @closing_pool
+    async def test_sse(self):
+        """Тест текущего состояния при подключении, событий после операций и поддержания соединения"""
+        version = await sync_to_async(self.version)()
+        response = await self.events(self.user)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = response.streaming_content
+        self.assertEqual(await self.receive(stream), b'retry: 1000\n\n')
+        self.assertEqual(await self.receive(stream), {
+            'id': version, 'event': 'balance',
+            'data': {'uuid': str(self.wallet.uuid), 'balance': '100.00', 'owner': self.user.pk}
+        })
+
+        await sync_to_async(self.deposit)('50.00')
+        event = await self.receive(stream)
+        self.assertGreater(event['id'], version)
+        self.assertEqual(event['data']['balance'], '150.00')
+        self.assertEqual(await self.receive(stream), b': keep-alive\n\n')
+        await stream.aclose()
+
+    @closing_pool
+    async def test_resume(self):
+        """Тест продолжения с версии: пропущенные изменения приходят сразу одним событием"""
+        version = await sync_to_async(self.version)()
+        stream = (await self.events(self.user, Last_Event_ID=str(version))).streaming_content
+        await self.receive(stream)
+        self.assertEqual(await self.receive(stream), b': keep-alive\n\n')
+        await stream.aclose()
+
+        await sync_to_async(self.deposit)('10.00')
+        await sync_to_async(self.deposit)('20.00')
+        latest = await sync_to_async(self.version)()
+        for headers, data in [({'Last_Event_ID': str(version)}, None), ({}, {'version': version})]:
+            stream = (await self.events(self.user, data=data, **headers)).streaming_content
+            await self.receive(stream)
+            event = await self.receive(stream)
+            self.assertEqual((event['id'], event['data']['balance']), (latest, '130.00'))
+            await stream.aclose()
+
+        # Last-Event-ID переподключения EventSource важнее версии из адреса
+        stream = (await self.events(self.user, data={'version': version}, Last_Event_ID=str(latest))).streaming_content
+        await self.receive(stream)
+        self.assertEqual(await self.receive(stream), b': keep-alive\n\n')
+        await stream.aclose()
+
+        response = await self.events(self.user, data={'version': 'last'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @closing_pool
+    async def test_permissions(self):
+        """Тест доступа к потоку: только владелец, кошелек должен существовать, только под ASGI"""
+        self.assertEqual((await self.events(self.other)).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual((await self.events()).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual((await self.events(self.user, uuid.uuid4())).status_code, status.HTTP_404_NOT_FOUND)
+        response = await sync_to_async(self.client.get)(reverse('wallets:wallet_events', args=[self.wallet.uuid]))
+        self.assertEqual(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+
+    @closing_pool
+    async def test_deleted(self):
+        """Тест события deleted и закрытия потока при удалении кошелька"""
+        stream = (await self.events(self.user)).streaming_content
+        await self.receive(stream)
+        await self.receive(stream)
+        await Wallet.objects.filter(pk=self.wallet.pk).adelete()
+        get_balance_cache().delete(self.wallet.uuid)
+        event = await self.receive(stream)
+        self.assertEqual((event['event'], event['data']), ('deleted', {'uuid': str(self.wallet.uuid)}))
+        with self.assertRaises(StopAsyncIteration):
+            await self.receive(stream)
+
+    async def websocket(self, path, user=None, query=b''):
+        from config.asgi import application
+
+        headers = [(b'authorization', self.token(user).encode())] if user is not None else []
+        scope = {'type': 'websocket', 'path': path, 'query_string': query, 'headers': headers}
+        inbox, outbox = asyncio.Queue(), asyncio.Queue()
+        await inbox.put({'type': 'websocket.connect'})
+        task = asyncio.ensure_future(application(scope, inbox.get, outbox.put))
+        return inbox, outbox, task
+
+    @staticmethod
+    async def message(outbox):
+        return await asyncio.wait_for(outbox.get(), 5)
+
+    @closing_pool
+    async def test_websocket(self):
+        """Тест потока по WebSocket через config.asgi и отказов с кодами закрытия"""
+        path = reverse('wallets:wallet_events', args=[self.wallet.uuid])
+        version = await sync_to_async(self.version)()
+        inbox, outbox, task = await self.websocket(path, self.user, f'version={version}'.encode())
+        self.assertEqual(await self.message(outbox), {'type': 'websocket.accept'})
+        await sync_to_async(self.deposit)('5.00')
+        message = json.loads((await self.message(outbox))['text'])
+        self.assertEqual((message['event'], message['data']['balance']), ('balance', '105.00'))
+        self.assertGreater(message['version'], version)
+        await inbox.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(task, 5)
+
+        for user, query, code in [(self.other, b'', 4403), (None, b'', 4401), (self.user, b'version=-1', 4400)]:
+            with self.subTest(code=code):
+                _, outbox, task = await self.websocket(path, user, query)
+                self.assertEqual(await self.message(outbox), {'type': 'websocket.accept'})
+                self.assertEqual((await self.message(outbox))['code'], code)
+                await asyncio.wait_for(task, 5)
+
+        _, outbox, task = await self.websocket(reverse('wallets:wallet_retrieve', args=[self.wallet.uuid]), self.user)
+        self.assertEqual(await self.message(outbox), {'type': 'websocket.close', 'code': 4404})
+        await asyncio.wait_for(task, 5)
@@ -1,13 +1,34 @@
+from django.conf import settings
 from django.urls import path
 
 from wallets.apps import WalletsConfig
-from wallets.views import WalletCreateView, WalletOperationView, WalletRetrieveView, WalletDestroyApiView
+from wallets.views import (
+    WalletCreateView, WalletOperationView, WalletRetrieveView, WalletDestroyApiView, BatchOperationView,
+    BalanceCacheStatsView, OperationListView, WalletOperationAsyncView, WalletRetrieveAsyncView, HealthView,
+    DatabasePoolStatsView, TransferView, StatementView, QueuedOperationView
+)
+from wallets.push import WalletEventsView
 
 app_name = WalletsConfig.name
 
+# Асинхронные представления баланса и операций (ASGI-сервер), по умолчанию синхронные
+if settings.WALLET_ASYNC_VIEWS:
+    WalletOperationView, WalletRetrieveView = WalletOperationAsyncView, WalletRetrieveAsyncView
+
 urlpatterns = [
     path('create/', WalletCreateView.as_view(), name='wallet_create'),
+    path('operations/batch/', BatchOperationView.as_view(), name='batch_operation'),
+    path('transfer/', TransferView.as_view(), name='transfer'),
+    path('cache/stats/', BalanceCacheStatsView.as_view(), name='cache_stats'),
+    path('db/stats/', DatabasePoolStatsView.as_view(), name='db_pool_stats'),
+    path('health/', HealthView.as_view(), name='health'),
     path('<uuid:wallet_uuid>/operation/', WalletOperationView.as_view(), name='wallet_operation'),
+    path('<uuid:wallet_uuid>/operations/', OperationListView.as_view(), name='wallet_operations'),
+    path(
+        '<uuid:wallet_uuid>/operations/<uuid:operation_id>/', QueuedOperationView.as_view(), name='queued_operation'
+    ),
+    path('<uuid:wallet_uuid>/events/', WalletEventsView.as_view(), name='wallet_events'),
+    path('<uuid:wallet_uuid>/statement/', StatementView.as_view(), name='wallet_statement'),
     path('<uuid:wallet_uuid>/', WalletRetrieveView.as_view(), name='wallet_retrieve'),
     path('<uuid:uuid>/destroy/', WalletDestroyApiView.as_view(), name='wallet_destroy'),
 ]
@@ -1,15 +1,88 @@
-from rest_framework.exceptions import ValidationError
-from rest_framework.generics import UpdateAPIView, DestroyAPIView, CreateAPIView
-from rest_framework.permissions import IsAuthenticated
-from rest_framework.views import APIView
+import os
+import time
+from io import BytesIO
+
+from asgiref.sync import sync_to_async
+
+from rest_framework.exceptions import (
+    ValidationError, NotAuthenticated, AuthenticationFailed, PermissionDenied
+)
+from rest_framework.generics import UpdateAPIView, DestroyAPIView, CreateAPIView, ListAPIView
+from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView, exception_handler
 from rest_framework.response import Response
 from rest_framework import status
-from django.shortcuts import get_object_or_404
-from django.db import IntegrityError
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db import DatabaseError, IntegrityError, connection, router, transaction
+from django.http import Http404, HttpResponse
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare
+from django.utils.http import parse_etags, quote_etag
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 
+from users.authentication import AsyncJWTAuthentication, ClaimsJWTAuthentication
 from users.permissions import IsAdmin, IsYourObject, IsOwner
-from wallets.models import Wallet, Operation
-from wallets.serializers import OperationSerializer, WalletSerializer, WalletCreateSerializer
+from wallets import async_db
+from wallets.admission import aadmit, admit
+from wallets.cache import get_balance_cache, run_cache
+from wallets.contention import telemetry
+from wallets.engines import get_engine, apply_on_shards, transfer, PendingOperation, wallet_not_found
+from wallets.metrics import registry, render_finished
+from wallets.models import Wallet, Operation, IdempotencyKey, DailyStatement, QueuedOperation
+from wallets.operation_queue import enqueue
+from wallets.pagination import KeysetPagination
+from wallets.serializers import (
+    WalletSerializer, WalletCreateSerializer, BatchOperationSerializer,
+    OperationHistorySerializer, OperationFilterSerializer, StatementFilterSerializer, StatementDaySerializer,
+    StatementTotalSerializer, QueuedOperationSerializer, compiled_operation, compiled_transfer, compiled_wallet
+)
+from wallets.sharding import on_shard, on_wallet_shard, wallet_db
+
+
+def get_wallet_state(wallet_uuid, cache=None, refresh=False):
+    """
+    Состояние кошелька из кэша; при промахе или refresh - одним запросом из базы
+    """
+    cache = cache or get_balance_cache()
+    state = None if refresh else cache.get(wallet_uuid)
+    if state is None:
+        using = router.db_for_read(Wallet)
+        state = Wallet.get_state(wallet_uuid, using)
+        if state is None:
+            raise wallet_not_found()
+        # Кэш заполняется только с основной базы шарда: отстающая реплика не запишет в него старое состояние
+        if using == wallet_db():
+            cache.set(wallet_uuid, state)
+    if state['balance'] is None:
+        raise wallet_not_found()
+    return state
+
+
+async def aget_wallet_state(wallet_uuid, cache=None, refresh=False):
+    """
+    get_wallet_state для асинхронных представлений
+    """
+    cache = cache or get_balance_cache()
+    state = None if refresh else await run_cache(cache, cache.get, wallet_uuid)
+    if state is None:
+        state = await Wallet.aget_state(wallet_uuid)
+        if state is None:
+            raise wallet_not_found()
+        await run_cache(cache, cache.set, wallet_uuid, state)
+    if state['balance'] is None:
+        raise wallet_not_found()
+    return state
+
+
+def respond_async(request) -> bool:
+    """
+    Клиент просит асинхронный режим: Prefer: respond-async (RFC 7240)
+    """
+    preferences = request.headers.get('Prefer', '').split(',')
+    return any(preference.split(';')[0].strip().lower() == 'respond-async' for preference in preferences)
 
 
 class WalletCreateView(APIView):
@@ -25,7 +98,8 @@ class WalletCreateView(APIView):
                 serializer.save()
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
             except IntegrityError as e:
-                if 'wallets_wallet_owner_id_key' in str(e):
+                # Второй кошелек владельца в том же шарде или в справочнике шардов
+                if 'wallets_wallet_owner_id_key' in str(e) or 'wallets_walletdirectory_owner_id_key' in str(e):
                     return Response(
                         {'detail': 'У пользователя уже есть кошелек'},
                         status=status.HTTP_400_BAD_REQUEST
@@ -36,18 +110,121 @@ class WalletCreateView(APIView):
 
 class WalletRetrieveView(APIView):
     """
-    Просмотр кошелька
+    Просмотр кошелька.
+
+    Ответ содержит ETag - версию состояния кошелька. Запрос с совпадающим
+    If-None-Match получает 304 без сериализации; с параметром wait (секунды,
+    не больше WALLET_LONG_POLL_MAX_WAIT) ответ откладывается до изменения
+    версии или истечения ожидания.
     """
     permission_classes = (IsAdmin | IsOwner,)
 
+    @on_wallet_shard
     def get(self, request, wallet_uuid):
-        wallet = get_object_or_404(Wallet, uuid=wallet_uuid)
+        cache = get_balance_cache()
+        state = get_wallet_state(wallet_uuid, cache)
+        wallet = Wallet(uuid=wallet_uuid, balance=state['balance'], owner_id=state['owner'], version=state['version'])
 
         # Проверка пермишенов для объекта
         self.check_object_permissions(request, wallet)
 
-        serializer = WalletSerializer(wallet)
-        return Response(serializer.data)
+        etags = parse_etags(request.headers.get('If-None-Match', ''))
+        if self.etag(state) in etags:
+            state = self.wait_for_change(cache, wallet_uuid, state, self.wait_seconds(request.query_params))
+            wallet = Wallet(uuid=wallet_uuid, balance=state['balance'], owner_id=state['owner'])
+        if self.etag(state) in etags or '*' in etags:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': self.etag(state)})
+
+        return Response(compiled_wallet.to_representation(wallet), headers={'ETag': self.etag(state)})
+
+    def wait_for_change(self, cache, wallet_uuid, state, seconds):
+        """
+        Ожидание новой версии. Кэш процесса не видит записей других
+        процессов, поэтому версия перечитывается из базы каждые
+        WALLET_LONG_POLL_INTERVAL секунд.
+        """
+        deadline = time.monotonic() + seconds
+        while (remaining := deadline - time.monotonic()) > 0:
+            if not cache.shared:
+                remaining = min(remaining, settings.WALLET_LONG_POLL_INTERVAL)
+            changed = cache.wait(wallet_uuid, state['version'], remaining)
+            current = get_wallet_state(wallet_uuid, cache, refresh=not changed and not cache.shared)
+            if current['version'] != state['version']:
+                return current
+        return state
+
+    @staticmethod
+    def wait_seconds(query_params):
+        try:
+            seconds = float(query_params.get('wait', 0))
+        except ValueError:
+            raise ValidationError({'wait': 'Должно быть числом секунд'})
+        return min(max(seconds, 0), settings.WALLET_LONG_POLL_MAX_WAIT)
+
+    @staticmethod
+    def etag(state):
+        return quote_etag(str(state['version']))
+
+
+class OperationListView(ListAPIView):
+    """
+    История операций кошелька, от новых к старым
+    """
+    serializer_class = OperationHistorySerializer
+    pagination_class = KeysetPagination
+    permission_classes = (IsAdmin | IsOwner,)
+
+    @on_wallet_shard
+    def list(self, request, wallet_uuid):
+        state = get_wallet_state(wallet_uuid)
+        # Проверка пермишенов для объекта
+        self.check_object_permissions(request, Wallet(uuid=wallet_uuid, owner_id=state['owner']))
+        return super().list(request, wallet_uuid)
+
+    def get_queryset(self):
+        filters = OperationFilterSerializer(data=self.request.query_params)
+        filters.is_valid(raise_exception=True)
+
+        # Только столбцы индекса истории - чтение без обращения к таблице
+        queryset = Operation.objects.filter(wallet_id=self.kwargs['wallet_uuid']).only(
+            'id', 'operation_type', 'amount', 'created_at'
+        )
+        if 'operation_type' in filters.validated_data:
+            queryset = queryset.filter(operation_type=filters.validated_data['operation_type'])
+        if 'created_after' in filters.validated_data:
+            queryset = queryset.filter(created_at__gte=filters.validated_data['created_after'])
+        if 'created_before' in filters.validated_data:
+            queryset = queryset.filter(created_at__lt=filters.validated_data['created_before'])
+        return queryset
+
+
+class StatementView(APIView):
+    """
+    Выписка кошелька: итоги по дням из дневных итогов, без чтения операций
+    """
+    permission_classes = (IsAdmin | IsOwner,)
+
+    @on_wallet_shard
+    def get(self, request, wallet_uuid):
+        state = get_wallet_state(wallet_uuid)
+        # Проверка пермишенов для объекта
+        self.check_object_permissions(request, Wallet(uuid=wallet_uuid, owner_id=state['owner']))
+
+        filters = StatementFilterSerializer(data=request.query_params)
+        filters.is_valid(raise_exception=True)
+        date_from, date_to = filters.validated_data['from'], filters.validated_data['to']
+        days = list(DailyStatement.for_wallet(wallet_uuid, date_from, date_to))
+        total = {
+            field: sum(day[field] for day in days)
+            for field in ('deposited', 'deposits', 'withdrawn', 'withdrawals')
+        }
+        return Response({
+            'wallet_uuid': wallet_uuid,
+            'from': date_from,
+            'to': date_to,
+            'days': StatementDaySerializer(days, many=True).data,
+            'total': StatementTotalSerializer(total).data,
+        })
 
 
 class WalletDestroyApiView(DestroyAPIView):
@@ -60,31 +237,465 @@ class WalletDestroyApiView(DestroyAPIView):
     lookup_field = 'uuid'
     lookup_url_kwarg = 'uuid'
 
+    @on_wallet_shard
+    def delete(self, request, *args, **kwargs):
+        # get_object_or_404 и удаление - в шарде кошелька
+        return super().delete(request, *args, **kwargs)
+
     def perform_destroy(self, instance):
-        if instance.balance != 0:
+        if instance.get_balance() != 0:
             raise ValidationError({"detail": "Нельзя удалить кошелек с положительным балансом"})
+        wallet_uuid = instance.uuid
         instance.delete()
+        transaction.on_commit(lambda: get_balance_cache().delete(wallet_uuid), using=wallet_db(), robust=True)
 
 
 class WalletOperationView(APIView):
+    """
+    Пополнение и списание средств. С заголовком Prefer: respond-async
+    операция принимается в очередь и применяется обработчиком (202)
+    """
 
+    @on_wallet_shard
     def post(self, request, wallet_uuid):
-        wallet = get_object_or_404(Wallet, uuid=wallet_uuid)
-        serializer = OperationSerializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
+        validated_data = compiled_operation.validate(request.data)
+        operation_type = validated_data['operation_type']
+        amount = validated_data['amount']
 
-        try:
-            # Вся логика внутри модели
-            wallet.update_balance(
-                operation_type=serializer.validated_data['operation_type'],
-                amount=serializer.validated_data['amount']
+        # Повтор запроса с тем же ключом возвращает исходный ответ
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is not None:
+            if not 0 < len(idempotency_key) <= IdempotencyKey._meta.get_field('key').max_length:
+                return Response(
+                    {'error': 'Некорректный ключ идемпотентности'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            stored = IdempotencyKey.objects.filter(wallet_id=wallet_uuid, key=idempotency_key).first()
+            if stored is not None:
+                return self.replay(stored, operation_type, amount)
+        if respond_async(request):
+            return self.enqueue(wallet_uuid, operation_type, amount, idempotency_key)
+
+        # Движок выбирается настройкой WALLET_OPERATION_ENGINE
+        engine = get_engine()
+        operation = {
+            'wallet_uuid': wallet_uuid,
+            'operation_type': operation_type,
+            'amount': amount,
+            'idempotency_key': idempotency_key,
+        }
+        # Допуск до блокировки строки кошелька: сверх пределов - сразу 429 с Retry-After
+        with admit(wallet_uuid, request.user.pk):
+            try:
+                try:
+                    balance = engine.apply(**operation)
+                except IntegrityError:
+                    if idempotency_key is None:
+                        raise
+                    # Конкурентный запрос с тем же ключом успел зафиксироваться первым
+                    stored = IdempotencyKey.objects.filter(wallet_id=wallet_uuid, key=idempotency_key).first()
+                    if stored is not None:
+                        return self.replay(stored, operation_type, amount)
+                    # Общую пачку откатил дубликат чужого ключа - повторяем операцию
+                    balance = engine.apply(**operation)
+                return Response({'balance': balance}, status=status.HTTP_200_OK)
+            except ValidationError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    @staticmethod
+    def replay(stored, operation_type, amount):
+        if not stored.matches(operation_type, amount):
+            return Response(
+                {'error': 'Ключ идемпотентности уже использован с другими параметрами'},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY
             )
-            # Логирование операции
-            Operation.objects.create(
-                wallet=wallet,
-                operation_type=serializer.validated_data['operation_type'],
-                amount=serializer.validated_data['amount']
+        return Response({'balance': stored.balance}, status=status.HTTP_200_OK, headers={'Idempotent-Replayed': 'true'})
+
+    @staticmethod
+    def enqueue(wallet_uuid, operation_type, amount, idempotency_key):
+        """
+        Прием операции в очередь: 202 со ссылкой на статус. Допуск (admit) не
+        нужен - прием не блокирует строку кошелька. Повтор с тем же ключом
+        возвращает уже принятую операцию.
+        """
+        # Несуществующий кошелек - 404 сразу, а не ошибкой обработки
+        get_wallet_state(wallet_uuid)
+        queued, replayed = None, False
+        if idempotency_key is not None:
+            queued = QueuedOperation.objects.filter(wallet_id=wallet_uuid, idempotency_key=idempotency_key).first()
+            replayed = queued is not None
+        if queued is None:
+            try:
+                queued = enqueue(wallet_uuid, operation_type, amount, idempotency_key)
+            except IntegrityError:
+                if idempotency_key is None:
+                    raise
+                # Конкурентный запрос с тем же ключом успел зафиксироваться первым
+                queued = QueuedOperation.objects.get(wallet_id=wallet_uuid, idempotency_key=idempotency_key)
+                replayed = True
+        if replayed and not queued.matches(operation_type, amount):
+            return Response(
+                {'error': 'Ключ идемпотентности уже использован с другими параметрами'},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY
             )
-            return Response({'balance': wallet.balance}, status=status.HTTP_200_OK)
+        headers = {
+            'Location': reverse('wallets:queued_operation', args=[wallet_uuid, queued.id]),
+            'Preference-Applied': 'respond-async',
+        }
+        if replayed:
+            headers['Idempotent-Replayed'] = 'true'
+        return Response(QueuedOperationSerializer(queued).data, status=status.HTTP_202_ACCEPTED, headers=headers)
+
+
+class QueuedOperationView(APIView):
+    """
+    Статус операции, принятой в асинхронном режиме. С параметром wait
+    (секунды, не больше WALLET_LONG_POLL_MAX_WAIT) ответ ждет обработки
+    """
+    permission_classes = (IsAdmin | IsOwner,)
+
+    @on_wallet_shard
+    def get(self, request, wallet_uuid, operation_id):
+        cache = get_balance_cache()
+        state = get_wallet_state(wallet_uuid, cache)
+        self.check_object_permissions(request, Wallet(uuid=wallet_uuid, owner_id=state['owner']))
+
+        deadline = time.monotonic() + WalletRetrieveView.wait_seconds(request.query_params)
+        while True:
+            queued = QueuedOperation.objects.filter(wallet_id=wallet_uuid, pk=operation_id).first()
+            if queued is None:
+                # Http404, а не ответ: on_wallet_shard повторит поиск, если кошелек перенесли
+                raise Http404
+            remaining = deadline - time.monotonic()
+            if queued.status != QueuedOperation.PENDING or remaining <= 0:
+                return Response(QueuedOperationSerializer(queued).data)
+            # Примененная операция меняет версию кошелька; отказ - нет, поэтому статус перечитывается
+            # не реже раза в WALLET_LONG_POLL_INTERVAL секунд
+            cache.wait(wallet_uuid, state['version'], min(remaining, settings.WALLET_LONG_POLL_INTERVAL))
+            state = get_wallet_state(wallet_uuid, cache, refresh=not cache.shared)
+
+
+class BatchOperationView(APIView):
+    """
+    Пачка пополнений и списаний по нескольким кошелькам
+    """
+    permission_classes = (IsAdmin,)
+
+    def post(self, request):
+        serializer = BatchOperationSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        batch = [PendingOperation(**item) for item in serializer.validated_data['operations']]
+        all_or_nothing = serializer.validated_data['mode'] == BatchOperationSerializer.ALL_OR_NOTHING
+        try:
+            applied = apply_on_shards(batch, all_or_nothing=all_or_nothing)
         except ValidationError as e:
-            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({'error': self.error_message(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not applied:
+            errors = [
+                {'index': index, 'wallet_uuid': item.wallet_uuid, 'error': self.error_message(item.error)}
+                for index, item in enumerate(batch) if item.error is not None
+            ]
+            return Response({'errors': errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = [
+            {'wallet_uuid': item.wallet_uuid, 'balance': item.balance} if item.error is None
+            else {'wallet_uuid': item.wallet_uuid, 'error': self.error_message(item.error)}
+            for item in batch
+        ]
+        return Response({'results': results}, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def error_message(error):
+        if isinstance(error, ValidationError):
+            return error.detail[0]
+        return str(error)
+
+
+class TransferView(APIView):
+    """
+    Перевод средств между кошельками
+    """
+    permission_classes = (IsAdmin | IsOwner,)
+
+    def post(self, request):
+        validated_data = compiled_transfer.validate(request.data)
+        source = validated_data['source']
+
+        # Владелец источника из кэша состояния: проверка прав без запроса к базе
+        owner = on_shard(source, get_wallet_state, source)['owner']
+        self.check_object_permissions(request, Wallet(uuid=source, owner_id=owner))
+
+        try:
+            withdraw = transfer(source, validated_data['destination'], validated_data['amount'])
+        except ValidationError as e:
+            return Response({'error': str(e.detail[0])}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'transfer_id': withdraw.transfer_id, 'balance': withdraw.balance}, status=status.HTTP_200_OK)
+
+
+class BalanceCacheStatsView(APIView):
+    """
+    Счетчики попаданий и промахов кэша состояния кошельков
+    """
+    permission_classes = (IsAdmin,)
+
+    def get(self, request):
+        return Response(get_balance_cache().stats())
+
+
+class HealthView(APIView):
+    """
+    Проверка готовности процесса: соединение с базой (из пула, если он включен)
+    """
+    authentication_classes = ()
+    permission_classes = (AllowAny,)
+
+    def get(self, request):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except DatabaseError:
+            return Response({'status': 'unavailable'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({'status': 'ok'})
+
+
+class MetricsView(View):
+    """
+    Метрики запросов и блокировок кошельков процесса в текстовом формате
+    Prometheus. Доступ - с заголовком Authorization: Bearer <METRICS_TOKEN>
+    (если токен задан) или с JWT администратора, как у статистики кэша и пулов.
+    """
+
+    def get(self, request):
+        if not self.has_metrics_token(request):
+            try:
+                result = ClaimsJWTAuthentication().authenticate(request)
+            except AuthenticationFailed:
+                result = None
+            if result is None:
+                return HttpResponse(status=status.HTTP_401_UNAUTHORIZED, headers={'WWW-Authenticate': 'Bearer'})
+            request.user = result[0]
+            if not IsAdmin().has_permission(request, self):
+                return HttpResponse(status=status.HTTP_403_FORBIDDEN)
+        return HttpResponse(
+            registry.export() + telemetry.export(), content_type='text/plain; version=0.0.4; charset=utf-8'
+        )
+
+    @staticmethod
+    def has_metrics_token(request):
+        return bool(settings.METRICS_TOKEN) and constant_time_compare(
+            request.headers.get('Authorization', ''), f'Bearer {settings.METRICS_TOKEN}'
+        )
+
+
+class DatabasePoolStatsView(APIView):
+    """
+    Счетчики пулов соединений процесса: синхронного (DB_POOL_ENABLED) и
+    пулов асинхронных представлений. Счетчики накапливаются с запуска процесса.
+    """
+    permission_classes = (IsAdmin,)
+
+    def get(self, request):
+        return Response({
+            'pid': os.getpid(),
+            'default': self.describe(connection.pool) if connection.pool is not None else None,
+            'async': [self.describe(pool) for pool in async_db.get_pools()],
+        })
+
+    @staticmethod
+    def describe(pool):
+        stats = pool.get_stats()
+        return {
+            'min_size': stats['pool_min'],
+            'max_size': stats['pool_max'],
+            'size': stats['pool_size'],
+            'available': stats['pool_available'],
+            # Запросы соединения: всего, сколько из них ждали и сколько не дождались (timeout)
+            'checkouts': stats.get('requests_num', 0),
+            'waits': stats.get('requests_queued', 0),
+            'wait_ms': stats.get('requests_wait_ms', 0),
+            'timeouts': stats.get('requests_errors', 0),
+            'waiting': stats.get('requests_waiting', 0),
+            'connections': stats.get('connections_num', 0),
+            'connection_errors': stats.get('connections_errors', 0),
+            'connections_lost': stats.get('connections_lost', 0),
+        }
+
+
+class AsyncAPIView(View):
+    """
+    Основа асинхронных представлений.
+
+    Обработчики возвращают Response, как в APIView, ответ всегда в JSON.
+    Аутентификация по JWT и пермишены работают без синхронных обращений
+    к базе, поэтому запрос не уходит в поток. Ошибки оформляются
+    обработчиком исключений DRF.
+    """
+    authentication_class = AsyncJWTAuthentication
+    permission_classes = (IsAuthenticated,)
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Как у APIView: аутентификация по заголовку, CSRF не проверяется
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            request.user = await self.authenticate(request)
+            self.check_permissions(request)
+            response = await super().dispatch(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(request, exc)
+        if not isinstance(response, Response):
+            return response
+        # Рендерер JSON из настроек REST_FRAMEWORK (первый в списке)
+        started = time.perf_counter()
+        content = api_settings.DEFAULT_RENDERER_CLASSES[0]().render(response.data)
+        render_finished(started)
+        rendered = HttpResponse(content, status=response.status_code, content_type='application/json')
+        for header, value in response.items():
+            if header != 'Content-Type':
+                rendered[header] = value
+        return rendered
+
+    async def authenticate(self, request):
+        result = await self.authentication_class().aauthenticate(request)
+        return AnonymousUser() if result is None else result[0]
+
+    def get_permissions(self):
+        return [permission() for permission in self.permission_classes]
+
+    def check_permissions(self, request):
+        for permission in self.get_permissions():
+            if not permission.has_permission(request, self):
+                self.permission_denied(request)
+
+    def check_object_permissions(self, request, obj):
+        for permission in self.get_permissions():
+            if not permission.has_object_permission(request, self, obj):
+                self.permission_denied(request)
+
+    @staticmethod
+    def permission_denied(request):
+        if not request.user.is_authenticated:
+            raise NotAuthenticated()
+        raise PermissionDenied()
+
+    def handle_exception(self, request, exc):
+        if isinstance(exc, (NotAuthenticated, AuthenticationFailed)):
+            exc.auth_header = self.authentication_class().authenticate_header(request)
+        response = exception_handler(exc, {'view': self, 'request': request})
+        if response is None:
+            raise exc
+        return response
+
+
+class WalletRetrieveAsyncView(AsyncAPIView):
+    """
+    Просмотр кошелька без потока на запрос, тот же ответ, что у
+    WalletRetrieveView. Ожидание изменения (wait) не занимает поток.
+    """
+    permission_classes = (IsAdmin | IsOwner,)
+
+    @on_wallet_shard
+    async def get(self, request, wallet_uuid):
+        cache = get_balance_cache()
+        state = await aget_wallet_state(wallet_uuid, cache)
+
+        # Проверка пермишенов для объекта
+        self.check_object_permissions(request, Wallet(uuid=wallet_uuid, owner_id=state['owner']))
+
+        etags = parse_etags(request.headers.get('If-None-Match', ''))
+        etag = WalletRetrieveView.etag
+        if etag(state) in etags:
+            state = await self.wait_for_change(cache, wallet_uuid, state, WalletRetrieveView.wait_seconds(request.GET))
+        if etag(state) in etags or '*' in etags:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag(state)})
+
+        wallet = Wallet(uuid=wallet_uuid, balance=state['balance'], owner_id=state['owner'])
+        return Response(compiled_wallet.to_representation(wallet), headers={'ETag': etag(state)})
+
+    @staticmethod
+    async def wait_for_change(cache, wallet_uuid, state, seconds):
+        deadline = time.monotonic() + seconds
+        while (remaining := deadline - time.monotonic()) > 0:
+            if not cache.shared:
+                remaining = min(remaining, settings.WALLET_LONG_POLL_INTERVAL)
+            changed = await cache.await_change(wallet_uuid, state['version'], remaining)
+            current = await aget_wallet_state(wallet_uuid, cache, refresh=not changed and not cache.shared)
+            if current['version'] != state['version']:
+                return current
+        return state
+
+
+class WalletOperationAsyncView(AsyncAPIView):
+    """
+    Пополнение и списание средств без потока на запрос: движок 'atomic'
+    выполняет операцию через асинхронный пул, остальные движки - в потоке
+    """
+
+    @on_wallet_shard
+    async def post(self, request, wallet_uuid):
+        validated_data = compiled_operation.validate(self.parse(request))
+        operation_type = validated_data['operation_type']
+        amount = validated_data['amount']
+
+        # Повтор запроса с тем же ключом возвращает исходный ответ
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is not None:
+            if not 0 < len(idempotency_key) <= IdempotencyKey._meta.get_field('key').max_length:
+                return Response(
+                    {'error': 'Некорректный ключ идемпотентности'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            stored = await self.stored_key(wallet_uuid, idempotency_key)
+            if stored is not None:
+                return WalletOperationView.replay(stored, operation_type, amount)
+        if respond_async(request):
+            return await sync_to_async(WalletOperationView.enqueue)(
+                wallet_uuid, operation_type, amount, idempotency_key
+            )
+
+        engine = get_engine()
+        operation = {
+            'wallet_uuid': wallet_uuid,
+            'operation_type': operation_type,
+            'amount': amount,
+            'idempotency_key': idempotency_key,
+        }
+        async with aadmit(wallet_uuid, request.user.pk):
+            try:
+                try:
+                    balance = await engine.aapply(**operation)
+                except IntegrityError:
+                    if idempotency_key is None:
+                        raise
+                    stored = await self.stored_key(wallet_uuid, idempotency_key)
+                    if stored is not None:
+                        return WalletOperationView.replay(stored, operation_type, amount)
+                    balance = await engine.aapply(**operation)
+                return Response({'balance': balance}, status=status.HTTP_200_OK)
+            except ValidationError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    @staticmethod
+    def parse(request):
+        if request.content_type != 'application/json':
+            return request.POST
+        if not request.body:
+            return {}
+        # Парсер JSON из настроек REST_FRAMEWORK (первый в списке)
+        return api_settings.DEFAULT_PARSER_CLASSES[0]().parse(BytesIO(request.body))
+
+    @staticmethod
+    async def stored_key(wallet_uuid, key):
+        row = await async_db.fetchone(
+            f'SELECT operation_type, amount, balance FROM {IdempotencyKey._meta.db_table} '
+            f'WHERE wallet_id = %s AND key = %s',
+            [wallet_uuid, key],
+            using=wallet_db()
+        )
+        if row is None:
+            return None
+        return IdempotencyKey(wallet_id=wallet_uuid, key=key, operation_type=row[0], amount=row[1], balance=row[2])